@@ -0,0 +1,169 @@
+# Name:         augment.py
+# Description:  Random augmentation of whole training batches with NumPy, used
+#               through the transform hook of 'batches.py'.
+# Instructions: python augment.py [--dataset training_data/dataset] [--workers 4]
+#               measures augmented samples per second; train.py --augment
+#               trains with it.
+# Notes:        Every sample gets its own random flip, shift, contrast and
+#               brightness, but the batch is processed at once: flips are one
+#               reversed slice over the flipped samples, shifts one slice per
+#               distinct amount over the samples shifted by it (edges are
+#               repeated), contrast and brightness one broadcast multiply-add.
+#               A horizontal flip turns a left turn into a right one, so the
+#               labels of the classes in swap are exchanged for flipped
+#               samples. Nothing is written to disk.
+
+"""Vectorized on-the-fly data augmentation with label-aware flips."""
+import argparse
+import multiprocessing
+import time
+
+import numpy as np
+
+import batches
+import dataset
+from frame_receiver import clock
+
+# forward_left and forward_right (see dispatcher.CLASS_COMMANDS) swap when mirrored
+SWAP = (0, 1)
+
+
+def shift(frames, amount, axis):
+    """Returns frames moved amount pixels along axis, repeating the edge."""
+    out = np.empty_like(frames)
+    size = frames.shape[axis]
+    index = [slice(None)] * frames.ndim
+
+    def at(part):
+        index[axis] = part
+        return tuple(index)
+
+    if amount > 0:
+        out[at(slice(amount, None))] = frames[at(slice(0, size - amount))]
+        out[at(slice(0, amount))] = frames[at(slice(0, 1))]
+    else:
+        out[at(slice(0, size + amount))] = frames[at(slice(-amount, None))]
+        out[at(slice(size + amount, None))] = frames[at(slice(size - 1, size))]
+    return out
+
+
+class Augmenter(object):
+    """Callable transform(images, labels) -> (images, labels).
+
+    images are (N, frame_size) rows, uint8 in [0,255] or float in [0,1]; the
+    result has the same dtype. labels are one hot rows or class indexes.
+    flip is the probability of mirroring a sample, shift the largest shift in
+    pixels, contrast and brightness the largest relative change of each.
+    """
+
+    def __init__(self, flip=0.5, shift=4, contrast=0.2, brightness=0.1,
+                 frame_shape=dataset.FRAME_SHAPE, swap=SWAP, seed=None):
+        self.flip = flip
+        self.shift = shift
+        self.contrast = contrast
+        self.brightness = brightness
+        self.frame_shape = tuple(frame_shape)
+        self.swap = swap
+        self.random = np.random.RandomState(seed)
+        self.samples = 0
+        self.seconds = 0.0
+
+    def reseed(self, seed):
+        """Gives a copy in a worker process its own random stream."""
+        self.random = np.random.RandomState(seed)
+
+    def flip_labels(self, labels, flipped):
+        labels = np.array(labels)
+        if self.swap is None or not flipped.any():
+            return labels
+        first, second = self.swap
+        if labels.ndim == 2:
+            labels[flipped, first], labels[flipped, second] = (
+                labels[flipped, second], labels[flipped, first])
+        else:
+            rows = labels[flipped]
+            labels[flipped] = np.where(rows == first, second,
+                                       np.where(rows == second, first, rows))
+        return labels
+
+    def __call__(self, images, labels):
+        start = clock()
+        count = len(images)
+        random = self.random
+        frames = np.asarray(images).reshape((count,) + self.frame_shape)
+
+        flipped = random.random_sample(count) < self.flip
+        out = frames.copy()
+        out[flipped] = frames[flipped, :, ::-1]
+        if self.shift:
+            # One pass per distinct shift, over every sample that has it
+            for axis in (2, 1):
+                shifts = random.randint(-self.shift, self.shift + 1, count)
+                for amount in np.unique(shifts[shifts != 0]):
+                    chosen = shifts == amount
+                    out[chosen] = shift(out[chosen], amount, axis)
+
+        if self.contrast or self.brightness:
+            top = 255.0 if out.dtype == np.uint8 else 1.0
+            gain = 1.0 + random.uniform(-self.contrast, self.contrast, (count, 1, 1))
+            offset = random.uniform(-self.brightness, self.brightness, (count, 1, 1)) * top
+            # Contrast scales about each frame's own mean
+            offset += frames.mean(axis=(1, 2), dtype=np.float32, keepdims=True) * (1.0 - gain)
+            if out.dtype == np.uint8:
+                # Truncating x + 0.5 below rounds to the nearest value
+                offset += 0.5
+            adjusted = out.astype(np.float32)
+            adjusted *= gain.astype(np.float32)
+            adjusted += offset.astype(np.float32)
+            np.clip(adjusted, 0, top, out=adjusted)
+            out = adjusted.astype(out.dtype, copy=False)
+
+        labels = self.flip_labels(labels, flipped)
+        self.samples += count
+        self.seconds += clock() - start
+        return out.reshape(count, -1), labels
+
+    def stats(self):
+        return {
+            'samples': self.samples,
+            'seconds': self.seconds,
+            'samples_per_second': self.samples / self.seconds if self.seconds else 0.0,
+        }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Measures batch augmentation throughput.')
+    parser.add_argument('--dataset', dest='dataset', default=dataset.DATASET_DIR,
+                        help='Dataset directory to augment batches from.')
+    parser.add_argument('--batch-size', dest='batch_size', default=256, type=int,
+                        help='Samples per batch.')
+    parser.add_argument('--batches', dest='batches', default=50, type=int,
+                        help='Batches to measure.')
+    parser.add_argument('--workers', dest='workers', default=multiprocessing.cpu_count(),
+                        type=int, help='Worker processes for the parallel measurement.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    data = dataset.Dataset(args.dataset)
+    augmenter = Augmenter()
+    for workers in sorted(set([0, args.workers])):
+        generator = batches.BatchGenerator(data, batch_size=args.batch_size,
+                                           transform=augmenter, workers=workers)
+        next(generator)
+        start = time.time()
+        samples = 0
+        for _ in range(args.batches):
+            images, _ = next(generator)
+            samples += len(images)
+        elapsed = time.time() - start
+        generator.close()
+        print('%d workers: %.0f augmented samples/s, %.1f ms per batch of %d '
+              '(augmenting alone %.0f samples/s per process)' % (
+                  workers, samples / elapsed, 1000.0 * elapsed / args.batches,
+                  args.batch_size, generator.stats()['transform_samples_per_second']))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,75 +6,42 @@
 #               directly from https://github.com/bskari/pi-rc/blob/master/interactive_control.py
 # Notes:        I have made modifications to the code obtained from above in order
 #               to streamline the training process to work with pi-rc and Keras. 
-#               Autopy key module can be found at http://www.autopy.org/documentation/api-reference/key.html
+#               Predictions are sent to pi_pcm directly by 'dispatcher.py'.
+#               With --headless pygame is never imported, no window is opened
+#               and Ctrl+C stops driving. Either way the model is loaded and
+#               warmed up before the Raspberry Pi's connection is accepted.
+#               Frames are cropped and downsampled by the preprocessing spec
+#               the model was trained with (see preprocess.py).
+
+from __future__ import print_function
+
+import time
+STARTED = time.time()
 
-import pygame
-import pygame.font
-import numpy as np
 import socket
 import argparse
 import json
-import cStringIO
-import io
-import time
 
-from keras.models import load_model
-from pygame.locals import *
-from common import dead_frequency
+from common import load_configuration
 from common import server_up
-from PIL import Image, ImageFile
-from autopy import key
+from frame_receiver import FrameReceiver
+from dispatcher import CommandDispatcher
+from drive_loop import drive_pipeline, load_predictor
+from frame_receiver import clock
+from feedback import FeedbackSender
+from control_scheduler import ControlScheduler
+from metrics import add_arguments, from_args
+from preprocess import for_model
+from session_log import SessionRecorder, new_session_dir
+from wire_format import FORMATS
+from PIL import ImageFile
 
 
 UP = LEFT = DOWN = RIGHT = False
 QUIT = False
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-
-# Name:        load_configuration(configuration_file)
-# Description: Generates a dict of JSON command messages for each movement.
-def load_configuration(configuration_file):
-  configuration = json.loads(configuration_file.read())
-  dead = dead_frequency(configuration['frequency'])
-  sync_command = {
-      'frequency': configuration['frequency'],
-      'dead_frequency': dead,
-      'burst_us': configuration['synchronization_burst_us'],
-      'spacing_us': configuration['synchronization_spacing_us'],
-      'repeats': configuration['total_synchronizations'],
-  }
-  base_command = {
-      'frequency': configuration['frequency'],
-      'dead_frequency': dead,
-      'burst_us': configuration['signal_burst_us'],
-      'spacing_us': configuration['signal_spacing_us'],
-  }
-  movement_to_command = {}
-  for key in (
-      'forward',
-      'forward_left',
-      'forward_right',
-      'left',
-      'reverse',
-      'reverse_left',
-      'reverse_right',
-      'right',
-  ):
-      command_dict = base_command.copy()
-      command_dict['repeats'] = configuration[key]
-      movement_to_command[key] = command_dict
-
-  direct_commands = {
-      key: json.dumps([sync_command, movement_to_command[key]])
-      for key in movement_to_command
-  }
-
-  # We also need to add an idle command; just broadcast at the dead frequency
-  command_dict = [base_command.copy()]
-  command_dict[0]['frequency'] = dead
-  command_dict[0]['repeats'] = 20  # Doesn't matter
-  direct_commands['idle'] = json.dumps(command_dict)
-
-  return direct_commands
+# Only imported when there is a window, see autodriver()
+pygame = None
 
 # Name:        get_keys()
 # Description: Returns a tuple of (UP, DOWN, LEFT, RIGHT, changed) representing which
@@ -108,136 +75,94 @@ def get_keys():
 # Description: Similar to interactive_control in self_control_train.py except 
 #              the car will drive itself after receiving input images from socket 
 #              socket stream. 
-def autodriver(host, port, configuration):
+def autodriver(host, port, configuration, model_file='96_model.h5', record=False, tick_rate=2.0,
+               metrics=None, headless=False, listen='192.168.1.186'):
+  # Loading the model to use for autopilot, and making one prediction, before
+  # the Raspberry Pi can connect so its first frames do not wait for either
+  spec = for_model(model_file)
+  model = load_predictor(model_file, spec.size)
+  print('Model inputs:', spec)
+  if not headless:
+    global pygame
+    import pygame
+    pygame.init()
+
   # Setting up server
   server_socket = socket.socket()
-  server_socket.bind(('192.168.1.186', 8000))
+  server_socket.bind((listen, 8000))
   server_socket.listen(0)
+  print('Ready for the Raspberry Pi after %.2f s' % (time.time() - STARTED))
 
   # accept Raspberry Pi connection
-  connection = server_socket.accept()[0].makefile('rb')
-  pygame.init()
-
-  # Creating labels using one hot encoding method. There are 4 commands: 
-  # up, down, left, right, and therefore labels are 4 dimensional
-  # vectors. 
-  labels = np.zeros((4,4), 'float')
-  for i in range(4):
-    labels[i,i] = 1
-  
-  # The actual assignment of keypress to label
-  temp_label = np.zeros((1,4), 'float')
-  # Loading the Keras model to use for autopilot
-  model = load_model('96_model.h5')
-
-  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  connection = server_socket.accept()[0]
+  connected = clock()
+  # Optionally keep the raw stream and every command decision on disk so the
+  # session can be replayed later (see replay.py)
+  recorder = SessionRecorder(new_session_dir()) if record else None
+  receiver = FrameReceiver(connection, recorder=recorder, formats=FORMATS)
+  # Tells the client how far behind we are so it can send fewer, smaller frames
+  feedback = FeedbackSender(connection, receiver)
+
+  # Predictions go straight to pi_pcm, no faked keypresses. The car idles if
+  # they stop coming for a second.
+  dispatcher = CommandDispatcher(host, port, configuration, failsafe=1.0)
   
   # Assign send_inst to True initially; stream condition
   global send_inst
   send_inst = True
 
-  # Image is 320x120 that is reshaped into one row vector
-  image_array = np.zeros((1, 38400))
-  image_label = np.zeros((1,4), 'float')
-  saved_frame = 0
-  total_frames = 0
-
-  print 'Collecting images...'
-  
-
-  # Stream the image frame by frame
-  while not QUIT:
-    try: 
-      stream_bytes = ' '
-      frame = 1
-      while send_inst:
-        stream_bytes += connection.read(1024)
-        # JPEG image files begin with FF D8 and end with FF D9
-        first = stream_bytes.find('\xff\xd8')
-        last = stream_bytes.find('\xff\xd9')
-        if first != -1 and last != -1:
-          jpg = stream_bytes[first:last + 2]
-          stream_bytes = stream_bytes[last + 2:]
-          image = Image.open(cStringIO.StringIO(jpg))
-          # Image is converted to grayscale (MUST)
-          image = image.convert(mode='L')
-          image = np.asarray(image)
-          image = np.array(np.asarray(image))
-          image_crop = image[120:240,:]
-          temp_array = image_crop.reshape(1, 38400).astype(np.float32)
-
-          #up, down, left, right, change = get_keys()
-          ##########################TO DO#########################
-          # Currently, I am using Autopy's key module to mimic keypresses in order
-          # for PyGame to grab and send to pi_pcm. However this is a little buggy
-          # and tends to spam the key presses. 
-          # 1. Fix spammy key presses
-          # 2. Add delay by using either sleep timer or average out predictions
-          # 3. so that autopilot will only provide one command every, say, 0.5 seconds.
-
-          # Predict which of the four classes (Left, Right, Up, Down) to send
-          # to the car. 
-          time.sleep(0.1)
-          predict = model.predict_classes(temp_array)
-        
-          if predict == 0:
-            print 'Go left'
-            up, down, left, right, change = get_keys()
-            key.toggle(long(key.K_LEFT), True)
-            key.toggle(long(key.K_UP), True)
-            key.toggle(long(key.K_LEFT), False)
-            key.toggle(long(key.K_UP), False)
-            up, down, left, right, change = get_keys()
-          if predict == 1:
-            print 'Go right'
-            up, down, left, right, change = get_keys()
-            key.toggle(long(key.K_RIGHT), True)
-            key.toggle(long(key.K_UP), True)
-            key.toggle(long(key.K_RIGHT), False)
-            key.toggle(long(key.K_UP), False)
-            up, down, left, right, change = get_keys()
-          if predict == 2:
-            print 'Go forward'
-            up, down, left, right, change = get_keys()
-            key.toggle(long(key.K_UP), True)
-            time.sleep(0.05)
-            key.toggle(long(key.K_UP), False)
-            up, down, left, right, change = get_keys()
-          if predict == 3:
-            print 'Go reverse'
-            up, down, left, right, change = get_keys()
-            key.toggle(long(key.K_DOWN), True)
-            time.sleep(0.05)
-            key.toggle(long(key.K_DOWN), False)
-            up, down, left, right, change = get_keys()
-
-
-          if change:
-              # Something changed, so send a new command
-            command = 'idle'
-            if up:
-                command = 'forward'
-                
-            elif down:
-                command = 'reverse'
-                
-            append = lambda x: command + '_' + x if command != 'idle' else x
-
-            if left:
-                command = append('left')
-                
-            elif right:
-                command = append('right')
-
-            print(command)
-            try:
-                sock.sendto(configuration[command], (host, port))
-            except TypeError:
-                # Windows + Python 3 workaround?
-              sock.sendto(bytes(configuration[command], 'utf-8'), (host, port))
-    finally: 
-      connection.close()
-      server_socket.close()
+  # Still pump pygame so that escape/q quits
+  def poll():
+    get_keys()
+    return QUIT or not send_inst
+  if headless:
+    poll = None
+
+  # Averaged predictions become one command per tick, tick_rate times a
+  # second; idle goes out when no fresh prediction made it in time
+  scheduler = None
+  if tick_rate:
+    scheduler = ControlScheduler(dispatcher, tick_rate, recorder=recorder, verbose=True)
+  pipeline = drive_pipeline(receiver, model, dispatcher, poll, recorder=recorder,
+                            feedback=feedback, scheduler=scheduler, metrics=metrics,
+                            preprocess=spec)
+  if metrics is not None:
+    metrics.add_source('pipeline', pipeline.stats)
+    metrics.add_source('receiver', receiver.stats)
+    metrics.add_source('dispatcher', dispatcher.stats)
+    if scheduler is not None:
+      metrics.add_source('scheduler', scheduler.stats)
+
+  print('Collecting images...')
+
+  # Stream the image frame by frame. The actuate stage runs here on the main
+  # thread since pygame expects it.
+  try: 
+    if scheduler is not None:
+      scheduler.start()
+    try:
+      pipeline.run(report_interval=5.0)
+    except KeyboardInterrupt:
+      print('Stopping...')
+    if pipeline.first_finished is not None:
+      print('First prediction acted on %.3f s after the connection' % (
+          pipeline.first_finished - connected))
+    print('Pipeline stats:', pipeline.stats())
+    print('Receiver stats:', receiver.stats())
+    print('Dispatcher stats:', dispatcher.stats())
+    if scheduler is not None:
+      print('Scheduler stats:', scheduler.stats())
+  finally: 
+    if scheduler is not None:
+      scheduler.stop()
+    pipeline.stop()
+    dispatcher.idle()
+    dispatcher.close()
+    connection.close()
+    server_socket.close()
+    if recorder is not None:
+      recorder.close()
+      print('Session recorded to', recorder.directory)
 
 # Name:         make_parser()
 # Description:  Builds and returns an argument parser.
@@ -264,6 +189,43 @@ def make_parser():
       help='The server to send control commands to.',
       default='127.1'
   )
+  parser.add_argument(
+      '-m',
+      '--model',
+      dest='model',
+      help='Model to drive with: a Keras .h5 file or a .npz from export_model.py.',
+      default='96_model.h5'
+  )
+  parser.add_argument(
+      '-t',
+      '--tick-rate',
+      dest='tick_rate',
+      help='Commands per second, each from the predictions averaged since the '
+           'last; 0 sends one per prediction.',
+      default=2.0,
+      type=float
+  )
+  parser.add_argument(
+      '-r',
+      '--record',
+      dest='record',
+      help='Record the raw camera stream and commands under sessions/.',
+      action='store_true'
+  )
+  parser.add_argument(
+      '--headless',
+      dest='headless',
+      help='No pygame window; stop with Ctrl+C.',
+      action='store_true'
+  )
+  parser.add_argument(
+      '-l',
+      '--listen',
+      dest='listen',
+      help='Address to accept the Raspberry Pi camera stream on.',
+      default='192.168.1.186'
+  )
+  add_arguments(parser)
   return parser
 
 # Name:         main()
@@ -283,6 +245,7 @@ def main():
       print('Server does not appear to be listening for messages, aborting')
       return
 
-  autodriver(args.server, args.port, configuration)
+  autodriver(args.server, args.port, configuration, args.model, args.record,
+             args.tick_rate, from_args(args), args.headless, args.listen)
 if __name__ == '__main__':
   main()
\ No newline at end of file
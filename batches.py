@@ -0,0 +1,229 @@
+# Name:         batches.py
+# Description:  Feeds Keras from a 'dataset.py' dataset one batch at a time
+#               so training never needs the whole normalized set in RAM.
+# Notes:        Shuffling permutes indexes only; frames stay where they are on
+#               disk and are gathered and scaled to float32 per batch. A
+#               background thread keeps the next few batches ready while the
+#               current one trains. With workers, batches (and their
+#               transform, e.g. 'augment.py') are built in worker processes
+#               instead, each with its own mapping of the dataset; they hand
+#               back uint8 frames, which cost a quarter of float32 to pass
+#               between processes, and are scaled here. close() lets the
+#               requests already handed to the workers finish before shutting
+#               the pool down; terminating it under them can deadlock.
+
+"""Prefetching batch generator over a memory-mapped dataset."""
+import collections
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import dataset
+from frame_receiver import clock
+from preprocess import PIXEL_SCALE
+
+# Raised in the consumer when the prefetch thread fails
+_ERROR = object()
+
+# State of a worker process, set up by _start_worker
+_worker = {}
+
+# Seconds close() waits for the producer and the workers before terminating them
+CLOSE_TIMEOUT = 30.0
+
+
+def _start_worker(directory, transform, seed):
+    _worker['data'] = dataset.Dataset(directory)
+    _worker['transform'] = transform
+    if hasattr(transform, 'reseed'):
+        # Forked workers would otherwise all draw the same random numbers
+        transform.reseed((seed or 0) + os.getpid())
+
+
+def _worker_batch(indices):
+    """Returns uint8 images, one hot labels and the seconds spent in transform."""
+    data = _worker['data']
+    images = data.take(indices)
+    labels = dataset.one_hot(data.labels[indices], data.num_classes)
+    transform = _worker['transform']
+    seconds = 0.0
+    if transform is not None:
+        start = clock()
+        images, labels = transform(images, labels)
+        seconds = clock() - start
+    return images, labels, seconds
+
+
+def split(count, validation_split=0.025, seed=None):
+    """Returns shuffled (train, validation) index arrays."""
+    order = np.random.RandomState(seed).permutation(count)
+    held_out = int(count * validation_split)
+    return order[held_out:], order[:held_out]
+
+
+class BatchGenerator(object):
+    """Endless (images, one hot labels) batches over the given indexes.
+
+    With shuffle the order is re-permuted every epoch. Batches are built by a
+    background thread, prefetch of them at a time, or with workers by that
+    many processes. A transform used with workers must be picklable and
+    accept uint8 images.
+    """
+
+    def __init__(
+        self,
+        data,
+        indices=None,
+        batch_size=256,
+        shuffle=True,
+        prefetch=4,
+        seed=None,
+        transform=None,
+        workers=0
+    ):
+        self.data = data
+        self.indices = np.arange(len(data)) if indices is None else np.asarray(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # Optional function(images, labels) -> (images, labels) applied per batch
+        self.transform = transform
+        self.random = np.random.RandomState(seed)
+        self.batches = 0
+        self.workers = workers
+        self.samples_built = 0
+        self.transform_seconds = 0.0
+        self._pool = None
+        # Requests handed to the workers, oldest first
+        self._pending = collections.deque()
+        if workers:
+            self._pool = multiprocessing.Pool(
+                workers, _start_worker, (data.directory, transform, seed))
+        self._queue = queue.Queue(maxsize=prefetch)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._produce, name='batches')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        """Batches per epoch."""
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    @property
+    def samples(self):
+        return len(self.indices)
+
+    def batch(self, indices):
+        """Returns float32 images in [0,1] and one hot labels for indices."""
+        # Sorted indexes keep reads from the mapped shards sequential
+        indices = np.sort(indices)
+        images = np.empty((len(indices), self.data.frame_size), np.float32)
+        self.data.take(indices, out=images)
+        images *= PIXEL_SCALE
+        labels = dataset.one_hot(self.data.labels[indices], self.data.num_classes)
+        if self.transform is not None:
+            start = clock()
+            images, labels = self.transform(images, labels)
+            self.transform_seconds += clock() - start
+        self.samples_built += len(indices)
+        return images, labels
+
+    def _batches(self):
+        """Yields batches forever, epoch after epoch."""
+        while len(self.indices):
+            order = self.indices
+            if self.shuffle:
+                order = order[self.random.permutation(len(order))]
+            for start in range(0, len(order), self.batch_size):
+                chunk = order[start:start + self.batch_size]
+                if self._pool is None:
+                    yield self.batch(chunk)
+                else:
+                    yield self._pool.apply_async(_worker_batch, (np.sort(chunk),))
+
+    def _collect(self, result):
+        images, labels, seconds = result.get()
+        scaled = images.astype(np.float32)
+        scaled *= PIXEL_SCALE
+        self.transform_seconds += seconds
+        self.samples_built += len(images)
+        return scaled, labels
+
+    def _put(self, item):
+        """Queues item unless the generator is stopped first."""
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _produce(self):
+        try:
+            batches = self._batches()
+            pending = self._pending
+            while not self._stopped.is_set():
+                if self._pool is None:
+                    item = next(batches)
+                else:
+                    while len(pending) < 2 * self.workers:
+                        pending.append(next(batches))
+                    item = self._collect(pending[0])
+                    pending.popleft()
+                self._put(item)
+        except Exception as error:
+            self._put((_ERROR, error))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item[0] is _ERROR:
+            raise item[1]
+        self.batches += 1
+        return item
+
+    next = __next__
+
+    def stats(self):
+        """Samples built so far and the rate the transform handled them at,
+        per process."""
+        return {
+            'batches': self.batches,
+            'samples': self.samples_built,
+            'workers': self.workers,
+            'transform_seconds': self.transform_seconds,
+            'transform_samples_per_second':
+                self.samples_built / self.transform_seconds if self.transform_seconds else 0.0,
+        }
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """Stops prefetching and shuts the workers down once the batches
+        they were handed are done; they are only terminated if that takes
+        longer than timeout seconds."""
+        self._stopped.set()
+        deadline = clock() + timeout
+        self._thread.join(timeout)
+        if self._pool is None:
+            return
+        finished = not self._thread.is_alive()
+        if finished:
+            for result in self._pending:
+                result.wait(max(0.0, deadline - clock()))
+                if not result.ready():
+                    finished = False
+                    break
+        if finished:
+            self._pool.close()
+        else:
+            self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+        self._pending.clear()
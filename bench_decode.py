@@ -0,0 +1,72 @@
+# Name:         bench_decode.py
+# Description:  Times the old per-frame decode used by the servers against
+#               decode_frame() from 'decode.py'.
+# Instructions: python bench_decode.py [--frames N] [--json results.json]
+
+import argparse
+import io
+import json
+import time
+
+import numpy as np
+from PIL import Image
+
+from bench_frame_receiver import make_jpeg
+from decode import decode_frame, crop_shape
+from frame_receiver import clock
+
+
+def old_decode(jpg):
+    """What auto-driver.py did: full color decode, convert, copy, crop, cast."""
+    image = Image.open(io.BytesIO(jpg))
+    image = image.convert(mode='L')
+    image = np.asarray(image)
+    image = np.array(np.asarray(image))
+    image_crop = image[120:240, :]
+    return image_crop.reshape(1, 38400).astype(np.float32)
+
+
+def time_per_frame(function, frames):
+    start = clock()
+    for _ in range(frames):
+        function()
+    return 1000.0 * (clock() - start) / frames
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark JPEG decode per frame.'
+    )
+    parser.add_argument('--frames', dest='frames', default=500, type=int,
+                        help='Frames decoded per variant.')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='Also write the results to this JSON file.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    jpg = make_jpeg(320, 240)
+    results = {'old': time_per_frame(lambda: old_decode(jpg), args.frames)}
+    print('%-24s %8.3f ms/frame' % ('old (convert, copy, crop)', results['old']))
+    for scale in (1, 2, 4):
+        out = np.empty((1,) + (int(np.prod(crop_shape(scale=scale))),), np.float32)
+        name = 'decode_frame scale=%d' % scale
+        results[name] = time_per_frame(lambda: decode_frame(jpg, out, scale=scale), args.frames)
+        print('%-24s %8.3f ms/frame (%.1fx)' % (name, results[name], results['old'] / results[name]))
+
+    # The Y channel libjpeg decodes to uses the same luma weights as
+    # convert('L'); only rounding and clipping of the RGB round trip differ.
+    difference = np.abs(old_decode(jpg) - decode_frame(jpg, np.empty((1, 38400), np.float32)))
+    pixel_difference = {'mean': float(difference.mean()), 'max': float(difference.max())}
+    print('pixel difference at scale=1: mean %.3f max %.0f' % (difference.mean(), difference.max()))
+
+    if args.json_file:
+        with open(args.json_file, 'w') as output:
+            json.dump({'benchmark': 'decode', 'time': time.time(),
+                       'ms_per_frame': results, 'pixel_difference': pixel_difference},
+                      output, indent=4)
+
+
+if __name__ == '__main__':
+    main()
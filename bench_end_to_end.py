@@ -0,0 +1,216 @@
+# Name:         bench_end_to_end.py
+# Description:  Runs auto-driver's drive loop against a fake camera and a fake
+#               pi_pcm on this machine and reports throughput, frame capture
+#               to command latency and time spent in each stage.
+# Instructions: python bench_end_to_end.py [--model models/model.npz] [--fps 30]
+#                   [--frames 300] [--json results.json]
+# Notes:        Without --model a randomly initialised network of the shape
+#               built in 'train.py' is used, which costs the same to run. All
+#               parts run in this process so their clocks agree.
+#               capture_to_command runs from a frame being sent by the camera
+#               to fake pi_pcm receiving the command decided from it, for the
+#               frames whose command was actually sent; capture_to_sink runs
+#               to the pipeline finishing with every frame, sent or not.
+
+import argparse
+import json
+import os
+import socket
+import tempfile
+import time
+
+import numpy as np
+
+from camera import open_source
+from common import load_configuration, server_up
+from control_scheduler import ControlScheduler
+from dispatcher import CommandDispatcher
+from drive_loop import INPUT_DIM, drive_pipeline, load_predictor
+from fake_camera import FakeCamera
+from fake_pcm import FakePCM
+from frame_receiver import FrameReceiver
+from preprocess import for_model
+
+
+def random_model(filename, hidden=64, classes=4):
+    """Writes an untrained Dense(64)-PReLU-Dense(64)-PReLU-Dense(4)-softmax."""
+    rng = np.random.RandomState(0)
+    np.savez(
+        filename,
+        layers=np.array(['dense', 'prelu', 'dense', 'prelu', 'dense', 'softmax']),
+        W_0=rng.uniform(-0.01, 0.01, (INPUT_DIM, hidden)), b_0=np.zeros(hidden),
+        alpha_1=np.zeros(hidden),
+        W_2=rng.uniform(-0.2, 0.2, (hidden, hidden)), b_2=np.zeros(hidden),
+        alpha_3=np.zeros(hidden),
+        W_4=rng.uniform(-0.2, 0.2, (hidden, classes)), b_4=np.zeros(classes),
+    )
+
+
+class SendLog(object):
+    """Stands in for a session recorder to note which frame each command
+    the dispatcher sent was decided from."""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        # (index of the UDP packet among the channel's sends, seq, command)
+        self.sends = []
+
+    def record_command(self, seq, command, sent=True, at=None):
+        if sent:
+            self.sends.append((self.dispatcher.sent - 1, seq, command))
+
+
+def command_latencies(sends, log, sent_at):
+    """Returns the capture to command received latencies of sends, matched
+    to the fake pi_pcm's log by packet order, and how many did not match."""
+    latencies = []
+    unmatched = 0
+    for index, seq, command in sends:
+        # UDP over loopback arrives in order and nothing else uses the channel
+        if index < len(log) and log[index][1] == command:
+            latencies.append(log[index][0] - sent_at[seq])
+        else:
+            unmatched += 1
+    return latencies, unmatched
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000.0
+    if not len(values):
+        return {}
+    return {
+        'p50_ms': float(np.percentile(values, 50)),
+        'p90_ms': float(np.percentile(values, 90)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'max_ms': float(values.max()),
+        'mean_ms': float(values.mean()),
+    }
+
+
+def run(args):
+    with open(args.control_file) as configuration_file:
+        configuration = load_configuration(configuration_file)
+
+    model_file = args.model
+    if model_file is None:
+        model_file = os.path.join(tempfile.mkdtemp(), 'random_model.npz')
+        random_model(model_file)
+
+    pcm = FakePCM('127.0.0.1', args.pcm_port, configuration)
+    pcm.start()
+    frequency = json.loads(configuration['idle'])[0]['frequency']
+    if not server_up('127.0.0.1', args.pcm_port, frequency):
+        pcm.stop()
+        raise RuntimeError('Fake pi_pcm did not answer the server_up probe')
+
+    server_socket = socket.socket()
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+
+    # Frames are reduced as the model was trained, like auto-driver.py does
+    spec = for_model(model_file)
+    model = load_predictor(model_file, spec.size)
+    dispatcher = CommandDispatcher('127.0.0.1', args.pcm_port, configuration,
+                                   resend_interval=args.resend_interval)
+    camera = FakeCamera(server_socket.getsockname(),
+                        open_source(args.source, framerate=args.fps), args.frames)
+    camera.start()
+    connection = server_socket.accept()[0]
+    receiver = FrameReceiver(connection)
+    send_log = SendLog(dispatcher)
+    scheduler = None
+    if args.tick_rate:
+        scheduler = ControlScheduler(dispatcher, args.tick_rate, recorder=send_log)
+        scheduler.start()
+    pipeline = drive_pipeline(receiver, model, dispatcher, verbose=False, scheduler=scheduler,
+                              preprocess=spec, recorder=send_log)
+    try:
+        pipeline.run()
+    finally:
+        if scheduler is not None:
+            scheduler.stop()
+        pipeline.stop()
+        connection.close()
+        server_socket.close()
+        camera.join()
+        time.sleep(0.2)   # let the last commands reach the fake pi_pcm
+        pcm.stop()
+        dispatcher.close()
+
+    # Completed frames are matched to the camera by sequence number
+    sink_latencies = [finished - camera.sent[seq] for seq, _, finished in pipeline.completed]
+    latencies, unmatched = command_latencies(send_log.sends, pcm.log, camera.sent)
+    first, last = camera.sent[0], camera.sent[-1]
+    seconds = max(last - first, 1e-9)
+    stats = pipeline.stats()
+    stages = dict(
+        (name, {
+            'items': stage['items'],
+            'mean_ms': 1000.0 * stage['busy_seconds'] / stage['items'] if stage['items'] else 0.0,
+        })
+        for name, stage in stats['stages'].items())
+    results = {
+        'benchmark': 'end_to_end',
+        'time': time.time(),
+        'model': args.model or 'random',
+        'preprocess': spec.to_dict(),
+        'target_fps': args.fps,
+        'frames_sent': len(camera.sent),
+        'frames_received': receiver.frames,
+        'frames_acted_on': len(pipeline.completed),
+        'frames_dropped': stats['dropped'],
+        'sent_fps': (len(camera.sent) - 1) / seconds,
+        'acted_fps': len(pipeline.completed) / seconds,
+        'capture_to_command': percentiles(latencies),
+        'capture_to_sink': percentiles(sink_latencies),
+        'stages': stages,
+        'queues': stats['queues'],
+        'commands_sent': dispatcher.sent,
+        'commands_suppressed': dispatcher.suppressed,
+        'commands_received': len(pcm.log),
+        'commands_timed': len(latencies),
+        'commands_unmatched': unmatched,
+    }
+    if scheduler is not None:
+        # capture_to_sink then runs to the prediction reaching the scheduler
+        results['scheduler'] = scheduler.stats()
+    return results
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='End-to-end latency benchmark with a fake camera and pi_pcm.'
+    )
+    parser.add_argument('--model', dest='model', default=None,
+                        help='.npz or .h5 model, defaults to random weights.')
+    parser.add_argument('--control', dest='control_file', default='lambo.json',
+                        help='JSON control file for the RC car.')
+    parser.add_argument('--source', dest='source', default='synthetic',
+                        help="'synthetic' or a JPEG directory/stream file.")
+    parser.add_argument('--fps', dest='fps', default=30, type=int,
+                        help='Frames per second the fake camera sends.')
+    parser.add_argument('--frames', dest='frames', default=300, type=int,
+                        help='Frames to send.')
+    parser.add_argument('--pcm-port', dest='pcm_port', default=12345, type=int,
+                        help='Port for the fake pi_pcm (port + 1 must be free too).')
+    parser.add_argument('--resend-interval', dest='resend_interval', default=0.25, type=float,
+                        help='Dispatcher resend interval for unchanged commands.')
+    parser.add_argument('--tick-rate', dest='tick_rate', default=0, type=float,
+                        help='Send commands from a ControlScheduler at this rate.')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='Also write the results to this JSON file.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    results = run(args)
+    print(json.dumps(results, indent=4, sort_keys=True))
+    if args.json_file:
+        with open(args.json_file, 'w') as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
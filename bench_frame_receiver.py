@@ -0,0 +1,131 @@
+# Name:         bench_frame_receiver.py
+# Description:  Compares the old JPEG marker scanner used by the servers with
+#               the length-prefixed FrameReceiver in 'frame_receiver.py'.
+# Instructions: python bench_frame_receiver.py [--frames N] [--json results.json]
+# Notes:        Both readers consume the same in-memory stream laid out exactly
+#               like 'stream_image_client.py' writes it, so only the parsing
+#               cost is measured, not the network. The old scanner is
+#               quadratic in the frame size (~0.6 s per 1080p frame), so the
+#               defaults are kept small; a plain run takes under a minute.
+
+import argparse
+import io
+import json
+import struct
+import time
+
+import numpy as np
+from PIL import Image
+
+from frame_receiver import FrameReceiver, clock
+
+RESOLUTIONS = [(320, 240), (640, 480), (1280, 720), (1920, 1080)]
+
+
+def make_jpeg(width, height, seed=0):
+    """Returns a noisy gradient JPEG so compressed sizes look like camera output."""
+    rng = np.random.RandomState(seed)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :, np.newaxis]
+    pixels = gradient + rng.normal(0, 25, (height, width, 3))
+    pixels = np.clip(pixels, 0, 255).astype(np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels, 'RGB').save(output, 'jpeg', quality=85)
+    return output.getvalue()
+
+
+def make_stream(jpeg, frames):
+    """Lays out frames the same way 'stream_image_client.py' writes them."""
+    stream = io.BytesIO()
+    for _ in range(frames):
+        stream.write(struct.pack('<L', len(jpeg)))
+        stream.write(jpeg)
+    stream.write(struct.pack('<L', 0))
+    return stream.getvalue()
+
+
+def scan_markers(connection):
+    """The old server loop: append 1 KB reads and search for FF D8 / FF D9."""
+    frames = 0
+    stream_bytes = b' '
+    while True:
+        chunk = connection.read(1024)
+        if not chunk:
+            return frames
+        stream_bytes += chunk
+        first = stream_bytes.find(b'\xff\xd8')
+        last = stream_bytes.find(b'\xff\xd9')
+        if first != -1 and last != -1:
+            jpg = stream_bytes[first:last + 2]
+            stream_bytes = stream_bytes[last + 2:]
+            frames += 1
+
+
+def receive_frames(connection):
+    """The new server loop."""
+    receiver = FrameReceiver(connection)
+    for _ in receiver:
+        pass
+    return receiver.frames
+
+
+def best_of(function, data, repeats):
+    """Returns (frames, best seconds) over repeats runs."""
+    best = None
+    frames = 0
+    for _ in range(repeats):
+        connection = io.BytesIO(data)
+        start = clock()
+        frames = function(connection)
+        elapsed = clock() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return frames, best
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark JPEG stream framing.'
+    )
+    parser.add_argument('--frames', dest='frames', default=30, type=int,
+                        help='Frames per stream.')
+    parser.add_argument('--repeats', dest='repeats', default=2, type=int,
+                        help='Runs per reader, best time is kept.')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='Also write the results to this JSON file.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    results = []
+    print('%-10s %8s %12s %12s %8s' % ('size', 'jpeg KB', 'scan ms/f', 'recv ms/f', 'speedup'))
+    for width, height in RESOLUTIONS:
+        jpeg = make_jpeg(width, height)
+        data = make_stream(jpeg, args.frames)
+        # The marker scanner can stop on FF D9 bytes inside the entropy coded
+        # data, so its frame count is reported rather than assumed.
+        scanned, scan_seconds = best_of(scan_markers, data, args.repeats)
+        received, receive_seconds = best_of(receive_frames, data, args.repeats)
+        result = {
+            'width': width,
+            'height': height,
+            'jpeg_bytes': len(jpeg),
+            'frames': args.frames,
+            'scan_frames': scanned,
+            'scan_ms_per_frame': 1000.0 * scan_seconds / args.frames,
+            'receive_frames': received,
+            'receive_ms_per_frame': 1000.0 * receive_seconds / args.frames,
+            'speedup': scan_seconds / receive_seconds if receive_seconds else float('inf'),
+        }
+        results.append(result)
+        print('%-10s %8.1f %12.3f %12.3f %7.1fx' % (
+            '%dx%d' % (width, height), len(jpeg) / 1024.0,
+            result['scan_ms_per_frame'], result['receive_ms_per_frame'], result['speedup']))
+
+    if args.json_file:
+        with open(args.json_file, 'w') as output:
+            json.dump({'benchmark': 'frame_receiver', 'time': time.time(), 'results': results},
+                      output, indent=4)
+
+
+if __name__ == '__main__':
+    main()
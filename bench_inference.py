@@ -0,0 +1,92 @@
+# Name:         bench_inference.py
+# Description:  Per-frame latency and startup time of the NumPy engine in
+#               'mlp.py', and of Keras when a .h5 model is given.
+# Instructions: python bench_inference.py models/model.npz [--keras models/model.h5]
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from frame_receiver import clock
+from mlp import NumpyModel
+
+
+def import_seconds(statement, repeats=3):
+    """Best wall time of a fresh interpreter running statement."""
+    best = None
+    for _ in range(repeats):
+        start = clock()
+        subprocess.check_call([sys.executable, '-c', statement])
+        elapsed = clock() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def latency_ms(predict, batch, frames):
+    """Milliseconds per frame predicting frames rows, batch rows per call."""
+    calls = max(1, frames // len(batch))
+    predict(batch)  # warm up
+    start = clock()
+    for _ in range(calls):
+        predict(batch)
+    return 1000.0 * (clock() - start) / (calls * len(batch))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark MLP inference latency.'
+    )
+    parser.add_argument(dest='numpy_model', help='Exported .npz model.')
+    parser.add_argument('--keras', dest='keras_model', default=None,
+                        help='Keras .h5 model to compare against.')
+    parser.add_argument('--frames', dest='frames', default=2000, type=int,
+                        help='Frames predicted per measurement.')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='Also write the results to this JSON file.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    results = {}
+
+    start = clock()
+    model = NumpyModel(args.numpy_model, max_batch=64)
+    results['numpy_load_seconds'] = clock() - start
+    sample = np.random.RandomState(0).rand(64, model.input_dim).astype(np.float32)
+    for rows in (1, 8, 64):
+        results['numpy_ms_per_frame_batch_%d' % rows] = latency_ms(
+            model.predict_classes, sample[:rows], args.frames)
+    results['numpy_import_seconds'] = import_seconds('import mlp')
+
+    if args.keras_model:
+        results['keras_import_seconds'] = import_seconds('import keras.models')
+        from keras.models import load_model
+        start = clock()
+        keras_model = load_model(args.keras_model)
+        results['keras_load_seconds'] = clock() - start
+        predict = lambda batch: keras_model.predict_classes(batch, verbose=0)
+        for rows in (1, 8, 64):
+            results['keras_ms_per_frame_batch_%d' % rows] = latency_ms(
+                predict, sample[:rows], args.frames)
+        results['max_probability_difference'] = float(np.abs(
+            keras_model.predict(sample, verbose=0) - model.predict(sample)).max())
+        results['startup_seconds_saved'] = (
+            results['keras_import_seconds'] + results['keras_load_seconds'] -
+            results['numpy_import_seconds'] - results['numpy_load_seconds'])
+
+    for name in sorted(results):
+        print('%-36s %10.4f' % (name, results[name]))
+
+    if args.json_file:
+        with open(args.json_file, 'w') as output:
+            json.dump({'benchmark': 'inference', 'time': time.time(), 'results': results},
+                      output, indent=4)
+
+
+if __name__ == '__main__':
+    main()
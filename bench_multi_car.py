@@ -0,0 +1,128 @@
+# Name:         bench_multi_car.py
+# Description:  Load generator for 'multi_server.py': simulates N cars
+#               streaming at a set frame rate and reports what one box keeps
+#               up with.
+# Instructions: python bench_multi_car.py [--cars 1 2 4 8] [--fps 10 30]
+#                   [--seconds 10] [--model models/model.npz] [--json results.json]
+# Notes:        The server, fake cameras and a fake pi_pcm all run in this
+#               process so capture to command latency can be measured. A car
+#               count keeps up when every car has its frames acted on at
+#               close to the rate it sends them.
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from bench_end_to_end import percentiles, random_model
+from camera import open_source
+from common import load_configuration
+from drive_loop import load_predictor
+from fake_camera import FakeCamera
+from fake_pcm import FakePCM
+from multi_server import MultiCarServer
+from preprocess import for_model
+
+
+def run_load(model, configuration, cars, fps, seconds, source, pcm_port, window, spec=None):
+    """Streams from cars fake cameras at fps for seconds and returns the results."""
+    pcm = FakePCM('127.0.0.1', pcm_port, configuration)
+    pcm.start()
+    server = MultiCarServer(model, configuration, '127.0.0.1', 0, '127.0.0.1', pcm_port,
+                            window, max_batch=max(cars, 1), preprocess=spec)
+    server.start()
+    frames = int(fps * seconds)
+    cameras = [FakeCamera(server.address, open_source(source, framerate=fps), frames)
+               for _ in range(cars)]
+    for camera in cameras:
+        camera.start()
+    for camera in cameras:
+        camera.join()
+    time.sleep(0.5)   # let the last frames through the batcher
+    stats = server.stats()
+    server.stop()
+    pcm.stop()
+
+    # Cars are numbered in the order they connected, which is not necessarily
+    # the order the cameras started; match them by the client's port.
+    by_port = dict((car.address[1], car) for car in server.cars)
+    latencies = []
+    acted_fps = []
+    for camera in cameras:
+        car = by_port.get(camera.port)
+        if car is None or len(camera.sent) < 2:
+            continue
+        latencies.extend(acted - camera.sent[seq] for seq, _, acted in car.completed)
+        acted_fps.append(len(car.completed) / (camera.sent[-1] - camera.sent[0]))
+    return {
+        'cars': cars,
+        'target_fps': fps,
+        'frames_sent': sum(len(camera.sent) for camera in cameras),
+        'frames_acted_on': sum(car['predicted'] for car in stats['cars']),
+        'frames_dropped': sum(car['dropped'] for car in stats['cars']),
+        'acted_fps_min': min(acted_fps) if acted_fps else 0.0,
+        'acted_fps_mean': sum(acted_fps) / len(acted_fps) if acted_fps else 0.0,
+        'capture_to_command': percentiles(latencies),
+        'batcher': stats['batcher'],
+        'commands_received': len(pcm.log),
+    }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Multi-car load generator for multi_server.py.')
+    parser.add_argument('--model', dest='model', default=None,
+                        help='.npz or .h5 model, defaults to random weights.')
+    parser.add_argument('--control', dest='control_file', default='lambo.json',
+                        help='JSON control file for the RC car.')
+    parser.add_argument('--source', dest='source', default='synthetic',
+                        help="'synthetic' or a JPEG directory/stream file.")
+    parser.add_argument('--cars', dest='cars', default=[1, 2, 4, 8], type=int, nargs='+',
+                        help='Numbers of simultaneous cars to try.')
+    parser.add_argument('--fps', dest='fps', default=[10, 30], type=int, nargs='+',
+                        help='Frame rates per car to try.')
+    parser.add_argument('--seconds', dest='seconds', default=10.0, type=float,
+                        help='Seconds each run streams for.')
+    parser.add_argument('--window', dest='window', default=0.005, type=float,
+                        help='Batching window of the server.')
+    parser.add_argument('--pcm-port', dest='pcm_port', default=12345, type=int,
+                        help='Port for the fake pi_pcm.')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='Also write the results to this JSON file.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    with open(args.control_file) as configuration_file:
+        configuration = load_configuration(configuration_file)
+    model_file = args.model
+    if model_file is None:
+        model_file = os.path.join(tempfile.mkdtemp(), 'random_model.npz')
+        random_model(model_file)
+    # Frames are reduced as the model was trained, like the server does
+    spec = for_model(model_file)
+    model = load_predictor(model_file, spec.size)
+
+    results = []
+    print('%5s %5s %10s %10s %8s %10s %10s' % (
+        'cars', 'fps', 'acted min', 'acted mean', 'dropped', 'p50 ms', 'p99 ms'))
+    for fps in args.fps:
+        for cars in args.cars:
+            result = run_load(model, configuration, cars, fps, args.seconds, args.source,
+                              args.pcm_port, args.window, spec)
+            result['model'] = args.model or 'random'
+            result['preprocess'] = spec.to_dict()
+            results.append(result)
+            latency = result['capture_to_command']
+            print('%5d %5d %10.1f %10.1f %8d %10.1f %10.1f' % (
+                cars, fps, result['acted_fps_min'], result['acted_fps_mean'],
+                result['frames_dropped'], latency.get('p50_ms', 0.0), latency.get('p99_ms', 0.0)))
+    if args.json_file:
+        with open(args.json_file, 'w') as output:
+            json.dump({'benchmark': 'multi_car', 'time': time.time(), 'runs': results},
+                      output, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Name:         bench_wire_format.py
+# Description:  Measures bytes on the wire and server CPU per frame for each
+#               wire format in 'wire_format.py'.
+# Instructions: python bench_wire_format.py [--source synthetic] [--frames 200]
+#                   [--fps 10 30] [--json results.json]
+# Notes:        Server CPU is the time to turn a payload into the model's
+#               float32 input row. Client CPU is only the encoding step: the
+#               camera produces the JPEG itself and on the Pi the grayscale
+#               region comes straight out of an unencoded YUV capture, so
+#               neither costs anything extra there.
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from camera import gray_frames, open_source
+from decode import crop_shape
+from drive_loop import INPUT_DIM
+from frame_receiver import clock
+from wire_format import FORMATS, decoder, encoder
+
+
+def collect(source_name, frames):
+    """Returns frames JPEGs from the source and their grayscale regions."""
+    source = open_source(source_name, framerate=0)
+    jpegs = []
+    for jpeg in source:
+        jpegs.append(bytes(jpeg))
+        if len(jpegs) >= frames:
+            break
+    source.close()
+    grays = [np.array(gray) for gray in gray_frames(iter(jpegs))]
+    return jpegs, grays
+
+
+def measure(name, jpegs, grays, repeats):
+    frames = jpegs if name == 'jpeg' else grays
+    encode = encoder(name)
+    decode = decoder(name)
+    out = np.empty((1, INPUT_DIM), np.float32)
+    best_encode = best_decode = None
+    for _ in range(repeats):
+        start = clock()
+        payloads = [encode(frame) for frame in frames]
+        encoded = clock()
+        for payload in payloads:
+            decode(payload, out)
+        decoded = clock()
+        if best_encode is None or encoded - start < best_encode:
+            best_encode = encoded - start
+        if best_decode is None or decoded - encoded < best_decode:
+            best_decode = decoded - encoded
+    size = float(sum(len(payload) for payload in payloads)) / len(payloads)
+    return {
+        'bytes_per_frame': size,
+        'client_encode_ms': 1000.0 * best_encode / len(frames) if name != 'jpeg' else 0.0,
+        'server_decode_ms': 1000.0 * best_decode / len(frames),
+    }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Bandwidth and server CPU per wire format.')
+    parser.add_argument('--source', dest='source', default='synthetic',
+                        help="'synthetic' or a JPEG directory/stream file/session.")
+    parser.add_argument('--frames', dest='frames', default=200, type=int,
+                        help='Frames to measure with.')
+    parser.add_argument('--repeats', dest='repeats', default=3, type=int,
+                        help='Best of this many runs is reported.')
+    parser.add_argument('--fps', dest='fps', default=[10, 30], type=int, nargs='+',
+                        help='Frame rates to work out the bandwidth for.')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='Also write the results to this JSON file.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    jpegs, grays = collect(args.source, args.frames)
+    print('%d frames, model region %dx%d' % ((len(jpegs),) + crop_shape()[::-1]))
+    results = {}
+    for name in FORMATS:
+        result = measure(name, jpegs, grays, args.repeats)
+        result['mbps'] = dict(
+            (str(fps), result['bytes_per_frame'] * 8 * fps / 1e6) for fps in args.fps)
+        results[name] = result
+        print('%-6s %8.0f bytes/frame  encode %6.3f ms  server %6.3f ms  %s' % (
+            name, result['bytes_per_frame'], result['client_encode_ms'],
+            result['server_decode_ms'],
+            '  '.join('%.2f Mbit/s @ %d fps' % (result['mbps'][str(fps)], fps)
+                      for fps in args.fps)))
+    if args.json_file:
+        with open(args.json_file, 'w') as output:
+            json.dump({'benchmark': 'wire_format', 'time': time.time(),
+                       'source': args.source, 'frames': len(jpegs), 'formats': results},
+                      output, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+# Name:         camera.py
+# Description:  Pluggable JPEG frame sources for 'stream_image_client.py'.
+# Notes:        Every source is an iterable of JPEG bytes produced at roughly
+#               the requested frame rate, which configure() can change while
+#               streaming (along with resolution and quality where possible). 'picamera' needs the Pi; 'synthetic'
+#               draws a moving track and a file path replays recorded frames,
+#               so the client can be run on any Linux box.
+
+"""Camera, synthetic and file-backed frame sources."""
+import glob
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from decode import crop_gray, crop_shape, decode_frame
+from frame_receiver import FrameReceiver, clock
+
+
+class Pacer(object):
+    """Sleeps just enough to hold a steady frame rate (0 or None: no limit)."""
+
+    def __init__(self, framerate):
+        self.set_framerate(framerate)
+        self.next = clock()
+
+    def set_framerate(self, framerate):
+        self.interval = 1.0 / framerate if framerate else 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        self.next += self.interval
+        delay = self.next - clock()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Running behind; don't try to catch up with a burst
+            self.next = clock()
+
+
+class Source(object):
+    """Base for sources whose settings can change while streaming."""
+
+    def __init__(self, resolution, framerate, quality):
+        self.resolution = tuple(resolution) if resolution else None
+        self.framerate = framerate
+        self.quality = quality
+        self.pacer = Pacer(framerate)
+
+    def configure(self, framerate=None, resolution=None, quality=None):
+        """Changes the settings from the next frame on; None keeps one."""
+        if framerate is not None:
+            self.framerate = framerate
+            self.pacer.set_framerate(framerate)
+        if resolution is not None:
+            self.resolution = tuple(resolution)
+        if quality is not None:
+            self.quality = quality
+
+    def close(self):
+        pass
+
+
+class PiCameraSource(Source):
+    """JPEGs from the Pi camera's video port."""
+
+    def __init__(self, resolution=(320, 240), framerate=10, quality=85, warmup=3):
+        import picamera
+        Source.__init__(self, resolution, framerate, quality)
+        self.camera = picamera.PiCamera()
+        self.camera.resolution = resolution
+        self.camera.framerate = framerate
+        self.changed = False
+        time.sleep(warmup)              # Give camera time to warm up.
+
+    def configure(self, framerate=None, resolution=None, quality=None):
+        Source.configure(self, framerate, resolution, quality)
+        self.changed = True
+
+    def _captures(self, format):
+        stream = io.BytesIO()
+        while True:
+            self.changed = False
+            # The camera paces itself; the quality is fixed per capture run
+            options = {'quality': self.quality} if format == 'jpeg' else {}
+            for _ in self.camera.capture_continuous(stream, format, use_video_port=True,
+                                                    **options):
+                yield stream.getvalue()
+                stream.seek(0)
+                stream.truncate()
+                if self.changed:
+                    break
+            # Resolution and frame rate can only change between captures
+            self.camera.resolution = self.resolution
+            self.camera.framerate = self.framerate
+
+    def __iter__(self):
+        return self._captures('jpeg')
+
+    def gray_frames(self):
+        """The crop of the luma plane of unencoded YUV captures; no JPEG at all."""
+        out = np.empty(crop_shape(), np.uint8)
+        for data in self._captures('yuv'):
+            width, height = self.camera.resolution
+            # The planes are padded to multiples of 32 columns and 16 rows
+            padded_width = (width + 31) // 32 * 32
+            padded_height = (height + 15) // 16 * 16
+            luma = np.frombuffer(data, np.uint8, padded_width * padded_height)
+            yield crop_gray(luma.reshape(padded_height, padded_width)[:height, :width], out)
+
+    def close(self):
+        self.camera.close()
+
+
+class SyntheticSource(Source):
+    """A pre-rendered loop of a two-line track drifting left and right."""
+
+    def __init__(self, resolution=(320, 240), framerate=10, frames=60, quality=85):
+        Source.__init__(self, resolution, framerate, quality)
+        width, height = resolution
+        self.images = []
+        # (resolution, quality) -> JPEGs, encoded as they are first needed
+        self.jpegs = {}
+        columns = np.arange(width)
+        rng = np.random.RandomState(0)
+        for index in range(frames):
+            centre = width / 2.0 + width / 4.0 * np.sin(2 * np.pi * index / frames)
+            image = np.full((height, width), 200, np.float32)
+            for edge in (centre - width / 5.0, centre + width / 5.0):
+                image[:, np.abs(columns - edge) < 4] = 40
+            image += rng.normal(0, 8, image.shape)
+            self.images.append(Image.fromarray(np.clip(image, 0, 255).astype(np.uint8), 'L'))
+        for index in range(frames):
+            self._jpeg(index)
+
+    def _jpeg(self, index):
+        key = (self.resolution, self.quality)
+        jpegs = self.jpegs.setdefault(key, [None] * len(self.images))
+        if jpegs[index] is None:
+            image = self.images[index]
+            if image.size != self.resolution:
+                image = image.resize(self.resolution, Image.BILINEAR)
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'jpeg', quality=self.quality)
+            jpegs[index] = output.getvalue()
+        return jpegs[index]
+
+    def __iter__(self):
+        while True:
+            for index in range(len(self.images)):
+                yield self._jpeg(index)
+                self.pacer.wait()
+
+
+class FileSource(Source):
+    """Replays a directory of .jpg files or a length-prefixed stream file.
+
+    Only the frame rate can be changed; frames are sent as they were stored.
+    """
+
+    def __init__(self, path, framerate=10, loop=True):
+        Source.__init__(self, None, framerate, None)
+        self.path = path
+        self.loop = loop
+
+    def _frames(self):
+        if os.path.isdir(self.path):
+            for filename in sorted(glob.glob(os.path.join(self.path, '*.jp*g'))):
+                with open(filename, 'rb') as jpeg_file:
+                    yield jpeg_file.read()
+        else:
+            with open(self.path, 'rb') as stream_file:
+                for frame in FrameReceiver(stream_file):
+                    yield frame.tobytes()
+
+    def __iter__(self):
+        while True:
+            count = 0
+            for jpeg in self._frames():
+                count += 1
+                yield jpeg
+                self.pacer.wait()
+            if not self.loop or not count:
+                return
+
+
+def gray_frames(source):
+    """Yields the model's grayscale region (decode.CROP_BOX) of every frame.
+
+    Sources that can produce it without a JPEG (the Pi camera) do so, the
+    others are decoded. The same buffer is reused for every frame.
+    """
+    native = getattr(source, 'gray_frames', None)
+    if native is not None:
+        return native()
+    out = np.empty(crop_shape(), np.uint8)
+    return (decode_frame(jpeg, out) for jpeg in source)
+
+
+def open_source(name, resolution=(320, 240), framerate=10, speed=1.0):
+    """Returns the source called name: 'picamera', 'synthetic' or a path.
+
+    A path may be a session recorded by 'session_log.py', replayed at speed
+    times its original pace, a directory of JPEGs or a stream file.
+    """
+    if name == 'picamera':
+        return PiCameraSource(resolution, framerate)
+    if name == 'synthetic':
+        return SyntheticSource(resolution, framerate)
+    from session_log import ReplaySource, is_session
+    if is_session(name):
+        return ReplaySource(name, speed)
+    return FileSource(name, framerate)
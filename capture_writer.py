@@ -0,0 +1,234 @@
+# Name:         capture_writer.py
+# Description:  Writes the frames captured by 'self_control_train.py' and
+#               'test_control.py' straight into a dataset (see dataset.py)
+#               from a background thread while capture goes on.
+# Notes:        append() copies a frame into a preallocated chunk and never
+#               touches the disk. A full chunk, or one whose first frame is
+#               flush_interval seconds old, is handed to the writer thread,
+#               which appends it to the session's current shard, fsyncs it
+#               and only then records the shard's new frame count in the
+#               dataset's manifest, which is the index. A crash keeps every
+#               chunk written before it, and a half written one is never
+#               listed. A shard is closed and the next one started once it
+#               holds max_bytes of frames or is max_seconds old. Shards are
+#               named after the session (start time and process id) and
+#               their part number, so sessions never overwrite each other.
+#               If the disk falls behind, up to max_queued bytes of chunks
+#               wait in memory; past that, whole chunks are dropped rather
+#               than hold up capture or exhaust memory. Dropped frames are
+#               counted in stats() and in the manifest, against the shard
+#               listed next after they were dropped. One capture at a time
+#               per dataset: the manifest is rewritten without locking.
+
+"""Background, chunked, crash-safe writer of captured frames."""
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+import dataset
+import preprocess
+from frame_receiver import clock
+
+CHUNK_FRAMES = 256              # ~10 MB per chunk at 38400 bytes per frame
+FLUSH_INTERVAL = 5.0            # most seconds a frame waits in memory
+MAX_BYTES = 256 * 1024 ** 2     # frames per shard before starting the next
+MAX_SECONDS = 600.0             # age of a shard before starting the next
+MAX_QUEUED = 1024 ** 3          # never hold more than 1 GB of frames waiting for the disk
+
+
+def session_name():
+    """Returns a name unique to this capture session."""
+    return 'capture-%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+
+
+class CaptureWriter(object):
+    """Appends labelled frames to a dataset as they are captured."""
+
+    def __init__(self, directory=dataset.DATASET_DIR, spec=None, duplicates=None,
+                 chunk_frames=CHUNK_FRAMES, flush_interval=FLUSH_INTERVAL, max_bytes=MAX_BYTES,
+                 max_seconds=MAX_SECONDS, session=None, max_queued=MAX_QUEUED):
+        self.directory = directory
+        self.spec = spec or preprocess.Preprocess()
+        self.duplicates = duplicates
+        self.chunk_frames = chunk_frames
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.session = session or session_name()
+        # Refuse up front, not at the first chunk, to mix specs in a dataset
+        if os.path.exists(os.path.join(directory, dataset.MANIFEST)):
+            existing = preprocess.from_dict(dataset.read_manifest(directory).get('preprocess'))
+            if existing != self.spec:
+                raise ValueError('%s holds %r frames, not %r' % (directory, existing, self.spec))
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.count = 0
+        self.written = 0
+        self.lost = 0
+        self.dropped = 0
+        self.error = None
+        self.write_seconds = 0.0
+        self.max_pending = 0
+        # Manifest entries of this session's shards
+        self.parts = []
+        self._part = None
+        # Frames dropped before the current shard's count starts
+        self._dropped_before = 0
+        self._files = None
+        self._queue = queue.Queue(max(1, max_queued // (chunk_frames * self.spec.size)))
+        # Chunks already written, reused so their memory is not faulted in again
+        self._free = queue.Queue()
+        # Guards the current chunk, which the writer thread flushes when idle
+        self._lock = threading.Lock()
+        self._new_chunk()
+        self._thread = threading.Thread(target=self._run, name='capture_writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return self.count
+
+    def _new_chunk(self):
+        try:
+            self._frames, self._labels = self._free.get_nowait()
+        except queue.Empty:
+            self._frames = np.empty((self.chunk_frames, self.spec.size), np.uint8)
+            self._labels = np.empty(self.chunk_frames, np.int8)
+        self._rows = 0
+        self._chunk_started = None
+
+    def append(self, frame, label):
+        """Copies one frame and its class index in; returns False if the
+        frame is a near duplicate of one just stored."""
+        if self.duplicates is not None and not self.duplicates.admit(frame, label):
+            return False
+        with self._lock:
+            if self._chunk_started is None:
+                self._chunk_started = clock()
+            self._frames[self._rows] = np.ravel(frame)
+            self._labels[self._rows] = label
+            self._rows += 1
+            self.count += 1
+            if self._rows == self.chunk_frames:
+                self._submit()
+        return True
+
+    def _submit(self):
+        if self._rows:
+            try:
+                self._queue.put_nowait((self._frames, self._labels, self._rows))
+            except queue.Full:
+                # The disk is too far behind; the chunk is reused for the next frames
+                self.dropped += self._rows
+                self._rows = 0
+                self._chunk_started = None
+                return
+            self.max_pending = max(self.max_pending, self._queue.qsize())
+            self._new_chunk()
+
+    def flush(self, older_than=None):
+        """Hands the frames appended so far to the writer thread, or only
+        if the first of them is older_than seconds old."""
+        with self._lock:
+            if older_than is None or (self._chunk_started is not None and
+                                      clock() - self._chunk_started >= older_than):
+                self._submit()
+
+    def _run(self):
+        while True:
+            try:
+                chunk = self._queue.get(timeout=self.flush_interval / 2.0)
+            except queue.Empty:
+                self.flush(self.flush_interval)
+                continue
+            if chunk is None:
+                if (self.error is None and self._part is not None and
+                        self._part['dropped'] != self.dropped - self._dropped_before):
+                    try:
+                        self._list_part()
+                    except (IOError, OSError) as error:
+                        self.error = error
+                return
+            if self.error is None:
+                try:
+                    self._write(*chunk)
+                except (IOError, OSError) as error:
+                    self.error = error
+                    print('Capture writer stopped, frames are no longer saved: %r' % (error,))
+            if self.error is not None:
+                # Keep draining so memory does not grow behind a broken disk
+                self.lost += chunk[2]
+            self._free.put(chunk[:2])
+
+    def _open_part(self):
+        self._close_part()
+        if self._part is not None:
+            # Frames dropped since the last shard was listed count against this one
+            self._dropped_before += self._part['dropped']
+        name = '%s-%03d' % (self.session, len(self.parts))
+        path = os.path.join(self.directory, name)
+        self._part = {'name': name, 'frames': 0, 'dropped': 0, 'source': self.session}
+        self._files = (open(path + '.frames', 'wb'), open(path + '.labels', 'wb'))
+        self._part_started = clock()
+        self.parts.append(self._part)
+
+    def _close_part(self):
+        if self._files is not None:
+            for part_file in self._files:
+                part_file.close()
+            self._files = None
+
+    def _write(self, frames, labels, rows):
+        start = clock()
+        if (self._part is None or self._part['frames'] * self.spec.size >= self.max_bytes
+                or start - self._part_started >= self.max_seconds):
+            self._open_part()
+        for part_file, values in zip(self._files, (frames[:rows], labels[:rows])):
+            part_file.write(values.data)
+            part_file.flush()
+            os.fsync(part_file.fileno())
+        # Listed only once it is safely on disk
+        self._part['frames'] += rows
+        self._list_part()
+        self.written += rows
+        self.write_seconds += clock() - start
+
+    def _list_part(self):
+        """Lists the current shard, and the frames dropped since the last one
+        was listed, in the manifest."""
+        self._part['dropped'] = self.dropped - self._dropped_before
+        dataset.add_shards(self.directory, [dict(self._part)], self.spec)
+
+    def close(self):
+        """Writes whatever is left and waits for the writer thread."""
+        if not self._thread.is_alive():
+            return
+        with self._lock:
+            last = (self._frames, self._labels, self._rows)
+            self._rows = 0
+        if last[2]:
+            # Waits for room rather than drop the last frames
+            self._queue.put(last)
+        self._queue.put(None)
+        self._thread.join()
+        self._close_part()
+
+    def stats(self):
+        return {
+            'session': self.session,
+            'frames': self.count,
+            'written': self.written,
+            'lost': self.lost,
+            'dropped': self.dropped,
+            'shards': len(self.parts),
+            'pending': self._queue.qsize(),
+            'max_pending': self.max_pending,
+            'write_seconds': self.write_seconds,
+        }
@@ -0,0 +1,128 @@
+# Name:         checkpoints.py
+# Description:  Per-epoch training checkpoints for 'train.py', and the record
+#               of which data each saved model has been trained on.
+# Notes:        A checkpoint directory holds 'checkpoint.h5', the model after
+#               the last finished epoch (optimizer state included), and
+#               'state.json' with that epoch and the settings needed to pick
+#               the same training data again. Both are replaced atomically,
+#               so a crash mid-save leaves the previous checkpoint intact.
+#               Next to every saved model, 'model.h5' say, 'model.json' lists
+#               the dataset shards it has seen, which is what fine-tuning uses
+#               to tell new captures from old ones, and the preprocessing spec
+#               its inputs are made with, which is what the servers use.
+
+"""Training checkpoints and seen-data manifests."""
+import json
+import os
+import time
+
+import numpy as np
+
+CHECKPOINT = 'checkpoint.h5'
+STATE = 'state.json'
+CHECKPOINT_DIR = 'models/checkpoints'
+
+
+def _write_json(path, value):
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as output:
+        json.dump(value, output, indent=4, sort_keys=True)
+    os.rename(temporary, path)
+
+
+def read_state(directory=CHECKPOINT_DIR):
+    """Returns the state of the last checkpoint in directory, or None."""
+    path = os.path.join(directory, STATE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as state_file:
+        return json.load(state_file)
+
+
+def checkpoint_file(directory=CHECKPOINT_DIR):
+    return os.path.join(directory, CHECKPOINT)
+
+
+def save_checkpoint(model, directory, state):
+    """Saves model and state (which must include 'epoch') to directory."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = checkpoint_file(directory)
+    # Keep the extension, h5py and Keras look at it
+    temporary = path[:-len('.h5')] + '.tmp.h5'
+    model.save(temporary)
+    os.rename(temporary, path)
+    _write_json(os.path.join(directory, STATE), state)
+
+
+def checkpointer(directory, state):
+    """Returns a Keras callback checkpointing after every epoch.
+
+    state is saved along with the model, with 'epoch' set to the number of
+    epochs finished, which is what resuming passes as initial_epoch.
+    """
+    from keras.callbacks import Callback
+
+    class Checkpointer(Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            state['epoch'] = epoch + 1
+            state['time'] = time.time()
+            state['logs'] = dict((key, float(value)) for key, value in (logs or {}).items())
+            save_checkpoint(self.model, directory, state)
+
+    return Checkpointer()
+
+
+def manifest_file(model_file):
+    """Returns the seen-data manifest next to model_file."""
+    return os.path.splitext(model_file)[0] + '.json'
+
+
+def read_seen(model_file):
+    """Returns the seen-data manifest of model_file, or None if it has none."""
+    path = manifest_file(model_file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as seen_file:
+        return json.load(seen_file)
+
+
+def write_seen(model_file, dataset_dir, shards, frames, epochs, parent=None, files=None,
+               preprocess=None):
+    """Records that model_file has been trained on shards of dataset_dir
+    (or, without a dataset, on the .npz files) made with the
+    preprocess.Preprocess spec preprocess."""
+    seen = {
+        'model': model_file,
+        'dataset': dataset_dir,
+        'shards': sorted(shards),
+        'frames': int(frames),
+        'epochs': epochs,
+        'parent': parent,
+        'time': time.time(),
+    }
+    if files is not None:
+        seen['files'] = sorted(files)
+    if preprocess is not None:
+        seen['preprocess'] = preprocess.to_dict()
+    _write_json(manifest_file(model_file), seen)
+    return seen
+
+
+def fine_tune_indices(data, seen_shards, replay=1.0, random=np.random):
+    """Returns (indexes to train on, names of the new shards).
+
+    The indexes are every frame of the shards of data not in seen_shards,
+    plus a random sample of replay times as many frames from the seen ones
+    so the model does not forget what it learned from them.
+    """
+    seen_shards = set(seen_shards)
+    new_shards = [name for name in data.names if name not in seen_shards]
+    new = data.shard_indices(new_shards)
+    old = data.shard_indices(seen_shards)
+    count = min(len(old), int(round(replay * len(new))))
+    if count:
+        old = random.choice(old, count, replace=False)
+    else:
+        old = old[:0]
+    return np.concatenate([new, old]), new_shards
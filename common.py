@@ -7,7 +7,9 @@
 """Common functions for the Raspberry Pi radio controller."""
 import json
 import socket
-import sys
+import threading
+
+from frame_receiver import clock
 
 
 def dead_frequency(frequency):
@@ -44,31 +46,213 @@ def format_command(
     ])
 
 
-def server_up(host, port, frequency):
+def load_configuration(configuration_file):
+    """Generates a dict of JSON command messages for each movement."""
+    configuration = json.loads(configuration_file.read())
+    dead = dead_frequency(configuration['frequency'])
+    sync_command = {
+        'frequency': configuration['frequency'],
+        'dead_frequency': dead,
+        'burst_us': configuration['synchronization_burst_us'],
+        'spacing_us': configuration['synchronization_spacing_us'],
+        'repeats': configuration['total_synchronizations'],
+    }
+    base_command = {
+        'frequency': configuration['frequency'],
+        'dead_frequency': dead,
+        'burst_us': configuration['signal_burst_us'],
+        'spacing_us': configuration['signal_spacing_us'],
+    }
+    movement_to_command = {}
+    for key in (
+        'forward',
+        'forward_left',
+        'forward_right',
+        'left',
+        'reverse',
+        'reverse_left',
+        'reverse_right',
+        'right',
+    ):
+        command_dict = base_command.copy()
+        command_dict['repeats'] = configuration[key]
+        movement_to_command[key] = command_dict
+
+    direct_commands = {
+        key: json.dumps([sync_command, movement_to_command[key]])
+        for key in movement_to_command
+    }
+
+    # We also need to add an idle command; just broadcast at the dead frequency
+    command_dict = [base_command.copy()]
+    command_dict[0]['frequency'] = dead
+    command_dict[0]['repeats'] = 20  # Doesn't matter
+    direct_commands['idle'] = json.dumps(command_dict)
+
+    return direct_commands
+
+
+def encode(payload):
+    """Returns payload as bytes for sendto on Python 2 and 3."""
+    if isinstance(payload, bytes):
+        return payload
+    return payload.encode('utf-8')
+
+
+def server_up(host, port, frequency, send_socket=None):
     """Checks that the server is up and listening to commands."""
-    # Send a test command to make sure that the server is listening
+    # Send a test command to make sure that the server is listening. The
+    # response comes back to port + 1; both sockets are closed afterwards so
+    # this can be called again, and send_socket (e.g. a CommandChannel's) is
+    # used instead of a new one if given.
     listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     listen_socket.bind(('', port + 1))
     listen_socket.settimeout(1.0)
-    send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    command = json.dumps([{
+    own_socket = send_socket is None
+    if own_socket:
+        send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    command = encode(json.dumps([{
         'frequency': dead_frequency(frequency),
         'dead_frequency': dead_frequency(frequency),
         'burst_us': 100,
         'spacing_us': 100,
         'repeats': 10,
         'request_response': True,  # This forces the server to respond
-    }])
+    }]))
     response_received = False
-    for _ in range(3):
-        if sys.version_info.major == 3 and isinstance(command, str):
-            command = bytes(command, 'utf-8')
-        send_socket.sendto(command, (host, port))
-        try:
-            listen_socket.recv(1024)
-            response_received = True
-            break
-        except socket.timeout:
-            pass
-
-    return response_received
\ No newline at end of file
+    try:
+        for _ in range(3):
+            send_socket.sendto(command, (host, port))
+            try:
+                listen_socket.recv(1024)
+                response_received = True
+                break
+            except socket.timeout:
+                pass
+    finally:
+        listen_socket.close()
+        if own_socket:
+            send_socket.close()
+
+    return response_received
+
+
+class CommandChannel(object):
+    """One UDP socket to pi_pcm with every command encoded to bytes once.
+
+    send() coalesces an unchanged command until resend_interval has passed
+    and holds back a changed one that comes within min_interval of the last
+    send; tick() sends it once that has passed, so a channel with a
+    min_interval needs start() (or its own calls to tick()). If keepalive is set the last
+    command is repeated after that many quiet seconds, and if failsafe is set
+    idle is sent once nothing has been asked for in that many seconds (the
+    driver has stalled). start() calls tick() from a background thread.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        configuration,
+        resend_interval=0.25,
+        min_interval=0.02,
+        keepalive=None,
+        failsafe=None
+    ):
+        self.address = (host, port)
+        self.payloads = dict((command, encode(payload))
+                             for command, payload in configuration.items())
+        self.resend_interval = resend_interval
+        self.min_interval = min_interval
+        self.keepalive = keepalive
+        self.failsafe = failsafe
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.lock = threading.Lock()
+        self.last_command = None
+        self.last_sent = 0.0
+        self.last_request = clock()
+        self.pending = None
+        self.sent = 0
+        self.suppressed = 0
+        self.rate_limited = 0
+        self.keepalives = 0
+        self.failsafes = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def send(self, command, force=False):
+        """Asks for command to be sent, returns True if it went out now."""
+        with self.lock:
+            now = clock()
+            self.last_request = now
+            if not force:
+                if command == self.last_command and now - self.last_sent < self.resend_interval:
+                    # Anything held back is stale now
+                    self.pending = None
+                    self.suppressed += 1
+                    return False
+                if now - self.last_sent < self.min_interval:
+                    self.pending = command
+                    self.rate_limited += 1
+                    return False
+            self.pending = None
+            self._send(command, now)
+            return True
+
+    def idle(self):
+        """Sends idle straight away."""
+        return self.send('idle', force=True)
+
+    def _send(self, command, now):
+        self.socket.sendto(self.payloads[command], self.address)
+        self.last_command = command
+        self.last_sent = now
+        self.sent += 1
+
+    def tick(self):
+        """Sends whatever is due: the fail-safe idle, a held back command or a keepalive."""
+        with self.lock:
+            now = clock()
+            if (self.failsafe is not None and self.last_command not in (None, 'idle')
+                    and now - self.last_request >= self.failsafe):
+                self.pending = None
+                self._send('idle', now)
+                self.failsafes += 1
+            elif self.pending is not None and now - self.last_sent >= self.min_interval:
+                command, self.pending = self.pending, None
+                self._send(command, now)
+            elif (self.keepalive is not None and self.last_command is not None
+                    and now - self.last_sent >= self.keepalive):
+                self._send(self.last_command, now)
+                self.keepalives += 1
+
+    def start(self, interval=None):
+        """Calls tick() every interval seconds on a daemon thread."""
+        if interval is None:
+            interval = min(value for value in (self.min_interval, self.keepalive, self.failsafe, 0.1)
+                           if value) / 2.0
+
+        def run():
+            while not self._stopped.wait(interval):
+                self.tick()
+
+        self._thread = threading.Thread(target=run, name='command_channel')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        """Returns the send counters."""
+        return {
+            'sent': self.sent,
+            'suppressed': self.suppressed,
+            'rate_limited': self.rate_limited,
+            'keepalives': self.keepalives,
+            'failsafes': self.failsafes,
+        }
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.socket.close()
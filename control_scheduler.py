@@ -0,0 +1,113 @@
+# Name:         control_scheduler.py
+# Description:  Sends commands at a fixed tick rate, decoupled from when
+#               frames arrive and predictions finish.
+# Notes:        Predictions are submitted as they come. On every tick the
+#               class probabilities submitted since the previous tick are
+#               averaged into one decision and dispatched; if none is younger
+#               than the deadline the car is sent idle instead and the missed
+#               deadline is counted. Ticks are scheduled against the start
+#               time, not the previous tick, so lateness does not accumulate,
+#               and how late each one ran (jitter) is kept for stats().
+
+"""Fixed-rate control scheduler with deadlines and fail-safe idle."""
+import collections
+import threading
+
+import numpy as np
+
+from frame_receiver import clock
+
+
+class ControlScheduler(threading.Thread):
+    """Dispatches one averaged decision per tick through dispatcher.
+
+    deadline defaults to one tick: every tick needs a prediction made since
+    the one before. recorder, if given, notes each decision against the
+    newest frame that went into it.
+    """
+
+    def __init__(self, dispatcher, rate=2.0, deadline=None, recorder=None, history=4096,
+                 verbose=False):
+        threading.Thread.__init__(self, name='control_scheduler')
+        self.daemon = True
+        self.dispatcher = dispatcher
+        self.interval = 1.0 / rate
+        self.deadline = self.interval if deadline is None else deadline
+        self.recorder = recorder
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+        # (seq, probabilities, predicted at) since the last tick
+        self.pending = []
+        self.ticks = 0
+        self.decisions = 0
+        self.missed = 0
+        self.overruns = 0
+        self.predictions = 0
+        # How late each tick ran, in seconds
+        self.jitter = collections.deque(maxlen=history)
+
+    def submit(self, seq, probabilities, predicted_at=None):
+        """Adds one prediction (class probabilities) for the next tick."""
+        with self.lock:
+            self.pending.append(
+                (seq, probabilities, clock() if predicted_at is None else predicted_at))
+            self.predictions += 1
+
+    def tick(self, now=None):
+        """Makes one decision from the pending predictions."""
+        now = clock() if now is None else now
+        with self.lock:
+            pending, self.pending = self.pending, []
+        self.ticks += 1
+        if not self.predictions:
+            # Nothing to miss before the first prediction
+            return None
+        fresh = [item for item in pending if now - item[2] <= self.deadline]
+        if not fresh:
+            self.missed += 1
+            self.dispatcher.idle()
+            if self.recorder is not None and pending:
+                self.recorder.record_command(pending[-1][0], 'idle')
+            return None
+        total = np.sum([probabilities for _, probabilities, _ in fresh], axis=0)
+        predict = int(np.argmax(total))
+        sent = self.dispatcher.dispatch(predict, fresh[-1][2])
+        self.decisions += 1
+        if sent and self.verbose:
+            print(self.dispatcher.command(predict))
+        if self.recorder is not None:
+            self.recorder.record_command(fresh[-1][0], self.dispatcher.command(predict), sent)
+        return predict
+
+    def run(self):
+        start = clock()
+        tick = 0
+        while True:
+            tick += 1
+            scheduled = start + tick * self.interval
+            if self._stopped.wait(max(0.0, scheduled - clock())):
+                return
+            now = clock()
+            if now - scheduled >= self.interval:
+                # A whole tick late: skip the ones missed rather than burst
+                self.overruns += 1
+                tick = int((now - start) / self.interval)
+            self.jitter.append(now - scheduled)
+            self.tick(now)
+
+    def stop(self):
+        self._stopped.set()
+
+    def stats(self):
+        jitter = np.asarray(self.jitter) * 1000.0
+        return {
+            'ticks': self.ticks,
+            'decisions': self.decisions,
+            'missed_deadlines': self.missed,
+            'overruns': self.overruns,
+            'predictions': self.predictions,
+            'jitter_mean_ms': float(jitter.mean()) if len(jitter) else 0.0,
+            'jitter_p99_ms': float(np.percentile(jitter, 99)) if len(jitter) else 0.0,
+            'jitter_max_ms': float(jitter.max()) if len(jitter) else 0.0,
+        }
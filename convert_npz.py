@@ -0,0 +1,169 @@
+# Name:         convert_npz.py
+# Description:  Migrates the .npz captures in 'training_data' into the sharded
+#               memory-mapped dataset read by 'dataset.py'.
+# Instructions: python convert_npz.py [--output training_data/dataset] [files ...]
+# Notes:        Each .npz file is converted by its own worker process and
+#               split into shards of at most --shard-frames frames. Files
+#               already listed as a shard source in the manifest, with the
+#               same size and modification time, are skipped, so the
+#               converter can be re-run after every capture session; a file
+#               captured again at the same path is converted again. Shards
+#               are named after the file; a name already in the dataset (or
+#               taken by another file in the same run) gets a '-2', '-3', ...
+#               suffix, so existing shards are never overwritten.
+#               Every file must have been captured with the dataset's
+#               preprocessing spec (see preprocess.py).
+
+import argparse
+import glob
+import multiprocessing
+import os
+
+import numpy as np
+
+import dataset
+import preprocess
+
+
+def source_stamp(source):
+    """Returns the size and modification time that identify a capture file."""
+    status = os.stat(source)
+    return {'source_size': status.st_size, 'source_mtime': int(status.st_mtime)}
+
+
+def is_converted(source, entries):
+    """Returns True if manifest entries hold source as it is now on disk.
+    Entries from before sizes and times were kept only match on the path."""
+    stamp = source_stamp(source)
+    for entry in entries:
+        if entry.get('source') != source:
+            continue
+        if all(entry.get(key, value) == value for key, value in stamp.items()):
+            return True
+    return False
+
+
+def base_name(shard_name):
+    """Returns the part of a shard name before its part number."""
+    return shard_name.rsplit('-', 1)[0]
+
+
+def shard_bases(sources, names=()):
+    """Returns one shard base name per source, from the file name, that
+    neither the shard names already in the dataset nor the other sources use."""
+    taken = set(base_name(name) for name in names)
+    bases = []
+    for source in sources:
+        stem = os.path.splitext(os.path.basename(source))[0]
+        base = stem
+        suffix = 2
+        while base in taken:
+            base = '%s-%d' % (stem, suffix)
+            suffix += 1
+        taken.add(base)
+        bases.append(base)
+    return bases
+
+
+def convert(job):
+    """Converts one .npz file, returning its shard manifest entries and
+    the file's preprocessing spec."""
+    source, base, output, shard_frames = job
+    stamp = source_stamp(source)
+    data = np.load(source)
+    spec = preprocess.from_npz(data)
+    # Old captures hold float64 pixels and one hot float64 labels
+    frames = data['train']
+    labels = np.argmax(data['train_labels'], axis=1).astype(np.int8)
+    if frames.dtype != np.uint8:
+        frames = np.clip(np.rint(frames), 0, 255).astype(np.uint8)
+    entries = []
+    for part, start in enumerate(range(0, len(frames), shard_frames)):
+        name = '%s-%05d' % (base, part)
+        entry = dataset.write_shard(
+            output, name, frames[start:start + shard_frames],
+            labels[start:start + shard_frames], source=source)
+        entry.update(stamp)
+        entries.append(entry)
+    return entries, spec
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Convert .npz training captures to a sharded dataset.'
+    )
+    parser.add_argument(
+        dest='sources',
+        nargs='*',
+        help='.npz files to convert, defaults to training_data/*.npz'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        dest='output',
+        default=dataset.DATASET_DIR,
+        help='Dataset directory.'
+    )
+    parser.add_argument(
+        '--shard-frames',
+        dest='shard_frames',
+        default=4096,
+        type=int,
+        help='Maximum frames per shard.'
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        default=multiprocessing.cpu_count(),
+        type=int,
+        help='Number of worker processes.'
+    )
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    sources = args.sources or sorted(glob.glob('training_data/*.npz'))
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    existing = []
+    if os.path.exists(os.path.join(args.output, dataset.MANIFEST)):
+        existing = dataset.read_manifest(args.output)['shards']
+    sources = [source for source in sources if not is_converted(source, existing)]
+    if not sources:
+        print('Nothing to convert')
+        return
+
+    # Names are settled before the workers start, so they never collide with
+    # each other or overwrite a shard already in the dataset
+    bases = shard_bases(sources, [entry['name'] for entry in existing])
+    jobs = [(source, base, args.output, args.shard_frames)
+            for source, base in zip(sources, bases)]
+    pool = multiprocessing.Pool(max(1, min(args.jobs, len(jobs))))
+    try:
+        results = pool.map(convert, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    specs = [spec for _, spec in results]
+    if any(spec != specs[0] for spec in specs):
+        print('Source files were captured with different preprocessing, aborting:')
+        for source, spec in zip(sources, specs):
+            print('  %s: %r' % (source, spec))
+        return
+    entries = [entry for result, _ in results for entry in result]
+    try:
+        manifest = dataset.add_shards(args.output, entries, specs[0])
+    except ValueError as error:
+        print('%s, aborting' % error)
+        return
+    frames = sum(entry['frames'] for entry in entries)
+    print('Converted %d files into %d shards (%d frames)' % (len(sources), len(entries), frames))
+    print('Dataset now holds %d frames' % sum(entry['frames'] for entry in manifest['shards']))
+
+
+if __name__ == '__main__':
+    main()
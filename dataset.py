@@ -0,0 +1,177 @@
+# Name:         dataset.py
+# Description:  Sharded on-disk training set of raw uint8 frames and int8
+#               class labels, opened with np.memmap.
+# Notes:        A dataset is a directory holding a 'manifest.json' plus, for
+#               every shard, '<name>.frames' (N x frame_size uint8, C order)
+#               and '<name>.labels' (N int8 class indexes). Opening one only
+#               maps the files, so nothing is read until frames are used.
+#               Use 'convert_npz.py' to migrate the old .npz captures. The
+#               manifest also holds the preprocessing spec the frames were
+#               made with (see preprocess.py); every shard must share it.
+
+"""Memory-mapped sharded frame dataset."""
+import json
+import os
+
+import numpy as np
+
+import preprocess
+
+MANIFEST = 'manifest.json'
+VERSION = 1
+FRAME_SHAPE = (120, 320)
+NUM_CLASSES = 4
+DATASET_DIR = 'training_data/dataset'
+
+
+def one_hot(labels, num_classes=NUM_CLASSES, dtype=np.float32):
+    """Returns class indexes as one hot rows, the format Keras trains on."""
+    encoded = np.zeros((len(labels), num_classes), dtype)
+    encoded[np.arange(len(labels)), labels] = 1
+    return encoded
+
+
+def new_manifest(spec=None, num_classes=NUM_CLASSES):
+    spec = spec or preprocess.Preprocess()
+    return {
+        'version': VERSION,
+        'frame_shape': list(spec.shape),
+        'frame_size': spec.size,
+        'num_classes': num_classes,
+        'preprocess': spec.to_dict(),
+        'shards': [],
+    }
+
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(directory, manifest):
+    """Writes the manifest atomically so readers never see half of one."""
+    path = os.path.join(directory, MANIFEST)
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4, sort_keys=True)
+    os.rename(temporary, path)
+
+
+def write_shard(directory, name, frames, labels, source=None):
+    """Writes one shard's files and returns its manifest entry.
+
+    The caller is responsible for adding the entry to the manifest, see
+    add_shards().
+    """
+    frames = np.ascontiguousarray(frames, np.uint8)
+    labels = np.ascontiguousarray(labels, np.int8)
+    if len(frames) != len(labels):
+        raise ValueError('%d frames but %d labels' % (len(frames), len(labels)))
+    frames.tofile(os.path.join(directory, name + '.frames'))
+    labels.tofile(os.path.join(directory, name + '.labels'))
+    entry = {'name': name, 'frames': int(len(frames))}
+    if source is not None:
+        entry['source'] = source
+    return entry
+
+
+def add_shards(directory, entries, spec=None):
+    """Appends shard entries, whose frames were made with the preprocess.Preprocess
+    spec (the default one if None), to the manifest, creating the dataset if needed.
+
+    An entry replaces the one already listed under its name, if any (e.g. a
+    shard that has grown, see capture_writer.py).
+    """
+    spec = spec or preprocess.Preprocess()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        manifest = read_manifest(directory)
+        existing = preprocess.from_dict(manifest.get('preprocess'))
+        if existing != spec:
+            raise ValueError('%s holds %r frames, not %r' % (directory, existing, spec))
+    else:
+        manifest = new_manifest(spec)
+    names = dict((entry['name'], entry) for entry in entries)
+    manifest['shards'] = [names.pop(entry['name'], entry) for entry in manifest['shards']]
+    manifest['shards'].extend(entry for entry in entries if entry['name'] in names)
+    write_manifest(directory, manifest)
+    return manifest
+
+
+class Dataset(object):
+    """Read-only view over every shard listed in a dataset's manifest."""
+
+    def __init__(self, directory=DATASET_DIR):
+        self.directory = directory
+        self.manifest = read_manifest(directory)
+        self.frame_shape = tuple(self.manifest['frame_shape'])
+        self.frame_size = self.manifest['frame_size']
+        self.num_classes = self.manifest['num_classes']
+        # Datasets from before specs were recorded hold the default one
+        self.preprocess = preprocess.from_dict(self.manifest.get('preprocess'))
+        self.shards = []
+        # Name of every mapped shard, in the same order
+        self.names = []
+        label_parts = []
+        for entry in self.manifest['shards']:
+            if not entry['frames']:
+                continue
+            self.names.append(entry['name'])
+            path = os.path.join(directory, entry['name'])
+            self.shards.append(np.memmap(
+                path + '.frames', np.uint8, 'r', shape=(entry['frames'], self.frame_size)))
+            label_parts.append(np.fromfile(path + '.labels', np.int8))
+        # Labels are one byte per frame so they are simply read into memory
+        if label_parts:
+            self.labels = np.concatenate(label_parts)
+        else:
+            self.labels = np.zeros(0, np.int8)
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def shard_indices(self, names):
+        """Returns the global indexes of every frame in the named shards."""
+        names = set(names)
+        parts = [np.arange(self.offsets[shard], self.offsets[shard + 1])
+                 for shard, name in enumerate(self.names) if name in names]
+        return np.concatenate(parts) if parts else np.zeros(0, np.int64)
+
+    def frame(self, index):
+        """Returns a read-only (frame_size,) uint8 view of one frame."""
+        shard = np.searchsorted(self.offsets, index, side='right') - 1
+        return self.shards[shard][index - self.offsets[shard]]
+
+    def take(self, indices, out=None):
+        """Gathers frames by global index into out, a (len(indices), frame_size) array.
+
+        out may have any dtype; uint8 pixels are converted as they are copied.
+        """
+        indices = np.asarray(indices)
+        if out is None:
+            out = np.empty((len(indices), self.frame_size), np.uint8)
+        shards = np.searchsorted(self.offsets, indices, side='right') - 1
+        for shard in np.unique(shards):
+            rows = np.nonzero(shards == shard)[0]
+            # Sorted reads keep access to the mapped file sequential
+            local = indices[rows] - self.offsets[shard]
+            order = np.argsort(local)
+            out[rows[order]] = self.shards[shard][local[order]]
+        return out
+
+    def load(self, indices=None, scale=preprocess.PIXEL_SCALE, chunk=4096):
+        """Returns float32 frames multiplied by scale, chunk rows at a time.
+
+        Only the float32 result is allocated; there are no intermediate full
+        size copies.
+        """
+        if indices is None:
+            indices = np.arange(len(self))
+        images = np.empty((len(indices), self.frame_size), np.float32)
+        for start in range(0, len(indices), chunk):
+            block = images[start:start + chunk]
+            self.take(indices[start:start + chunk], out=block)
+            block *= scale
+        return images
@@ -0,0 +1,64 @@
+# Name:         decode.py
+# Description:  Shared JPEG -> cropped grayscale frame decode used by every
+#               server.
+# Notes:        PIL's draft mode makes libjpeg decode straight to grayscale
+#               (the Y channel, no color conversion) and, when a scale is
+#               asked for, to 1/2, 1/4 or 1/8 size using DCT scaling. The
+#               crop happens in PIL before any NumPy conversion and the
+#               pixels are written once into the caller's output array.
+
+"""Fast grayscale JPEG decode with crop-before-convert."""
+import io
+
+import numpy as np
+from PIL import Image
+
+FRAME_SIZE = (320, 240)
+# Left, upper, right, lower at full resolution; the lower half of the frame
+CROP_BOX = (0, 120, 320, 240)
+
+
+def crop_shape(box=CROP_BOX, scale=1):
+    """Returns the (height, width) decode_frame produces for box and scale."""
+    return ((box[3] - box[1]) // scale, (box[2] - box[0]) // scale)
+
+
+def crop_gray(pixels, out=None, box=CROP_BOX, scale=1):
+    """Like decode_frame for a 4:3 uint8 grayscale array of any size."""
+    step = float(FRAME_SIZE[0]) / pixels.shape[1]
+    left, upper, right, lower = (int(round(edge / step)) for edge in box)
+    region = pixels[upper:lower, left:right]
+    height, width = crop_shape(box, scale)
+    if region.shape != (height, width):
+        region = np.asarray(Image.fromarray(region).resize((width, height), Image.BILINEAR))
+    if out is None:
+        return np.array(region)
+    np.copyto(out.reshape(height, width), region, casting='unsafe')
+    return out
+
+
+def decode_frame(jpg, out=None, box=CROP_BOX, scale=1):
+    """Decodes the box region of jpg as grayscale, downsampled by scale.
+
+    jpg is any bytes-like object holding a 4:3 frame of any size; box is in
+    FRAME_SIZE pixels and scales with the frame. out may be any array with
+    crop_shape(box, scale) elements (e.g. (1, 38400) float32 for the model)
+    and is filled in place; otherwise a new uint8 array is returned.
+    """
+    image = Image.open(io.BytesIO(jpg))
+    # Larger frames are DCT scaled down to what the box needs
+    image.draft('L', (FRAME_SIZE[0] // scale, FRAME_SIZE[1] // scale))
+    if image.mode != 'L':
+        # Not a JPEG (or an unusual one); draft could not help
+        image = image.convert('L')
+    # draft picks the nearest DCT scale, so work out what we actually got
+    step = float(FRAME_SIZE[0]) / image.size[0]
+    height, width = crop_shape(box, scale)
+    region = image.crop(tuple(int(round(edge / step)) for edge in box))
+    if region.size != (width, height):
+        region = region.resize((width, height), Image.BILINEAR)
+    pixels = np.asarray(region)
+    if out is None:
+        return pixels
+    np.copyto(out.reshape(height, width), pixels, casting='unsafe')
+    return out
@@ -0,0 +1,210 @@
+# Name:         dedupe.py
+# Description:  Drops near-duplicate training frames, at capture time or
+#               offline over existing captures.
+# Instructions: python dedupe.py [--output training_data/dedup] [sources ...]
+#               where sources are .npz captures or dataset directories
+#               (default: training_data/dataset).
+# Notes:        Each frame gets a 128 bit average hash: the 320x120 crop is
+#               reduced to 8x16 block means and each bit says whether a block
+#               is brighter than the frame's mean. A frame is dropped when
+#               its hash is within --distance bits of one of the last
+#               --window frames kept with the same label, which is what a
+#               stopped or crawling car produces. Hashing and comparing
+#               cost about 0.1 ms per frame.
+
+"""Perceptual hash near-duplicate frame filter."""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+import dataset
+import preprocess
+
+SIGNATURE_SHAPE = (8, 16)
+DISTANCE = 6
+WINDOW = 16
+CHUNK = 1024
+
+# Number of set bits in every byte value
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], np.uint8)
+
+
+def signatures(frames, frame_shape=dataset.FRAME_SHAPE, shape=SIGNATURE_SHAPE):
+    """Returns the packed average hashes of (N, frame_size) frames, (N, bytes) uint8."""
+    frames = np.asarray(frames)
+    count = len(frames)
+    height, width = frame_shape
+    rows, columns = shape
+    # Rows and columns that do not fill a whole block are left out
+    block_height, block_width = height // rows, width // columns
+    frames = frames.reshape(count, height, width)[
+        :, :rows * block_height, :columns * block_width]
+    blocks = frames.reshape(count, rows, block_height, columns, block_width)
+    means = blocks.mean(axis=(2, 4), dtype=np.float32).reshape(count, -1)
+    return np.packbits(means > means.mean(axis=1, keepdims=True), axis=1)
+
+
+def signature(frame, frame_shape=dataset.FRAME_SHAPE, shape=SIGNATURE_SHAPE):
+    """Returns the packed average hash of one frame."""
+    return signatures(np.asarray(frame).reshape(1, -1), frame_shape, shape)[0]
+
+
+class DuplicateFilter(object):
+    """Remembers the last window kept signatures per label."""
+
+    def __init__(self, distance=DISTANCE, window=WINDOW, frame_shape=dataset.FRAME_SHAPE):
+        self.distance = distance
+        self.window = window
+        self.frame_shape = tuple(frame_shape)
+        self._recent = {}
+        self.kept = collections.Counter()
+        self.dropped = collections.Counter()
+
+    def admit_signature(self, sig, label):
+        """Returns True (and remembers sig) unless it duplicates a recent frame."""
+        label = int(label)
+        recent = self._recent.get(label)
+        if recent is None:
+            recent = self._recent[label] = collections.deque(maxlen=self.window)
+        if recent:
+            distances = POPCOUNT[np.bitwise_xor(np.array(recent), sig)].sum(axis=1)
+            if distances.min() <= self.distance:
+                self.dropped[label] += 1
+                return False
+        recent.append(sig)
+        self.kept[label] += 1
+        return True
+
+    def admit(self, frame, label):
+        """Returns True if frame should be kept."""
+        return self.admit_signature(signature(frame, self.frame_shape), label)
+
+    def stats(self):
+        labels = sorted(set(self.kept) | set(self.dropped))
+        return {
+            'kept': sum(self.kept.values()),
+            'dropped': sum(self.dropped.values()),
+            'labels': dict((str(label), {'kept': self.kept[label], 'dropped': self.dropped[label]})
+                           for label in labels),
+        }
+
+
+def dedupe_arrays(frames, labels, distance=DISTANCE, window=WINDOW,
+                  frame_shape=dataset.FRAME_SHAPE):
+    """Returns the indexes of the frames to keep, in capture order, and the filter."""
+    duplicates = DuplicateFilter(distance, window, frame_shape)
+    keep = []
+    for start in range(0, len(frames), CHUNK):
+        block = signatures(frames[start:start + CHUNK], frame_shape)
+        for offset, sig in enumerate(block):
+            if duplicates.admit_signature(sig, labels[start + offset]):
+                keep.append(start + offset)
+    return np.array(keep, np.int64), duplicates
+
+
+def list_parts(source):
+    """Returns the names of the parts of source deduped separately: the
+    shards of a dataset directory, or the one .npz capture."""
+    if os.path.isdir(source):
+        return [entry['name'] for entry in dataset.read_manifest(source)['shards']
+                if entry['frames']]
+    return [os.path.splitext(os.path.basename(source))[0]]
+
+
+def read_part(source, name):
+    """Returns (frames, labels, preprocessing spec) of one part, the frames
+    memory mapped for a shard."""
+    if os.path.isdir(source):
+        manifest = dataset.read_manifest(source)
+        entry = [entry for entry in manifest['shards'] if entry['name'] == name][0]
+        path = os.path.join(source, name)
+        frames = np.memmap(path + '.frames', np.uint8, 'r',
+                           shape=(entry['frames'], manifest['frame_size']))
+        return (frames, np.fromfile(path + '.labels', np.int8),
+                preprocess.from_dict(manifest.get('preprocess')))
+    data = np.load(source)
+    frames = data['train']
+    if frames.dtype != np.uint8:
+        frames = np.clip(np.rint(frames), 0, 255).astype(np.uint8)
+    return (frames, np.argmax(data['train_labels'], axis=1).astype(np.int8),
+            preprocess.from_npz(data))
+
+
+def dedupe_part(job):
+    """Dedupes one shard or file into a shard of output, returns its entry,
+    stats and preprocessing spec."""
+    source, name, output, distance, window = job
+    frames, labels, spec = read_part(source, name)
+    keep, duplicates = dedupe_arrays(frames, labels, distance, window, spec.shape)
+    entry = dataset.write_shard(output, name, frames[keep], labels[keep], source=source)
+    return entry, duplicates.stats(), spec
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Drop near-duplicate training frames.')
+    parser.add_argument(dest='sources', nargs='*',
+                        help='.npz captures or dataset directories, defaults to '
+                             + dataset.DATASET_DIR)
+    parser.add_argument('-o', '--output', dest='output', default='training_data/dedup',
+                        help='Dataset directory for the frames kept.')
+    parser.add_argument('--distance', dest='distance', default=DISTANCE, type=int,
+                        help='Frames within this many hash bits are duplicates.')
+    parser.add_argument('--window', dest='window', default=WINDOW, type=int,
+                        help='Kept frames per label each new frame is compared with.')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=multiprocessing.cpu_count(), type=int,
+                        help='Number of worker processes.')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='Also write the kept/dropped counts to this JSON file.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    sources = args.sources or [dataset.DATASET_DIR]
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    jobs = []
+    for source in sources:
+        for name in list_parts(source):
+            jobs.append((source, name, args.output, args.distance, args.window))
+    if len(set(job[1] for job in jobs)) != len(jobs):
+        print('Shard and file names must be unique, aborting')
+        return
+
+    pool = multiprocessing.Pool(max(1, min(args.jobs, len(jobs))))
+    try:
+        results = pool.map(dedupe_part, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    specs = [spec for _, _, spec in results]
+    if any(spec != specs[0] for spec in specs):
+        print('Sources were captured with different preprocessing, aborting')
+        return
+    dataset.add_shards(args.output, [entry for entry, _, _ in results], specs[0])
+    kept = collections.Counter()
+    dropped = collections.Counter()
+    for _, stats, _ in results:
+        for label, counts in stats['labels'].items():
+            kept[label] += counts['kept']
+            dropped[label] += counts['dropped']
+    for label in sorted(set(kept) | set(dropped)):
+        print('Label %s: kept %d, dropped %d' % (label, kept[label], dropped[label]))
+    total_kept, total_dropped = sum(kept.values()), sum(dropped.values())
+    total = total_kept + total_dropped
+    print('Kept %d of %d frames (%.1f%% dropped) in %s' % (
+        total_kept, total, 100.0 * total_dropped / total if total else 0.0, args.output))
+    if args.json_file:
+        with open(args.json_file, 'w') as output:
+            json.dump({'sources': sources, 'distance': args.distance, 'window': args.window,
+                       'kept': dict(kept), 'dropped': dict(dropped)},
+                      output, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
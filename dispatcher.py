@@ -0,0 +1,86 @@
+# Name:         dispatcher.py
+# Description:  Sends the model's predicted class straight to pi_pcm as the
+#               matching command from load_configuration().
+# Notes:        Replaces faking arrow keys with autopy and reading them back
+#               through pygame. Sending is left to common.CommandChannel, which
+#               encodes payloads once, keeps the UDP socket open and only
+#               resends an unchanged command once resend_interval has passed.
+
+"""Prediction to UDP command dispatcher."""
+import collections
+
+from common import CommandChannel, clock
+
+# Model class index -> command. These match the keys the old autopy path
+# pressed: left and right were always sent together with up.
+CLASS_COMMANDS = ('forward_left', 'forward_right', 'forward', 'reverse')
+
+
+class CommandDispatcher(object):
+    """Maps class indexes to commands and sends them through a CommandChannel.
+
+    The channel's timer thread is started if min_interval, failsafe or
+    keepalive is set: it sends a change held back by min_interval, which
+    would otherwise wait for the next prediction that differs, and makes the
+    car go idle on its own when predictions stop arriving.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        configuration,
+        class_commands=CLASS_COMMANDS,
+        resend_interval=0.25,
+        history=1024,
+        min_interval=0.02,
+        keepalive=None,
+        failsafe=None
+    ):
+        self.class_commands = class_commands
+        self.channel = CommandChannel(host, port, configuration, resend_interval,
+                                      min_interval, keepalive, failsafe)
+        if min_interval or keepalive is not None or failsafe is not None:
+            self.channel.start()
+        # (class index or None for idle, predicted at, sent at) for recent sends
+        self.history = collections.deque(maxlen=history)
+
+    @property
+    def sent(self):
+        return self.channel.sent
+
+    @property
+    def suppressed(self):
+        return self.channel.suppressed
+
+    def dispatch(self, class_index, predicted_at=None):
+        """Sends the command for class_index, returns False if it was held back."""
+        now = clock()
+        if not self.channel.send(self.class_commands[class_index]):
+            return False
+        self._record(class_index, now if predicted_at is None else predicted_at)
+        return True
+
+    def idle(self):
+        """Sends the idle command regardless of what was sent last."""
+        now = clock()
+        self.channel.idle()
+        self._record(None, now)
+
+    def _record(self, class_index, predicted_at):
+        self.history.append((class_index, predicted_at, self.channel.last_sent))
+
+    def command(self, class_index):
+        """Returns the command name for class_index."""
+        return 'idle' if class_index is None else self.class_commands[class_index]
+
+    def stats(self):
+        """Returns send counts and prediction-to-send latency over the history."""
+        latencies = [sent_at - predicted_at for _, predicted_at, sent_at in self.history]
+        stats = self.channel.stats()
+        stats['latency_mean'] = sum(latencies) / len(latencies) if latencies else 0.0
+        stats['latency_max'] = max(latencies) if latencies else 0.0
+        return stats
+
+    def close(self):
+        self.channel.close()
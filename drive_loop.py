@@ -0,0 +1,117 @@
+# Name:         drive_loop.py
+# Description:  The receive -> decode -> infer -> actuate loop that drives the
+#               car, shared by 'auto-driver.py' and the benchmarks.
+# Notes:        Kept free of pygame so it can run headless; callers pass a
+#               poll() function for anything that should happen on the main
+#               thread after each command (e.g. reading the quit key).
+
+"""Auto-driving pipeline built from the shared receiver, decoder and dispatcher."""
+import numpy as np
+
+from pipeline import Pipeline, clock
+from preprocess import Preprocess
+
+# Model inputs of the default preprocessing spec
+INPUT_DIM = Preprocess().size
+
+
+def load_predictor(model_file, input_dim=INPUT_DIM):
+    """Loads an exported .npz model (see export_model.py) with the NumPy
+    engine, or a Keras .h5 model. Keras is only imported for the latter.
+
+    One prediction is made on a blank input_dim frame before returning, so
+    whatever is set up lazily is ready before the first real frame arrives
+    (and a model expecting other inputs fails now rather than then).
+    """
+    if model_file.endswith('.npz'):
+        from mlp import NumpyModel
+        model = NumpyModel(model_file)
+    else:
+        from keras.models import load_model
+        model = load_model(model_file)
+        # Keras builds its predict function lazily; build it here so the
+        # inference thread does not have to (the TensorFlow graph is per thread).
+        model._make_predict_function()
+    model.predict(np.zeros((1, input_dim), np.float32), verbose=0)
+    return model
+
+
+def drive_pipeline(receiver, model, dispatcher, poll=None, verbose=True, recorder=None,
+                   feedback=None, scheduler=None, metrics=None, preprocess=None):
+    """Returns the Pipeline that drives from receiver's frames.
+
+    Each stage runs on its own thread. receive and decode copy the frame out
+    of the socket as fast as it arrives, and every queue only keeps the newest
+    frame, so inference never works through a backlog of stale images. The
+    actuate stage runs on the thread calling Pipeline.run(); if poll() returns
+    True the pipeline stops. Every command decision is noted in recorder, if
+    given, against the frame it was made from, and feedback (a
+    feedback.FeedbackSender) tells the client how far behind the server is.
+    With a scheduler (a control_scheduler.ControlScheduler) predictions are
+    handed to it and it decides what to send, and when; it notes its own
+    decisions in recorder. metrics, a metrics.Metrics, gets the time of
+    every stage and, separately, of poll(). Frames are prepared by
+    preprocess, the model's preprocess.Preprocess spec (the default one if
+    None).
+    """
+    preprocess = preprocess or Preprocess()
+    poll_histogram = metrics.histogram('poll') if metrics is not None else None
+
+    def receive():
+        # Each JPEG arrives behind a '<L' length header from the client. The
+        # view is reused on the next call so hand a copy to the decode thread.
+        # The frame's sequence number travels with it.
+        jpg = receiver.receive()
+        return (receiver.frames - 1, jpg.tobytes()) if jpg is not None else None
+
+    decoders = {}
+
+    def decode(frame):
+        # Decoded to grayscale, reduced to the model's region and resolution
+        # and written into its float32 input row, scaled like the training
+        # frames. A fresh row per frame since it is handed on to the
+        # inference thread. The wire format is only known once the client
+        # has sent its first frame.
+        seq, payload = frame
+        if receiver.format not in decoders:
+            decoders[receiver.format] = preprocess.decoder(receiver.format)
+        return seq, decoders[receiver.format](
+            payload, np.empty((1, preprocess.size), np.float32))
+
+    def infer(frame):
+        # Predict which of the four classes (Left, Right, Up, Down) to send
+        # to the car. The probabilities are copied since the NumPy engine
+        # reuses its output buffer.
+        seq, temp_array = frame
+        probabilities = np.array(model.predict(temp_array, verbose=0)[0])
+        return seq, probabilities, clock()
+
+    def actuate(prediction):
+        seq, probabilities, predicted_at = prediction
+        if scheduler is not None:
+            scheduler.submit(seq, probabilities, predicted_at)
+        else:
+            predict = int(np.argmax(probabilities))
+            sent = dispatcher.dispatch(predict, predicted_at)
+            if sent and verbose:
+                print(dispatcher.command(predict))
+            if recorder is not None:
+                recorder.record_command(seq, dispatcher.command(predict), sent)
+        if feedback is not None:
+            feedback.update(seq)
+        if poll is not None:
+            start = clock()
+            stop = poll()
+            if poll_histogram is not None:
+                poll_histogram.record(clock() - start)
+            if stop:
+                pipeline.stop()
+
+    pipeline = Pipeline(
+        receive,
+        [('decode', decode), ('infer', infer)],
+        ('actuate', actuate),
+        queue_sizes=[2, 1, 1],
+        metrics=metrics,
+    )
+    return pipeline
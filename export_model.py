@@ -0,0 +1,83 @@
+# Name:         export_model.py
+# Description:  Writes the weights of a Keras model trained by 'train.py' to
+#               a compact .npz file that 'mlp.py' runs without Keras.
+# Instructions: python export_model.py models/model.h5 [models/model.npz]
+# Notes:        After exporting, both models predict the same random batch
+#               and the export fails if any probability differs by more than
+#               --tolerance.
+
+import argparse
+import sys
+
+import numpy as np
+
+from mlp import ACTIVATIONS, NumpyModel
+
+
+def export(model, filename):
+    """Saves the Dense/PReLU/activation stack of model to filename."""
+    kinds = []
+    arrays = {}
+
+    def add_activation(name):
+        if name not in ACTIVATIONS:
+            raise ValueError('Unsupported activation %r' % name)
+        if name != 'linear':
+            kinds.append(name)
+
+    for layer in model.layers:
+        name = layer.__class__.__name__
+        if name == 'Dense':
+            W, b = layer.get_weights()
+            arrays['W_%d' % len(kinds)] = W.astype(np.float32)
+            arrays['b_%d' % len(kinds)] = b.astype(np.float32)
+            kinds.append('dense')
+            add_activation(layer.get_config()['activation'])
+        elif name == 'PReLU':
+            arrays['alpha_%d' % len(kinds)] = layer.get_weights()[0].astype(np.float32)
+            kinds.append('prelu')
+        elif name == 'Activation':
+            add_activation(layer.get_config()['activation'])
+        elif name == 'Dropout':
+            # Only active while training
+            continue
+        else:
+            raise ValueError('Cannot export %s layers' % name)
+    np.savez(filename, layers=np.array(kinds), **arrays)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Export a trained Keras MLP for NumPy inference.'
+    )
+    parser.add_argument(dest='model_file', help='Keras .h5 model.')
+    parser.add_argument(dest='output', nargs='?', default=None,
+                        help='Output .npz, defaults to the model name with .npz.')
+    parser.add_argument('--tolerance', dest='tolerance', default=1e-4, type=float,
+                        help='Largest allowed probability difference from Keras.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    output = args.output or args.model_file.rsplit('.', 1)[0] + '.npz'
+
+    from keras.models import load_model
+    model = load_model(args.model_file)
+    export(model, output)
+
+    numpy_model = NumpyModel(output, max_batch=64)
+    sample = np.random.RandomState(0).rand(64, numpy_model.input_dim).astype(np.float32)
+    expected = model.predict(sample, verbose=0)
+    actual = numpy_model.predict(sample)
+    difference = np.abs(expected - actual).max()
+    agreement = np.mean(expected.argmax(axis=1) == actual.argmax(axis=1))
+    print('Exported %s to %s' % (args.model_file, output))
+    print('Largest difference from Keras: %g, class agreement: %.1f%%' % (difference, 100 * agreement))
+    if difference > args.tolerance:
+        print('Difference exceeds tolerance %g' % args.tolerance)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
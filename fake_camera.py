@@ -0,0 +1,69 @@
+# Name:         fake_camera.py
+# Description:  Stand-in for 'stream_image_client.py' on the Pi: replays JPEGs
+#               to a server using the same length-prefixed protocol.
+# Instructions: python fake_camera.py [--source synthetic] [--fps 10] [-s host] [-p port]
+
+import argparse
+import socket
+import struct
+import threading
+
+from camera import open_source
+from frame_receiver import clock
+
+
+class FakeCamera(threading.Thread):
+    """Streams frames from source to address, noting when each one was sent."""
+
+    def __init__(self, address, source, frames=None):
+        threading.Thread.__init__(self, name='fake_camera')
+        self.daemon = True
+        self.address = address
+        self.source = source
+        self.frames = frames
+        # sent[seq] is when frame seq was "captured" and handed to the socket
+        self.sent = []
+        self.error = None
+        # Local port of the connection, to tell cameras apart on the server
+        self.port = None
+
+    def run(self):
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            client_socket.connect(self.address)
+            self.port = client_socket.getsockname()[1]
+            connection = client_socket.makefile('wb')
+            for jpeg in self.source:
+                if self.frames is not None and len(self.sent) >= self.frames:
+                    break
+                self.sent.append(clock())
+                connection.write(struct.pack('<L', len(jpeg)))
+                connection.write(jpeg)
+                connection.flush()
+            connection.write(struct.pack('<L', 0))
+            connection.close()
+        except socket.error as error:
+            self.error = error
+        finally:
+            client_socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay JPEGs like the Pi camera client.')
+    parser.add_argument('-s', '--server', dest='server', default='127.0.0.1')
+    parser.add_argument('-p', '--port', dest='port', default=8000, type=int)
+    parser.add_argument('--source', dest='source', default='synthetic',
+                        help="'synthetic' or a JPEG directory/stream file.")
+    parser.add_argument('--fps', dest='fps', default=10, type=int)
+    parser.add_argument('--frames', dest='frames', default=None, type=int)
+    args = parser.parse_args()
+
+    camera = FakeCamera((args.server, args.port), open_source(args.source, framerate=args.fps),
+                        args.frames)
+    camera.start()
+    camera.join()
+    print('Sent %d frames' % len(camera.sent))
+
+
+if __name__ == '__main__':
+    main()
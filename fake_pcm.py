@@ -0,0 +1,78 @@
+# Name:         fake_pcm.py
+# Description:  Stand-in for pi_pcm on the Raspberry Pi. Answers the
+#               server_up() probe and logs every command with a timestamp.
+# Instructions: python fake_pcm.py lambo.json [-p 12345]
+# Notes:        Like pi_pcm, a command containing 'request_response' is
+#               answered on port + 1 of the sender, which is where
+#               common.server_up() listens.
+
+import argparse
+import socket
+import threading
+
+from common import load_configuration
+from frame_receiver import clock
+
+
+class FakePCM(threading.Thread):
+    """UDP server that records (time, command) for every command received."""
+
+    def __init__(self, host='127.0.0.1', port=12345, configuration=None):
+        threading.Thread.__init__(self, name='fake_pcm')
+        self.daemon = True
+        self.port = port
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.1)
+        # Payload -> command name, so the log is readable
+        self.names = {}
+        for name, payload in (configuration or {}).items():
+            self.names[payload.encode('utf-8')] = name
+        self.log = []
+        self.probes = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                payload, address = self.socket.recvfrom(65536)
+            except socket.timeout:
+                continue
+            received = clock()
+            if b'request_response' in payload:
+                self.probes += 1
+                self.socket.sendto(b'ok', (address[0], self.port + 1))
+                continue
+            self.log.append((received, self.names.get(payload, 'unknown')))
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.socket.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake pi_pcm that logs commands.')
+    parser.add_argument(dest='control_file', help='JSON control file for the RC car.')
+    parser.add_argument('-p', '--port', dest='port', default=12345, type=int,
+                        help='Port to listen for commands on.')
+    args = parser.parse_args()
+
+    with open(args.control_file) as configuration_file:
+        configuration = load_configuration(configuration_file)
+    pcm = FakePCM('', args.port, configuration)
+    pcm.start()
+    print('Listening on port %d, Ctrl-C to stop' % args.port)
+    printed = 0
+    try:
+        while True:
+            pcm.join(0.5)
+            for received, name in pcm.log[printed:]:
+                print('%.6f %s' % (received, name))
+            printed = len(pcm.log)
+    except KeyboardInterrupt:
+        pcm.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+# Name:         feedback.py
+# Description:  Server to client feedback on the camera connection, and the
+#               client side controller that adapts frame rate, JPEG quality
+#               and resolution to what the server keeps up with.
+# Notes:        Every interval seconds the server writes one FEEDBACK record
+#               back on the TCP connection the frames arrive on: the newest
+#               frame it acted on and how many frames it has received and
+#               acted on. The client knows when it sent each frame, so it
+#               works out the backlog in the socket and the capture to action
+#               latency on its own clock; the two clocks never need to agree.
+#               Records only go to clients that asked for them when the
+#               connection was set up (see 'wire_format.py'), and a record is
+#               dropped rather than wait whenever the socket's send buffer is
+#               full, so a client that stops reading never holds up driving.
+
+"""Adaptive streaming feedback between the servers and 'stream_image_client.py'."""
+import collections
+import select
+import socket
+import struct
+import threading
+import time
+
+from frame_receiver import clock
+
+# Newest acted on frame seq (-1 for none yet), frames received, frames acted on
+FEEDBACK = struct.Struct('<iII')
+
+# Resolutions the controller steps through, best first. All are 4:3 so the
+# servers' crop box scales with them (see decode.py).
+RESOLUTIONS = ((320, 240), (240, 180), (160, 120))
+
+
+class FeedbackSender(object):
+    """Server side: reports progress on connection every interval seconds.
+
+    update() is called after acting on each frame; reports only go out if
+    the client asked for them (receiver.feedback) and never wait for room in
+    the socket. Every log_interval seconds the receive and act rates and the
+    mean frame size are printed and kept in log, so the settings the client
+    picked can be followed on the server.
+    """
+
+    def __init__(self, connection, receiver, interval=0.25, log_interval=5.0, verbose=True):
+        self.connection = connection
+        self.receiver = receiver
+        self.interval = interval
+        self.log_interval = log_interval
+        self.verbose = verbose
+        self.acted = 0
+        self.seq = -1
+        self.reports = 0
+        # Reports skipped because the send buffer was full
+        self.dropped = 0
+        self.closed = False
+        self._last_report = clock()
+        self._last_log = (clock(), 0, 0, 0)
+        # (time, received fps, acted fps, mean frame KB) per log_interval
+        self.log = []
+
+    def update(self, seq):
+        self.acted += 1
+        self.seq = seq
+        now = clock()
+        if self.closed or now - self._last_report < self.interval:
+            return
+        self._last_report = now
+        if self.receiver.feedback:
+            self._send(FEEDBACK.pack(self.seq, self.receiver.frames, self.acted))
+        if now - self._last_log[0] >= self.log_interval:
+            self._log(now)
+
+    def _send(self, record):
+        try:
+            # Writable means there is room for a whole record, so sendall
+            # does not block; the receive thread keeps the socket blocking
+            if not select.select([], [self.connection], [], 0)[1]:
+                self.dropped += 1
+                return
+            self.connection.sendall(record)
+            self.reports += 1
+        except (socket.error, select.error, ValueError):
+            # The client went away; the receive side will notice too
+            self.closed = True
+
+    def _log(self, now):
+        then, frames, acted, received_bytes = self._last_log
+        seconds = now - then
+        new_frames = self.receiver.frames - frames
+        entry = (
+            time.time(),
+            new_frames / seconds,
+            (self.acted - acted) / seconds,
+            (self.receiver.bytes_received - received_bytes) / 1024.0 / new_frames
+            if new_frames else 0.0,
+        )
+        self.log.append(entry)
+        self._last_log = (now, self.receiver.frames, self.acted, self.receiver.bytes_received)
+        if self.verbose:
+            print('Feedback: receiving %.1f fps, acting on %.1f fps, %.1f KB/frame' % entry[1:])
+
+
+class FeedbackReader(threading.Thread):
+    """Client side: reads FEEDBACK records and hands them to controller."""
+
+    def __init__(self, client_socket, controller):
+        threading.Thread.__init__(self, name='feedback')
+        self.daemon = True
+        self.socket = client_socket
+        self.controller = controller
+        self.reports = 0
+
+    def run(self):
+        record = bytearray(FEEDBACK.size)
+        view = memoryview(record)
+        try:
+            while True:
+                received = 0
+                while received < FEEDBACK.size:
+                    count = self.socket.recv_into(view[received:])
+                    if not count:
+                        return
+                    received += count
+                self.reports += 1
+                self.controller.report(*FEEDBACK.unpack_from(record))
+        except socket.error:
+            return
+
+
+class RateController(object):
+    """Adapts source's frame rate, JPEG quality and resolution to the server.
+
+    When the server falls behind (frames pile up in the socket, it skips
+    frames or latency passes target_latency) the frame rate is cut first,
+    then the quality, then the resolution. After steady good reports in a
+    row the settings come back in the opposite order, one step at a time.
+    """
+
+    def __init__(
+        self,
+        source,
+        framerate,
+        min_framerate=2,
+        max_framerate=30,
+        quality=85,
+        min_quality=40,
+        max_quality=85,
+        resolutions=RESOLUTIONS,
+        target_latency=0.2,
+        steady=4,
+        verbose=True
+    ):
+        self.source = source
+        self.framerate = framerate
+        self.min_framerate = min_framerate
+        self.max_framerate = max_framerate
+        self.quality = quality
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.resolutions = resolutions
+        self.resolution = 0
+        self.target_latency = target_latency
+        self.steady = steady
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.count = 0
+        # sent[seq - first] is when frame seq was written to the socket
+        self.sent_times = collections.deque(maxlen=4096)
+        self.good = 0
+        self._last = None
+        self.start = clock()
+        # (seconds since start, framerate, resolution, quality, backlog,
+        # latency) every time the settings change
+        self.history = []
+        self._apply(0, 0.0)
+
+    def sent(self):
+        """Notes that the next frame has been written to the socket."""
+        with self.lock:
+            self.sent_times.append(clock())
+            self.count += 1
+
+    def _sent_at(self, seq):
+        first = self.count - len(self.sent_times)
+        if first <= seq < self.count:
+            return self.sent_times[seq - first]
+        return None
+
+    def report(self, seq, received, acted):
+        """Takes one FEEDBACK record from the server."""
+        with self.lock:
+            now = clock()
+            sent_at = self._sent_at(seq)
+            latency = now - sent_at if sent_at is not None else 0.0
+            backlog = self.count - received
+            last, self._last = self._last, (now, received, acted)
+            if last is None:
+                return
+            new_frames = received - last[1]
+            skipped = new_frames - (acted - last[2]) if new_frames > 0 else 0
+            if backlog > 2 or latency > self.target_latency or skipped > 1:
+                self.good = 0
+                self._slower()
+            else:
+                self.good += 1
+                if self.good >= self.steady and latency < self.target_latency / 2:
+                    self.good = 0
+                    self._faster()
+            self._apply(backlog, latency)
+
+    def _slower(self):
+        if self.framerate > self.min_framerate:
+            self.framerate = max(self.min_framerate, int(self.framerate * 0.75))
+        elif self.quality > self.min_quality:
+            self.quality = max(self.min_quality, self.quality - 10)
+        elif self.resolution < len(self.resolutions) - 1:
+            self.resolution += 1
+
+    def _faster(self):
+        if self.resolution > 0:
+            self.resolution -= 1
+        elif self.quality < self.max_quality:
+            self.quality = min(self.max_quality, self.quality + 10)
+        elif self.framerate < self.max_framerate:
+            self.framerate += 1
+
+    def settings(self):
+        return self.framerate, self.resolutions[self.resolution], self.quality
+
+    def _apply(self, backlog, latency):
+        settings = self.settings()
+        if self.history and self.history[-1][1:4] == settings:
+            return
+        self.source.configure(*settings)
+        self.history.append((clock() - self.start,) + settings + (backlog, latency))
+        if self.verbose:
+            print('Adapt: %d fps, %dx%d, quality %d (backlog %d frames, latency %.0f ms)' % (
+                (settings[0],) + settings[1] + (settings[2], backlog, 1000 * latency)))
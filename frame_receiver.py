@@ -0,0 +1,151 @@
+# Name:         frame_receiver.py
+# Description:  Receives the length-prefixed JPEG stream sent by
+#               'stream_image_client.py'. Each frame is preceded by a
+#               struct.pack('<L', size) header and the stream ends with a
+#               zero length header.
+# Notes:        Frames are read straight into a reused bytearray with
+#               recv_into so no per-frame strings are built and the stream is
+#               never re-scanned for JPEG markers. Used by 'auto-driver.py',
+#               'self_control_train.py' and 'test_control.py'.
+
+"""Length-prefixed JPEG frame receiver shared by the streaming servers."""
+import struct
+import time
+
+HEADER = struct.Struct('<L')
+JPEG_START = b'\xff\xd8'
+JPEG_END = b'\xff\xd9'
+# Sent by the client in place of the first header to offer other formats
+HELLO = b'SSSC'
+
+# A 320x240 JPEG is ~10-20 KB; anything past this means the stream is out of sync
+MAX_FRAME_SIZE = 8 * 1024 * 1024
+INITIAL_BUFFER_SIZE = 64 * 1024
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class FrameError(ValueError):
+    """Raised when the stream can no longer be framed."""
+
+
+class FrameReceiver(object):
+    """Reads length-prefixed JPEG frames into a reused buffer.
+
+    connection is anything with recv_into (a socket) or readinto (a binary
+    file). receive() returns a memoryview that is only valid until the next
+    call. If recorder (a session_log.SessionRecorder) is given every good
+    frame is appended to it as it arrives. formats are the wire formats (see
+    'wire_format.py') this end can decode; a client may pick any of them
+    when it connects and format then holds the one in use, and
+    feedback whether it asked for feedback records.
+    """
+
+    def __init__(self, connection, max_frame_size=MAX_FRAME_SIZE, recorder=None,
+                 formats=('jpeg',)):
+        self.connection = connection
+        self.recorder = recorder
+        self.formats = formats
+        self.format = 'jpeg'
+        self.feedback = False
+        self._first_header = True
+        self.max_frame_size = max_frame_size
+        self._read_into = getattr(connection, 'recv_into', None)
+        if self._read_into is None:
+            self._read_into = connection.readinto
+        self._header = bytearray(HEADER.size)
+        self._header_view = memoryview(self._header)
+        self._buffer = bytearray(INITIAL_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self.frames = 0
+        self.malformed = 0
+        self.bytes_received = 0
+        self.started = None
+
+    def _fill(self, view):
+        """Fills view completely, returning False if the stream ended first."""
+        received = 0
+        size = len(view)
+        while received < size:
+            count = self._read_into(view[received:])
+            if not count:
+                self.bytes_received += received
+                return False
+            received += count
+        self.bytes_received += size
+        return True
+
+    def _reserve(self, size):
+        """Grows the frame buffer so it can hold size bytes."""
+        if size > len(self._buffer):
+            self._buffer = bytearray(max(size, 2 * len(self._buffer)))
+            self._view = memoryview(self._buffer)
+
+    def receive(self):
+        """Returns a memoryview of the next JPEG or None at end of stream."""
+        if self.started is None:
+            self.started = clock()
+        while True:
+            if not self._fill(self._header_view):
+                return None
+            if self._first_header:
+                self._first_header = False
+                if bytes(self._header) == HELLO:
+                    self._negotiate()
+                    continue
+            size = HEADER.unpack_from(self._header)[0]
+            if size == 0:
+                return None
+            if size > self.max_frame_size:
+                # The header is garbage so there is no way to find the next frame
+                self.malformed += 1
+                raise FrameError('Frame size %d exceeds %d bytes' % (size, self.max_frame_size))
+            self._reserve(size)
+            frame = self._view[:size]
+            if not self._fill(frame):
+                # Client went away in the middle of a frame
+                self.malformed += 1
+                return None
+            # JPEG image files begin with FF D8 and end with FF D9; raw
+            # formats are checked when they are decoded
+            if self.format == 'jpeg' and (frame[:2].tobytes() != JPEG_START
+                                          or frame[size - 2:].tobytes() != JPEG_END):
+                self.malformed += 1
+                continue
+            self.frames += 1
+            if self.recorder is not None:
+                self.recorder.record_frame(frame)
+            return frame
+
+    def _negotiate(self):
+        """Reads the client's offer after HELLO and answers with our pick."""
+        from wire_format import FEEDBACK, answer, choose
+        count = bytearray(1)
+        if not self._fill(memoryview(count)):
+            raise FrameError('Stream ended during negotiation')
+        codes = bytearray(count[0])
+        if not self._fill(memoryview(codes)):
+            raise FrameError('Stream ended during negotiation')
+        self.format = choose(codes, self.formats)
+        self.feedback = FEEDBACK in codes
+        self.connection.sendall(answer(self.format))
+        if self.recorder is not None:
+            self.recorder.set_format(self.format)
+
+    def __iter__(self):
+        frame = self.receive()
+        while frame is not None:
+            yield frame
+            frame = self.receive()
+
+    def stats(self):
+        """Returns a dict of frame, malformed frame and throughput counters."""
+        seconds = clock() - self.started if self.started is not None else 0.0
+        return {
+            'frames': self.frames,
+            'malformed': self.malformed,
+            'bytes': self.bytes_received,
+            'seconds': seconds,
+            'fps': self.frames / seconds if seconds else 0.0,
+            'mbps': self.bytes_received * 8 / seconds / 1e6 if seconds else 0.0,
+        }
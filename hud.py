@@ -0,0 +1,80 @@
+# Name:         hud.py
+# Description:  The pygame window of 'self_control_train.py' showing the
+#               current command and its JSON, drawn apart from frame intake.
+# Notes:        show() only replaces the state snapshot (a string), so it
+#               costs nothing wherever it is called from. render() runs on the
+#               thread that owns the window (pygame expects the main one) and
+#               redraws only when the snapshot changed, at most max_fps times
+#               a second. Each command's whole picture is rendered once and
+#               cached, so a redraw is one blit and a flip.
+
+"""Rate-capped heads-up display with per-command cached surfaces."""
+import json
+
+import pygame
+import pygame.font
+
+from frame_receiver import clock
+
+SIZE = (300, 400)
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+GREETING = 'Use arrows to move'
+
+
+class Hud(object):
+    """Window showing the last command given to show()."""
+
+    def __init__(self, configuration, max_fps=10.0, size=SIZE):
+        self.configuration = configuration
+        self.interval = 1.0 / max_fps if max_fps else None
+        self.screen = pygame.display.set_mode(size)
+        pygame.display.set_caption('rc-pi interactive')
+        self.big_font = pygame.font.Font(None, 40)
+        self.little_font = pygame.font.Font(None, 24)
+        self.surfaces = {}
+        self.state = GREETING
+        self.shown = None
+        self.last = 0.0
+        self.draws = 0
+        self.render(force=True)
+
+    def show(self, command):
+        """Sets the command to draw next."""
+        self.state = command
+
+    def surface(self, command):
+        """Returns the cached picture of command, rendering it the first time."""
+        surface = self.surfaces.get(command)
+        if surface is not None:
+            return surface
+        surface = pygame.Surface(self.screen.get_size())
+        surface.fill(BLACK)
+        text = self.big_font.render(command, 1, WHITE)
+        surface.blit(text, text.get_rect(centerx=surface.get_width() / 2))
+        if command in self.configuration:
+            pretty = json.dumps(json.loads(self.configuration[command]), indent=4)
+            y_position = self.big_font.size(command)[1] + 10
+            for line in pretty.split('\n'):
+                text = self.little_font.render(line, 1, WHITE)
+                surface.blit(text, text.get_rect(x=0, y=y_position))
+                y_position += self.little_font.size(line)[1]
+        self.surfaces[command] = surface
+        return surface
+
+    def render(self, force=False):
+        """Draws the current state if it changed and a redraw is due.
+
+        Returns True if it drew.
+        """
+        state = self.state
+        now = clock()
+        if not force:
+            if self.interval is None or state == self.shown or now - self.last < self.interval:
+                return False
+        self.screen.blit(self.surface(state), (0, 0))
+        pygame.display.flip()
+        self.shown = state
+        self.last = now
+        self.draws += 1
+        return True
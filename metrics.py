@@ -0,0 +1,272 @@
+# Name:         metrics.py
+# Description:  Lightweight per-stage timing for the driving and capture
+#               loops: a fixed-size latency histogram per stage, memory
+#               samples, a periodic log line, a JSON dump at exit and a local
+#               text endpoint for scraping.
+# Notes:        Callers time a stage themselves with the monotonic clock and
+#               hand the duration to record(), which only bisects a short list
+#               of bucket bounds and bumps three numbers under a lock (about a
+#               microsecond), so it can stay switched on while driving.
+#               Buckets follow a 1-2-5 series from 10 us to 10 s, so the
+#               percentiles reported are bucket upper bounds. Memory is only
+#               sampled by the reporter thread, never on the hot path. The
+#               endpoint answers any HTTP GET with the Prometheus text format.
+
+"""Per-stage latency histograms, memory samples and a stats endpoint."""
+import atexit
+import bisect
+import collections
+import json
+import resource
+import sys
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from frame_receiver import clock
+
+# Bucket upper bounds in seconds; one more bucket catches everything slower
+BOUNDS = tuple(round(scale * 10.0 ** exponent, 6)
+               for exponent in range(-5, 1) for scale in (1, 2, 5)) + (10.0,)
+PREFIX = 'sssc'
+
+
+class Histogram(object):
+    """Counts of durations per bucket, plus their count, sum and maximum."""
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        bucket = bisect.bisect_left(self.bounds, seconds)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket holding the fraction point."""
+        with self.lock:
+            counts, count, largest = list(self.counts), self.count, self.max
+        if not count:
+            return 0.0
+        seen = 0
+        for bucket, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= fraction * count:
+                return min(self.bounds[bucket], largest) if bucket < len(self.bounds) else largest
+        return largest
+
+    def stats(self):
+        with self.lock:
+            count, total, largest = self.count, self.total, self.max
+            buckets = list(self.counts)
+        return {
+            'count': count,
+            'mean_ms': 1000.0 * total / count if count else 0.0,
+            'p50_ms': 1000.0 * self.percentile(0.5),
+            'p99_ms': 1000.0 * self.percentile(0.99),
+            'max_ms': 1000.0 * largest,
+            'total_seconds': total,
+            'buckets': buckets,
+        }
+
+
+def memory():
+    """Returns the process' current and peak resident memory in bytes."""
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+    current = peak
+    try:
+        with open('/proc/self/statm') as statm:
+            current = int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return {'rss_bytes': current, 'peak_rss_bytes': peak}
+
+
+class Metrics(object):
+    """Named stage histograms and the ways of getting them out.
+
+    Other components' stats() (e.g. FrameReceiver.stats) can be added with
+    add_source() and are included in the JSON dump.
+    """
+
+    def __init__(self, history=720):
+        self.histograms = collections.OrderedDict()
+        self.sources = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.started = clock()
+        self.memory = memory()
+        # (seconds since start, rss bytes) of the recent samples
+        self.memory_history = collections.deque(maxlen=history)
+        self._stopped = threading.Event()
+        self._reporter = None
+        self._server = None
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def record(self, name, seconds):
+        """Adds one duration of stage name."""
+        self.histogram(name).record(seconds)
+
+    def add_source(self, name, stats):
+        """Includes the dict stats() returns in stats() under name."""
+        self.sources[name] = stats
+
+    def sample_memory(self):
+        self.memory = memory()
+        self.memory_history.append((clock() - self.started, self.memory['rss_bytes']))
+        return self.memory
+
+    def stats(self):
+        self.sample_memory()
+        result = {
+            'uptime_seconds': clock() - self.started,
+            'stages': collections.OrderedDict(
+                (name, histogram.stats()) for name, histogram in list(self.histograms.items())),
+            'memory': dict(self.memory, history=list(self.memory_history)),
+            'bounds_seconds': list(BOUNDS),
+        }
+        for name, stats in self.sources.items():
+            try:
+                result[name] = stats()
+            except Exception as error:
+                result[name] = {'error': repr(error)}
+        return result
+
+    def format_line(self):
+        """Returns the stages and memory as a single log line."""
+        parts = []
+        for name, histogram in list(self.histograms.items()):
+            stats = histogram.stats()
+            if not stats['count']:
+                continue
+            parts.append('%s n=%d p50=%.2f p99=%.2f max=%.2f' % (
+                name, stats['count'], stats['p50_ms'], stats['p99_ms'], stats['max_ms']))
+        return 'ms: %s | rss=%.0fMB peak=%.0fMB' % (
+            ' | '.join(parts), self.memory['rss_bytes'] / 1e6,
+            self.memory['peak_rss_bytes'] / 1e6)
+
+    def format_text(self):
+        """Returns everything in the Prometheus text exposition format."""
+        lines = ['# TYPE %s_stage_seconds histogram' % PREFIX]
+        for name, histogram in list(self.histograms.items()):
+            with histogram.lock:
+                counts, count, total = list(histogram.counts), histogram.count, histogram.total
+            cumulative = 0
+            for bound, bucket_count in zip(BOUNDS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('%s_stage_seconds_bucket{stage="%s",le="%s"} %d' % (
+                    PREFIX, name, bound if bound == '+Inf' else repr(bound), cumulative))
+            lines.append('%s_stage_seconds_sum{stage="%s"} %r' % (PREFIX, name, total))
+            lines.append('%s_stage_seconds_count{stage="%s"} %d' % (PREFIX, name, count))
+        for key, value in sorted(self.memory.items()):
+            lines.append('# TYPE %s_%s gauge' % (PREFIX, key))
+            lines.append('%s_%s %d' % (PREFIX, key, value))
+        lines.append('%s_uptime_seconds %r' % (PREFIX, clock() - self.started))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename):
+        with open(filename, 'w') as output:
+            json.dump(self.stats(), output, indent=4)
+
+    def _report(self, interval, verbose):
+        while not self._stopped.wait(interval):
+            self.sample_memory()
+            if verbose:
+                print(self.format_line())
+
+    def start(self, interval=5.0, verbose=True, port=None, host='127.0.0.1', json_file=None):
+        """Samples memory (and prints format_line() if verbose) every interval
+        seconds, serves format_text() on port if given and dumps stats() to
+        json_file at exit if given."""
+        if interval:
+            self._reporter = threading.Thread(target=self._report, args=(interval, verbose),
+                                              name='metrics')
+            self._reporter.daemon = True
+            self._reporter.start()
+        if port is not None:
+            self._server = serve(self, host, port)
+            print('Stats on http://%s:%d/metrics' % (host, self._server.server_port))
+        if json_file:
+            atexit.register(self.dump, json_file)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def serve(metrics, host='127.0.0.1', port=9100):
+    """Serves metrics.format_text() over HTTP from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            metrics.sample_memory()
+            body = metrics.format_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics_server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_arguments(parser):
+    """Adds the --stats-* options every instrumented script takes."""
+    parser.add_argument(
+        '--stats-interval',
+        dest='stats_interval',
+        help='Seconds between stage timing log lines; 0 turns them off.',
+        default=10.0,
+        type=float
+    )
+    parser.add_argument(
+        '--stats-port',
+        dest='stats_port',
+        help='Serve stage timings as text on this local port.',
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        '--stats-json',
+        dest='stats_json',
+        help='Write all timings to this JSON file at exit.',
+        default=None
+    )
+    return parser
+
+
+def from_args(args):
+    """Returns started Metrics configured by add_arguments()' options."""
+    return Metrics().start(args.stats_interval, bool(args.stats_interval),
+                           args.stats_port, json_file=args.stats_json)
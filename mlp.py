@@ -0,0 +1,115 @@
+# Name:         mlp.py
+# Description:  Runs the Dense/PReLU/softmax network built in 'train.py'
+#               with NumPy only, from weights written by 'export_model.py'.
+# Notes:        Importing this module does not import Keras. Activations
+#               live in preallocated float32 buffers and every layer is one
+#               BLAS matrix product written in place, so a prediction does
+#               no allocation beyond the returned classes.
+
+"""Keras-free forward pass for the exported MLP."""
+import numpy as np
+
+# Element-wise activations a Dense layer may carry in its config
+ACTIVATIONS = ('linear', 'relu', 'sigmoid', 'tanh', 'softmax')
+
+
+def softmax(values, out):
+    """Row-wise softmax of values written into out (may be values)."""
+    np.subtract(values, values.max(axis=1)[:, np.newaxis], out=out)
+    np.exp(out, out=out)
+    out /= out.sum(axis=1)[:, np.newaxis]
+    return out
+
+
+class NumpyModel(object):
+    """Forward pass over the layers stored in an exported .npz file.
+
+    The file holds 'layers', an array of layer kinds ('dense', 'prelu' or one
+    of ACTIVATIONS), and for layer i the arrays 'W_i' and 'b_i' (dense) or
+    'alpha_i' (prelu).
+    """
+
+    def __init__(self, filename, max_batch=1):
+        weights = np.load(filename)
+        self.layers = []
+        self.input_dim = None
+        for index, kind in enumerate(weights['layers']):
+            kind = str(kind)
+            if kind == 'dense':
+                W = np.ascontiguousarray(weights['W_%d' % index], np.float32)
+                b = np.ascontiguousarray(weights['b_%d' % index], np.float32)
+                if self.input_dim is None:
+                    self.input_dim = W.shape[0]
+                self.layers.append((kind, W, b))
+            elif kind == 'prelu':
+                alpha = np.ascontiguousarray(weights['alpha_%d' % index], np.float32)
+                self.layers.append((kind, alpha, None))
+            elif kind in ACTIVATIONS:
+                self.layers.append((kind, None, None))
+            else:
+                raise ValueError('Unsupported layer kind %r in %s' % (kind, filename))
+        if not self.layers or self.layers[0][0] != 'dense':
+            # Activations run in place, which must never touch the caller's input
+            raise ValueError('%s must start with a dense layer' % filename)
+        self.output_dim = [W.shape[1] for kind, W, _ in self.layers if kind == 'dense'][-1]
+        self._allocate(max_batch)
+
+    def _allocate(self, batch):
+        """(Re)allocates the per layer output and scratch buffers for batch rows."""
+        self.max_batch = batch
+        self._outputs = []
+        self._scratch = []
+        for kind, W, _ in self.layers:
+            if kind == 'dense':
+                width = W.shape[1]
+                self._outputs.append(np.empty((batch, width), np.float32))
+                self._scratch.append(np.empty((batch, width), np.float32))
+        self._input = np.empty((batch, self.input_dim), np.float32)
+
+    def predict(self, x, verbose=0):
+        """Returns class probabilities for x, (n, input_dim) or (input_dim,).
+
+        The result is a view into an internal buffer that the next call
+        overwrites.
+        """
+        x = np.asarray(x)
+        if x.ndim == 1:
+            x = x[np.newaxis, :]
+        rows = x.shape[0]
+        if rows > self.max_batch:
+            self._allocate(rows)
+        if x.dtype != np.float32 or not x.flags.c_contiguous:
+            np.copyto(self._input[:rows], x, casting='unsafe')
+            x = self._input[:rows]
+        layer = 0
+        h = x
+        for kind, first, second in self.layers:
+            if kind == 'dense':
+                out = self._outputs[layer][:rows]
+                np.dot(h, first, out=out)
+                out += second
+                h = out
+                scratch = self._scratch[layer][:rows]
+                layer += 1
+            elif kind == 'prelu':
+                # max(0, h) + alpha * min(0, h)
+                np.minimum(h, 0, out=scratch)
+                scratch *= first
+                np.maximum(h, 0, out=h)
+                h += scratch
+            elif kind == 'relu':
+                np.maximum(h, 0, out=h)
+            elif kind == 'sigmoid':
+                np.negative(h, out=h)
+                np.exp(h, out=h)
+                h += 1
+                np.reciprocal(h, out=h)
+            elif kind == 'tanh':
+                np.tanh(h, out=h)
+            elif kind == 'softmax':
+                softmax(h, h)
+        return h
+
+    def predict_classes(self, x, verbose=0):
+        """Returns the most likely class index for every row of x, like Keras."""
+        return self.predict(x).argmax(axis=-1)
@@ -0,0 +1,65 @@
+# Name:         monitor_viewer.py
+# Description:  Shows the thumbnails 'stream_image_client.py --drive --monitor'
+#               sends while the Pi drives itself.
+# Instructions: On the computer: python monitor_viewer.py [--port 8001]
+#               then on the Pi: python stream_image_client.py --drive model.npz --monitor
+# Notes:        Display only: nothing is predicted and no command is sent, so
+#               it listens on its own port (MONITOR_PORT), never on the one the
+#               driving servers use. The stream is the client's usual
+#               length-prefixed JPEGs, read with 'frame_receiver.py'.
+
+"""Display-only receiver of the on-device driving thumbnails."""
+import argparse
+import io
+import socket
+
+from frame_receiver import FrameReceiver
+
+MONITOR_PORT = 8001
+
+
+def show(connection, scale=4):
+    """Shows every thumbnail from connection until the stream ends."""
+    import pygame
+    pygame.init()
+    screen = None
+    receiver = FrameReceiver(connection)
+    while True:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return receiver.frames
+        frame = receiver.receive()
+        if frame is None:
+            return receiver.frames
+        image = pygame.image.load(io.BytesIO(frame.tobytes()), 'thumbnail.jpg')
+        size = (image.get_width() * scale, image.get_height() * scale)
+        if screen is None or screen.get_size() != size:
+            screen = pygame.display.set_mode(size)
+            pygame.display.set_caption('rc-pi monitor')
+        screen.blit(pygame.transform.scale(image, size), (0, 0))
+        pygame.display.flip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shows the thumbnails of a Pi driving itself.')
+    parser.add_argument('--listen', dest='listen', default='0.0.0.0',
+                        help='Address to listen on.')
+    parser.add_argument('-p', '--port', dest='port', default=MONITOR_PORT, type=int,
+                        help='Port to listen on.')
+    parser.add_argument('--scale', dest='scale', default=4, type=int,
+                        help='Times to enlarge the thumbnails.')
+    args = parser.parse_args()
+    server_socket = socket.socket()
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((args.listen, args.port))
+    server_socket.listen(0)
+    connection = server_socket.accept()[0]
+    try:
+        print('Thumbnails shown: %d' % show(connection, args.scale))
+    finally:
+        connection.close()
+        server_socket.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+# Name:         multi_server.py
+# Description:  Drives several cars from one workstation. Every car's Pi runs
+#               'stream_image_client.py' against this server and one model
+#               predicts for all of them.
+# Instructions: python multi_server.py lambo.json -m models/model.npz [--port 8000]
+#               Commands go to pi_pcm on the car that sent the frames unless
+#               --pcm-host is given.
+# Notes:        A thread per car receives and decodes its stream; frames from
+#               different cars that arrive within --window seconds of each
+#               other are predicted in one batch by a single inference thread.
+#               Each car only keeps its newest undecided frame, so a slow
+#               batch never builds a backlog. Frames are prepared by the
+#               preprocessing spec the model was trained with (preprocess.py).
+
+"""Multi-car streaming server with cross-car batched inference."""
+import argparse
+import collections
+import json
+import socket
+import threading
+
+import numpy as np
+from PIL import ImageFile
+
+from common import load_configuration
+from dispatcher import CommandDispatcher
+from feedback import FeedbackSender
+from drive_loop import INPUT_DIM, load_predictor
+from frame_receiver import FrameError, FrameReceiver, clock
+from preprocess import Preprocess, for_model
+from wire_format import FORMATS
+
+# A frame cut short still decodes rather than failing, as in auto-driver.py
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+class Car(object):
+    """Per-car state: its stream, command target and counters."""
+
+    def __init__(self, number, connection, address, dispatcher, history=4096):
+        self.number = number
+        self.connection = connection
+        self.address = address
+        self.receiver = FrameReceiver(connection, formats=FORMATS)
+        self.feedback = FeedbackSender(connection, self.receiver, verbose=False)
+        self.dispatcher = dispatcher
+        self.lock = threading.Lock()
+        self.finished = False
+        self.predicted = 0
+        # Frames replaced by a newer one before they were batched
+        self.dropped = 0
+        # Frames that could not be decoded and were skipped
+        self.errors = 0
+        # (seq, received, acted) for recent frames
+        self.completed = collections.deque(maxlen=history)
+
+    def act(self, seq, predict, received, predicted_at):
+        with self.lock:
+            # The stream may have ended while the batch was being predicted
+            if self.finished:
+                return
+            self.dispatcher.dispatch(predict, predicted_at)
+            self.feedback.update(seq)
+            self.predicted += 1
+            self.completed.append((seq, received, clock()))
+
+    def close(self):
+        with self.lock:
+            self.finished = True
+            self.dispatcher.idle()
+            self.dispatcher.close()
+            self.connection.close()
+
+    def stats(self):
+        latencies = [acted - received for _, received, acted in self.completed]
+        stats = {
+            'address': '%s:%d' % self.address,
+            'finished': self.finished,
+            'frames': self.receiver.frames,
+            'malformed': self.receiver.malformed,
+            'predicted': self.predicted,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'feedback_reports': self.feedback.reports,
+            'feedback_dropped': self.feedback.dropped,
+            'receive_to_command_mean_ms':
+                1000.0 * sum(latencies) / len(latencies) if latencies else 0.0,
+        }
+        stats.update(('commands_' + key, value)
+                     for key, value in self.dispatcher.channel.stats().items())
+        return stats
+
+
+class Batcher(threading.Thread):
+    """Collects the newest frame from each car and predicts them together."""
+
+    def __init__(self, model, window=0.005, max_batch=16, input_dim=INPUT_DIM):
+        threading.Thread.__init__(self, name='batcher')
+        self.daemon = True
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self.condition = threading.Condition()
+        # car -> (seq, row, received), oldest first
+        self.pending = collections.OrderedDict()
+        self.active = 0
+        self.stopped = False
+        self.batches = 0
+        self.batched_frames = 0
+        self.predict_seconds = 0.0
+        self.batch = np.empty((max_batch, input_dim), np.float32)
+
+    def submit(self, car, seq, row, received):
+        with self.condition:
+            if self.pending.pop(car, None) is not None:
+                car.dropped += 1
+            self.pending[car] = (seq, row, received)
+            self.condition.notify()
+
+    def _take(self):
+        """Waits for a frame, then up to window for the other cars' frames."""
+        with self.condition:
+            while not self.pending and not self.stopped:
+                self.condition.wait(0.1)
+            deadline = clock() + self.window
+            while not self.stopped and len(self.pending) < min(self.active, self.max_batch):
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            items = []
+            while self.pending and len(items) < self.max_batch:
+                items.append(self.pending.popitem(last=False))
+            return items
+
+    def run(self):
+        while not self.stopped:
+            items = self._take()
+            if not items:
+                continue
+            batch = self.batch[:len(items)]
+            for row, (_, (_, frame, _)) in enumerate(items):
+                batch[row] = frame
+            start = clock()
+            classes = self.model.predict_classes(batch, verbose=0)
+            predicted_at = clock()
+            self.predict_seconds += predicted_at - start
+            self.batches += 1
+            self.batched_frames += len(items)
+            for (car, (seq, _, received)), predict in zip(items, classes):
+                car.act(seq, int(predict), received, predicted_at)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'frames': self.batched_frames,
+            'mean_batch': float(self.batched_frames) / self.batches if self.batches else 0.0,
+            'mean_predict_ms':
+                1000.0 * self.predict_seconds / self.batches if self.batches else 0.0,
+        }
+
+
+class MultiCarServer(object):
+    """Accepts camera streams from any number of cars and drives them all."""
+
+    def __init__(
+        self,
+        model,
+        configuration,
+        host='',
+        port=8000,
+        pcm_host=None,
+        pcm_port=12345,
+        window=0.005,
+        max_batch=16,
+        failsafe=1.0,
+        preprocess=None
+    ):
+        self.configuration = configuration
+        self.preprocess = preprocess or Preprocess()
+        self.pcm_host = pcm_host
+        self.pcm_port = pcm_port
+        self.failsafe = failsafe
+        self.server_socket = socket.socket()
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(max_batch)
+        self.address = self.server_socket.getsockname()
+        self.batcher = Batcher(model, window, max_batch, self.preprocess.size)
+        self.cars = []
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def _serve_car(self, car):
+        decode = None
+        try:
+            while True:
+                try:
+                    jpg = car.receiver.receive()
+                except (FrameError, socket.error):
+                    # Out of sync or the connection is gone: the car is done
+                    break
+                if jpg is None:
+                    break
+                received = clock()
+                if decode is None:
+                    decode = self.preprocess.decoder(car.receiver.format)
+                # A fresh row per frame since it is handed to the batcher
+                try:
+                    row = decode(jpg, np.empty(self.preprocess.size, np.float32))
+                except Exception as error:
+                    # One bad frame should not end the car's session
+                    car.errors += 1
+                    print('car%d decode error: %r' % (car.number, error))
+                    continue
+                self.batcher.submit(car, car.receiver.frames - 1, row, received)
+        finally:
+            with self.batcher.condition:
+                self.batcher.active -= 1
+            car.close()
+
+    def serve(self):
+        """Accepts cars until stop() is called."""
+        self.batcher.start()
+        while not self.stopped:
+            try:
+                connection, address = self.server_socket.accept()
+            except socket.error:
+                break
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            dispatcher = CommandDispatcher(self.pcm_host or address[0], self.pcm_port,
+                                           self.configuration, failsafe=self.failsafe)
+            with self.lock:
+                car = Car(len(self.cars), connection, address, dispatcher)
+                self.cars.append(car)
+            with self.batcher.condition:
+                self.batcher.active += 1
+            thread = threading.Thread(target=self._serve_car, args=(car,),
+                                      name='car%d' % car.number)
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        """Runs serve() on a daemon thread."""
+        thread = threading.Thread(target=self.serve, name='accept')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped = True
+        try:
+            # Wakes up accept()
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server_socket.close()
+        self.batcher.stop()
+
+    def stats(self):
+        with self.lock:
+            cars = list(self.cars)
+        return {
+            'batcher': self.batcher.stats(),
+            'cars': [car.stats() for car in cars],
+        }
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Drive several cars with one model.')
+    parser.add_argument(dest='control_file', help='JSON control file for the RC cars.')
+    parser.add_argument('-m', '--model', dest='model', default='models/model.npz',
+                        help='Exported .npz or Keras .h5 model.')
+    parser.add_argument('--host', dest='host', default='',
+                        help='Address to listen on, all interfaces by default.')
+    parser.add_argument('--port', dest='port', default=8000, type=int,
+                        help='Port the cars stream to.')
+    parser.add_argument('--pcm-host', dest='pcm_host', default=None,
+                        help='Send every command here instead of to each car.')
+    parser.add_argument('--pcm-port', dest='pcm_port', default=12345, type=int,
+                        help='pi_pcm port on the cars.')
+    parser.add_argument('--window', dest='window', default=0.005, type=float,
+                        help='Seconds to wait for other cars to fill a batch.')
+    parser.add_argument('--max-batch', dest='max_batch', default=16, type=int,
+                        help='Most frames predicted together.')
+    parser.add_argument('--report-interval', dest='report_interval', default=10.0, type=float,
+                        help='Seconds between stats reports.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    with open(args.control_file) as configuration_file:
+        configuration = load_configuration(configuration_file)
+    spec = for_model(args.model)
+    server = MultiCarServer(load_predictor(args.model, spec.size), configuration, args.host,
+                            args.port, args.pcm_host, args.pcm_port, args.window, args.max_batch,
+                            preprocess=spec)
+    print('Listening on %s:%d' % server.address)
+    thread = server.start()
+    try:
+        while thread.is_alive():
+            thread.join(args.report_interval)
+            print(json.dumps(server.stats(), sort_keys=True))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# Name:         pipeline.py
+# Description:  Runs the receive, decode, infer and actuate steps of
+#               'auto-driver.py' as separate threads joined by small bounded
+#               queues.
+# Notes:        Every queue drops its oldest item when it is full, so a slow
+#               stage always works on the newest frame and frame-to-command
+#               latency stays around one inference time instead of growing
+#               with whatever piles up in the TCP buffer. Given a
+#               metrics.Metrics, every stage's time per item and the end to
+#               end latency also go into its histograms.
+
+"""Latest-frame-wins threaded pipeline."""
+import collections
+import threading
+
+from frame_receiver import clock
+
+# Passed down the pipeline once the source runs dry
+STOP = object()
+
+
+class Empty(Exception):
+    """Raised by LatestQueue.get when nothing arrives before the timeout."""
+
+
+class Packet(object):
+    """One frame travelling through the pipeline."""
+    __slots__ = ('seq', 'created', 'value')
+
+    def __init__(self, seq, created, value):
+        self.seq = seq
+        self.created = created
+        self.value = value
+
+
+class LatestQueue(object):
+    """Bounded FIFO that drops its oldest item instead of blocking the producer."""
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self._items = collections.deque()
+        self._ready = threading.Condition(threading.Lock())
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        with self._ready:
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        with self._ready:
+            if timeout is None:
+                while not self._items:
+                    self._ready.wait()
+            else:
+                deadline = clock() + timeout
+                while not self._items:
+                    remaining = deadline - clock()
+                    if remaining <= 0:
+                        raise Empty()
+                    self._ready.wait(remaining)
+            return self._items.popleft()
+
+    def qsize(self):
+        return len(self._items)
+
+
+class Stage(threading.Thread):
+    """Applies function to every packet from inbox and passes the result on.
+
+    A function returning None drops the packet (e.g. a frame that failed to
+    decode).
+    """
+
+    def __init__(self, name, function, inbox, outbox, metrics=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.function = function
+        self.inbox = inbox
+        self.outbox = outbox
+        self.histogram = metrics.histogram(name) if metrics is not None else None
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+
+    def run(self):
+        while True:
+            packet = self.inbox.get()
+            if packet is STOP:
+                self.outbox.put(STOP)
+                return
+            start = clock()
+            try:
+                value = self.function(packet.value)
+            except Exception as error:
+                # One bad frame should not take the whole stage down
+                self.errors += 1
+                print('%s stage error: %r' % (self.name, error))
+                value = None
+            elapsed = clock() - start
+            self.busy += elapsed
+            if self.histogram is not None:
+                self.histogram.record(elapsed)
+            self.items += 1
+            if value is not None:
+                packet.value = value
+                self.outbox.put(packet)
+
+
+class Source(threading.Thread):
+    """Calls read() until it returns None and feeds the results to outbox."""
+
+    def __init__(self, name, read, outbox, metrics=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.read = read
+        self.outbox = outbox
+        self.histogram = metrics.histogram(name) if metrics is not None else None
+        self.items = 0
+        self.busy = 0.0
+        self.error = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                start = clock()
+                value = self.read()
+                if value is None:
+                    break
+                now = clock()
+                self.busy += now - start
+                if self.histogram is not None:
+                    self.histogram.record(now - start)
+                self.outbox.put(Packet(self.items, now, value))
+                self.items += 1
+        except Exception as error:
+            # Usually the connection being closed underneath us on shutdown
+            if not self.stopped.is_set():
+                self.error = error
+        finally:
+            self.outbox.put(STOP)
+
+
+class Pipeline(object):
+    """source -> stages -> sink, with the sink run on the calling thread.
+
+    source is a callable returning the next item or None at the end, stages
+    is a list of (name, function) pairs each run on its own thread and sink
+    is a (name, function) pair run by run(). The sink stays on the calling
+    thread because pygame expects to be used from the main thread.
+    queue_sizes gives the capacity of the queue in front of each stage and
+    the sink; history how many completed packets to keep timings for.
+    metrics, a metrics.Metrics, gets every stage's time per item and the
+    end to end latency, as 'latency'.
+    """
+
+    def __init__(self, source, stages, sink, queue_sizes=None, history=4096, metrics=None):
+        names = [name for name, _ in stages] + [sink[0]]
+        if queue_sizes is None:
+            queue_sizes = [1] * len(names)
+        self.queues = collections.OrderedDict(
+            (name, LatestQueue(size)) for name, size in zip(names, queue_sizes))
+        inboxes = list(self.queues.values())
+        self.source = Source('receive', source, inboxes[0], metrics)
+        self.stages = [
+            Stage(name, function, inboxes[index], inboxes[index + 1], metrics)
+            for index, (name, function) in enumerate(stages)
+        ]
+        self.sink_name, self.sink = sink
+        self.sink_histogram = self.latency_histogram = None
+        if metrics is not None:
+            self.sink_histogram = metrics.histogram(self.sink_name)
+            self.latency_histogram = metrics.histogram('latency')
+        self.sink_items = 0
+        self.sink_busy = 0.0
+        self.latency_last = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        # When the sink finished its first packet
+        self.first_finished = None
+        # (seq, created, finished) of recently completed packets
+        self.completed = collections.deque(maxlen=history)
+        self._stopped = threading.Event()
+
+    def stop(self):
+        """Asks run() to return after the current packet."""
+        self._stopped.set()
+        self.source.stopped.set()
+
+    def run(self, report_interval=None):
+        """Runs until the source ends or stop() is called."""
+        for thread in [self.source] + self.stages:
+            thread.start()
+        inbox = self.queues[self.sink_name]
+        last_report = clock()
+        while not self._stopped.is_set():
+            try:
+                packet = inbox.get(timeout=0.1)
+            except Empty:
+                packet = None
+            if packet is STOP:
+                break
+            if packet is not None:
+                start = clock()
+                self.sink(packet.value)
+                now = clock()
+                self.sink_busy += now - start
+                if not self.sink_items:
+                    self.first_finished = now
+                self.sink_items += 1
+                # Time from the frame leaving the socket to the command going out
+                self.latency_last = now - packet.created
+                self.latency_total += self.latency_last
+                self.latency_max = max(self.latency_max, self.latency_last)
+                if self.sink_histogram is not None:
+                    self.sink_histogram.record(now - start)
+                    self.latency_histogram.record(self.latency_last)
+                self.completed.append((packet.seq, packet.created, now))
+            if report_interval and clock() - last_report >= report_interval:
+                print(self.format_stats())
+                last_report = clock()
+        self.stop()
+        if self.source.error is not None:
+            print('Receive stage stopped: %r' % (self.source.error,))
+
+    def stats(self):
+        """Returns per stage item counts, busy time, queue depth and drops."""
+        workers = [self.source] + self.stages
+        stages = collections.OrderedDict(
+            (worker.name, {'items': worker.items, 'busy_seconds': worker.busy,
+                           'errors': getattr(worker, 'errors', 0)})
+            for worker in workers)
+        stages[self.sink_name] = {'items': self.sink_items, 'busy_seconds': self.sink_busy,
+                                  'errors': 0}
+        queues = collections.OrderedDict(
+            (name, {'depth': queue.qsize(), 'max_depth': queue.max_depth,
+                    'dropped': queue.dropped})
+            for name, queue in self.queues.items())
+        return {
+            'stages': stages,
+            'queues': queues,
+            'dropped': sum(queue.dropped for queue in self.queues.values()),
+            'latency_last': self.latency_last,
+            'latency_mean': self.latency_total / self.sink_items if self.sink_items else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    def format_stats(self):
+        """Returns stats() as a single log line."""
+        stats = self.stats()
+        queues = ' '.join(
+            '%s=%d/%d' % (name, queue['depth'], queue['dropped'])
+            for name, queue in stats['queues'].items())
+        return 'frames=%d dropped=%d queues(depth/dropped) %s latency ms last=%.1f mean=%.1f max=%.1f' % (
+            self.source.items, stats['dropped'], queues,
+            1000 * stats['latency_last'], 1000 * stats['latency_mean'],
+            1000 * stats['latency_max'])
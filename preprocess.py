@@ -0,0 +1,228 @@
+# Name:         preprocess.py
+# Description:  The one definition of how a camera frame becomes the model's
+#               input, shared by capture, training and every server.
+# Instructions: Capture with a spec, e.g. 'self_control_train.py --scale 2',
+#               or derive a smaller dataset from a full resolution one:
+#                   python preprocess.py training_data/dataset training_data/x2 --scale 2
+# Notes:        A spec is a region of interest (in decode.FRAME_SIZE pixels),
+#               a downsample factor and optional per-frame histogram
+#               equalization. It is written into every dataset's manifest
+#               and the manifest next to every trained model (see
+#               checkpoints.py), and read from .npz captures that hold one.
+#               The servers read it back from the model they load. Frames
+#               are always decoded at full resolution and then reduced by
+#               Preprocess.apply(), one integer block average for a whole
+#               stack of frames, so live frames get the very pixels the
+#               stored ones got (libjpeg's DCT scaling would not). Model
+#               inputs are the stored pixels times PIXEL_SCALE.
+#               The default spec is the original 320x120 crop, which is what
+#               datasets and models without one were made with.
+
+"""Shared region of interest, downsampling and equalization spec."""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from decode import CROP_BOX, FRAME_SIZE, crop_shape
+
+# Pixels are fed to the model in [0, 1]
+PIXEL_SCALE = 1 / 255.0
+CHUNK = 4096
+
+
+def equalize(frames):
+    """Returns the histogram equalized frames of a (N, height, width) uint8 stack."""
+    count = len(frames)
+    flat = frames.reshape(count, -1)
+    # One 256 bin histogram per frame from a single bincount
+    index = flat + (np.arange(count) * 256)[:, np.newaxis]
+    histograms = np.bincount(index.ravel(), minlength=256 * count).reshape(count, 256)
+    cdf = np.cumsum(histograms, axis=1)
+    darkest = cdf[np.arange(count), (histograms > 0).argmax(axis=1)][:, np.newaxis]
+    spread = np.maximum(flat.shape[1] - darkest, 1)
+    table = np.clip(np.rint((cdf - darkest) * 255.0 / spread), 0, 255).astype(np.uint8)
+    return table.ravel()[index].reshape(frames.shape)
+
+
+class Preprocess(object):
+    """Region of interest, downsample factor and equalization of the frames."""
+
+    def __init__(self, box=CROP_BOX, scale=1, equalize=False):
+        self.box = tuple(int(edge) for edge in box)
+        self.scale = int(scale)
+        self.equalize = bool(equalize)
+        left, upper, right, lower = self.box
+        if not (0 <= left < right <= FRAME_SIZE[0] and 0 <= upper < lower <= FRAME_SIZE[1]):
+            raise ValueError('Region %r is not inside the %dx%d frame' % ((self.box,) + FRAME_SIZE))
+        if self.scale < 1 or min(crop_shape(self.box, self.scale)) < 1:
+            raise ValueError('Cannot downsample region %r by %r' % (self.box, scale))
+        # (height, width) of the frames and their length as one row
+        self.shape = crop_shape(self.box, self.scale)
+        self.size = self.shape[0] * self.shape[1]
+
+    def __eq__(self, other):
+        return isinstance(other, Preprocess) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Preprocess(box=%r, scale=%d, equalize=%r)' % (self.box, self.scale, self.equalize)
+
+    def to_dict(self):
+        return {'box': list(self.box), 'scale': self.scale, 'equalize': self.equalize}
+
+    def _offset(self, source):
+        """Returns where the region starts within source, a full resolution box."""
+        left, upper = self.box[0] - source[0], self.box[1] - source[1]
+        if left < 0 or upper < 0 or self.box[2] > source[2] or self.box[3] > source[3]:
+            raise ValueError('Region %r is not inside %r' % (self.box, tuple(source)))
+        return left, upper
+
+    def apply(self, pixels, out=None, source=None):
+        """Reduces full resolution uint8 pixels of the box source (this
+        spec's own box by default) to this spec's frames.
+
+        pixels is one frame or a stack of them, (..., height, width) or
+        flattened to rows. The result has the same layout, or is written into
+        out, any array with size elements per frame: a float out gets model
+        inputs (pixels times PIXEL_SCALE), anything else the pixels.
+        """
+        source = tuple(source or self.box)
+        left, upper = self._offset(source)
+        height, width = crop_shape(source)
+        pixels = np.asarray(pixels)
+        frames = pixels.reshape(-1, height, width)
+        count = len(frames)
+        rows, columns = self.shape
+        scale = self.scale
+        region = frames[:, upper:upper + rows * scale, left:left + columns * scale]
+        if scale > 1:
+            # Rounded integer block means, the same on every machine
+            blocks = region.reshape(count, rows, scale, columns, scale).sum(
+                axis=(2, 4), dtype=np.uint32)
+            blocks += scale * scale // 2
+            blocks //= scale * scale
+            region = blocks.astype(np.uint8)
+        if self.equalize:
+            region = equalize(region)
+        if out is None:
+            if pixels.shape[-2:] == (height, width):
+                return np.array(region, np.uint8).reshape(pixels.shape[:-2] + self.shape)
+            return np.array(region, np.uint8).reshape(pixels.shape[:-1] + (self.size,))
+        np.copyto(out.reshape(count, rows, columns), region, casting='unsafe')
+        if out.dtype.kind == 'f':
+            out *= PIXEL_SCALE
+        return out
+
+    def decoder(self, name):
+        """Returns a function(payload, out=None) from payloads in the wire
+        format name (see wire_format.py) to this spec's frames.
+
+        The function reuses one full resolution buffer, so every thread
+        needs its own.
+        """
+        from wire_format import decoder
+        # Raw grayscale payloads only ever hold the original crop
+        source = self.box if name == 'jpeg' else CROP_BOX
+        self._offset(source)
+        decode = decoder(name, source)
+        full = np.empty(crop_shape(source), np.uint8)
+
+        def decode_frame(payload, out=None):
+            return self.apply(decode(payload, full), out, source)
+
+        return decode_frame
+
+
+def from_dict(value):
+    """Returns the spec value describes; None is the default spec."""
+    if value is None:
+        return Preprocess()
+    return Preprocess(value['box'], value['scale'], value['equalize'])
+
+
+def from_npz(data):
+    """Returns the spec of a .npz capture; old captures have none and get the default."""
+    if 'preprocess' not in data.files:
+        return Preprocess()
+    return from_dict(json.loads(str(data['preprocess'])))
+
+
+def for_model(model_file):
+    """Returns the spec model_file was trained with."""
+    from checkpoints import read_seen
+    seen = read_seen(model_file)
+    return from_dict(seen.get('preprocess') if seen else None)
+
+
+def add_arguments(parser):
+    """Adds the options that pick a spec."""
+    parser.add_argument(
+        '--roi',
+        dest='roi',
+        help='Region of interest as left,upper,right,lower in %dx%d frame pixels.' % FRAME_SIZE,
+        default=','.join(str(edge) for edge in CROP_BOX)
+    )
+    parser.add_argument(
+        '--scale',
+        dest='scale',
+        help='Downsample the region by this factor, e.g. 2 or 4.',
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        '--equalize',
+        dest='equalize',
+        help='Histogram equalize every frame.',
+        action='store_true'
+    )
+    return parser
+
+
+def from_args(args):
+    """Returns the spec add_arguments()' options describe."""
+    return Preprocess([int(edge) for edge in args.roi.split(',')], args.scale, args.equalize)
+
+
+def convert(source, output, spec, chunk=CHUNK):
+    """Writes every shard of the full resolution dataset source to output,
+    reduced to spec. Returns the new manifest."""
+    import dataset
+    data = dataset.Dataset(source)
+    if data.preprocess.scale != 1 or data.preprocess.equalize:
+        raise ValueError('%s is already reduced (%r)' % (source, data.preprocess))
+    if os.path.exists(os.path.join(output, dataset.MANIFEST)):
+        existing = from_dict(dataset.read_manifest(output).get('preprocess'))
+        if existing != spec:
+            raise ValueError('%s holds %r frames, not %r' % (output, existing, spec))
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    entries = []
+    for name, shard in zip(data.names, data.shards):
+        frames = np.empty((len(shard), spec.size), np.uint8)
+        for start in range(0, len(shard), chunk):
+            spec.apply(shard[start:start + chunk], frames[start:start + chunk],
+                       data.preprocess.box)
+        labels = data.labels[data.shard_indices([name])]
+        entries.append(dataset.write_shard(output, name, frames, labels, source=source))
+    return dataset.add_shards(output, entries, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reduce a dataset to a preprocessing spec.')
+    parser.add_argument(dest='source', help='Full resolution dataset directory.')
+    parser.add_argument(dest='output', help='Dataset directory to write.')
+    add_arguments(parser)
+    args = parser.parse_args()
+    spec = from_args(args)
+    manifest = convert(args.source, args.output, spec)
+    print('Wrote %d frames of %dx%d to %s' % (
+        sum(entry['frames'] for entry in manifest['shards']), spec.shape[1], spec.shape[0],
+        args.output))
+
+
+if __name__ == '__main__':
+    main()
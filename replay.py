@@ -0,0 +1,89 @@
+# Name:         replay.py
+# Description:  Replays a session recorded with --record by 'auto-driver.py' or
+#               'self_control_train.py'.
+# Instructions: Feed it back to a running server, like the Pi would:
+#                   python replay.py sessions/<session> -s 127.0.0.1 [--speed 4]
+#               or evaluate a model on it offline, as fast as possible:
+#                   python replay.py sessions/<session> --evaluate models/model.npz
+# Notes:        --speed 1 keeps the original frame timing, 4 is four times as
+#               fast and 0 sends as fast as the server will take them.
+
+import argparse
+
+import numpy as np
+
+from dispatcher import CLASS_COMMANDS
+from fake_camera import FakeCamera
+from frame_receiver import clock
+from session_log import ReplaySource, SessionReader
+
+
+def evaluate(session, model_file):
+    """Predicts every frame of session and compares with the recorded commands."""
+    from drive_loop import load_predictor
+    from preprocess import for_model
+    spec = for_model(model_file)
+    model = load_predictor(model_file, spec.size)
+    reader = SessionReader(session)
+    decode = spec.decoder(reader.format)
+    temp_array = np.empty((1, spec.size), np.float32)
+    decode_seconds = 0.0
+    infer_seconds = 0.0
+    compared = 0
+    agreed = 0
+    command = None
+    for seq, _, payload in reader:
+        start = clock()
+        decode(payload, temp_array)
+        decoded = clock()
+        predict = int(model.predict_classes(temp_array, verbose=0)[0])
+        infer_seconds += clock() - decoded
+        decode_seconds += decoded - start
+        # The command in effect is the last one decided at or before this frame
+        if seq in reader.commands:
+            command = reader.commands[seq][-1][1]
+        if command in CLASS_COMMANDS:
+            compared += 1
+            agreed += CLASS_COMMANDS[predict] == command
+    frames = len(reader)
+    reader.close()
+    seconds = decode_seconds + infer_seconds
+    print('Frames: %d in %.2f s (%.0f frames/s)' % (frames, seconds, frames / seconds if seconds else 0))
+    print('Per frame: decode %.3f ms, infer %.3f ms' % (
+        1000 * decode_seconds / max(frames, 1), 1000 * infer_seconds / max(frames, 1)))
+    if compared:
+        print('Agreement with recorded commands: %.1f%% of %d frames' % (100.0 * agreed / compared, compared))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Replay a recorded camera session.')
+    parser.add_argument(dest='session', help='Session directory.')
+    parser.add_argument('-s', '--server', dest='server', default='127.0.0.1',
+                        help='Server to stream the session to.')
+    parser.add_argument('-p', '--port', dest='port', default=8000, type=int,
+                        help='Port the server listens on.')
+    parser.add_argument('--speed', dest='speed', default=1.0, type=float,
+                        help='Playback speed, 0 for as fast as possible.')
+    parser.add_argument('--evaluate', dest='model', default=None,
+                        help='Evaluate this model offline instead of streaming.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    if args.model:
+        evaluate(args.session, args.model)
+        return
+    source = ReplaySource(args.session, args.speed)
+    camera = FakeCamera((args.server, args.port), source)
+    start = clock()
+    camera.start()
+    camera.join()
+    source.close()
+    if camera.error is not None:
+        print('Replay stopped: %s' % (camera.error,))
+    print('Replayed %d frames in %.1f s' % (len(camera.sent), clock() - start))
+
+
+if __name__ == '__main__':
+    main()
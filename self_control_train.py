@@ -8,74 +8,46 @@
 #               directly from https://github.com/bskari/pi-rc/blob/master/interactive_control.py
 # Notes:        I have made modifications to the code obtained from above in order
 #               to streamline the training process to work with pi-rc and Keras.
+#               With --headless pygame is never imported: the arrow keys are
+#               read from the terminal instead (see terminal_keys.py).
+#               Frames are received and decoded on their own thread; the
+#               window (see hud.py) is redrawn at most --hud-fps times a
+#               second and never holds up the stream. Frames are stored as
+#               --roi, --scale and --equalize prepare them (see preprocess.py)
+#               and the spec is saved with them. They are written to the
+#               --output dataset in the background as they are captured
+#               (see capture_writer.py), in shards named after the session.
 
-import pygame
-import pygame.font
 import numpy as np
 import socket
 import argparse
 import json
-import cStringIO
-import io
 
-from pygame.locals import *
-from common import dead_frequency
+from common import CommandChannel
+from common import load_configuration
 from common import server_up
-from PIL import Image, ImageFile
-from matplotlib import pyplot as plt 
-from numpy import ma
-from scipy import ndimage
+from frame_receiver import FrameReceiver
+from frame_receiver import clock as monotonic
+from capture_writer import CaptureWriter
+import dataset
+from dedupe import DISTANCE, DuplicateFilter
+from metrics import Metrics, add_arguments, from_args
+from wire_format import FORMATS
+from session_log import SessionRecorder, new_session_dir
+from pipeline import Empty, LatestQueue, Source, STOP
+import preprocess
+from PIL import ImageFile
 
 
 UP = LEFT = DOWN = RIGHT = False
 QUIT = False
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-
-# Name:        load_configuration(configuration_file)
-# Description: Generates a dict of JSON command messages for each movement.
-def load_configuration(configuration_file):
-    configuration = json.loads(configuration_file.read())
-    dead = dead_frequency(configuration['frequency'])
-    sync_command = {
-        'frequency': configuration['frequency'],
-        'dead_frequency': dead,
-        'burst_us': configuration['synchronization_burst_us'],
-        'spacing_us': configuration['synchronization_spacing_us'],
-        'repeats': configuration['total_synchronizations'],
-    }
-    base_command = {
-        'frequency': configuration['frequency'],
-        'dead_frequency': dead,
-        'burst_us': configuration['signal_burst_us'],
-        'spacing_us': configuration['signal_spacing_us'],
-    }
-    movement_to_command = {}
-    for key in (
-        'forward',
-        'forward_left',
-        'forward_right',
-        'left',
-        'reverse',
-        'reverse_left',
-        'reverse_right',
-        'right',
-    ):
-        command_dict = base_command.copy()
-        command_dict['repeats'] = configuration[key]
-        movement_to_command[key] = command_dict
-
-    direct_commands = {
-        key: json.dumps([sync_command, movement_to_command[key]])
-        for key in movement_to_command
-    }
-
-    # We also need to add an idle command; just broadcast at the dead frequency
-    command_dict = [base_command.copy()]
-    command_dict[0]['frequency'] = dead
-    command_dict[0]['repeats'] = 20  # Doesn't matter
-    direct_commands['idle'] = json.dumps(command_dict)
-
-    return direct_commands
+# Only imported when there is a window, see interactive_control()
+pygame = None
+# Most redraws of the window per second, and longest wait for a frame before
+# the keys are polled anyway
+HUD_FPS = 10
+POLL = 0.02
 
 # Name:        get_keys()
 # Description: Returns a tuple of (UP, DOWN, LEFT, RIGHT, changed) representing which
@@ -105,186 +77,235 @@ def get_keys():
 
     return (UP, DOWN, LEFT, RIGHT, change)
 
-# Name:        interactive_control(host, port, configuration)
+# Name:        interactive_control(host, port, configuration, record, dedupe, metrics,
+#                                  headless, listen, hud_fps, spec, output)
 # Description: Runs the interactive control.
-def interactive_control(host, port, configuration):
+def interactive_control(host, port, configuration, record=False, dedupe=DISTANCE, metrics=None,
+                        headless=False, listen='192.168.1.186', hud_fps=HUD_FPS, spec=None,
+                        output=dataset.DATASET_DIR):
+  # There are 4 commands: left, right, up, down which are stored as class
+  # indexes 0-3. They are one hot encoded when the data is trained on,
+  # e.g. [1 0 0 0] is label for 'Left'
+
+  # Image is 320x120 (or whatever spec makes of it) that is stored as one
+  # uint8 row vector. Frames are copied into fixed chunks and written to the
+  # dataset in the background, so storing a frame never waits on the disk.
+  # Near-identical frames (the car stopped or crawling) are not stored
+  spec = spec or preprocess.Preprocess()
+  duplicates = DuplicateFilter(dedupe, frame_shape=spec.shape) if dedupe >= 0 else None
+  writer = CaptureWriter(output, spec, duplicates)
+
+  if headless:
+    from terminal_keys import TerminalKeys
+    keys = TerminalKeys()
+    hud = None
+    print 'Arrows or w/a/s/d latch, space stops, q quits'
+  else:
+    keys = None
+    global pygame
+    import pygame
+    from hud import Hud
+    # Starting PyGame window to control RC Car
+    # Making it look pretty :-)
+    pygame.init()
+    hud = Hud(configuration, hud_fps)
+
   # Setting up server
   server_socket = socket.socket()
-  server_socket.bind(('192.168.1.186', 8000))
+  server_socket.bind((listen, 8000))
   server_socket.listen(0)
   
   # accept Raspberry Pi connection
-  connection = server_socket.accept()[0].makefile('rb')
-  
-  # Creating labels using one hot encoding method. There are 4 commands: 
-  # up, down, left, right, and therefore labels are 4 dimensional
-  # vectors. E.g. [1 0 0 0] is label for 'Left'
-  labels = np.zeros((4,4), 'float')
-  for i in range(4):
-    labels[i,i] = 1
-  
-  # The actual assignment of keypress to label
-  temp_label = np.zeros((1,4), 'float')
-
-  # Starting PyGame window to control RC Car
-  # Making it look pretty :-)
-  pygame.init()
-  size = (300, 400)
-  screen = pygame.display.set_mode(size)
-  # pylint: disable=too-many-function-args
-  background = pygame.Surface(screen.get_size())
-  clock = pygame.time.Clock()
-  black = (0, 0, 0)
-  white = (255, 255, 255)
-  big_font = pygame.font.Font(None, 40)
-  little_font = pygame.font.Font(None, 24)
-  pygame.display.set_caption('rc-pi interactive')
-  text = big_font.render('Use arrows to move', 1, white)
-  text_position = text.get_rect(centerx=size[0] / 2)
-  background.blit(text, text_position)
-  screen.blit(background, (0, 0))
-  pygame.display.flip()
-
-  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  connection = server_socket.accept()[0]
+  # Optionally keep the raw stream and every command on disk so the session
+  # can be replayed later (see replay.py)
+  recorder = SessionRecorder(new_session_dir()) if record else None
+  receiver = FrameReceiver(connection, recorder=recorder, formats=FORMATS)
+
+  # Commands are only sent when the keys change, so no keepalive or fail-safe;
+  # the timer just sends a change that came too soon after the last one.
+  channel = CommandChannel(host, port, configuration)
+  channel.start()
   
   # Assign send_inst to True initially; stream condition
   global send_inst
   send_inst = True
 
-  # Image is 320x120 that is reshaped into one row vector
-  # These are just empty containers so we can concatenate the images
-  # that we are using later.
-  image_array = np.zeros((1, 38400))
-  image_label = np.zeros((1,4), 'float')
   saved_frame = 0
-  total_frames = 0
+
+  # Time spent in each step of the loop, see metrics.py
+  metrics = metrics or Metrics()
+  metrics.add_source('receiver', receiver.stats)
+  metrics.add_source('channel', channel.stats)
+  metrics.add_source('writer', writer.stats)
+  receive_time = metrics.histogram('receive')
+  decode_time = metrics.histogram('decode')
+  keys_time = metrics.histogram('keys')
+  store_time = metrics.histogram('store')
+  send_time = metrics.histogram('send')
+  display_time = metrics.histogram('display')
+  frame_time = metrics.histogram('frame')
+
+  decoders = {}
+
+  # Name:        read_frame()
+  # Description: Receives and decodes the next frame on the ingest thread.
+  def read_frame():
+    # Each JPEG arrives behind a '<L' length header from the client
+    start = monotonic()
+    jpg = receiver.receive()
+    if jpg is None:
+      return None
+    received = monotonic()
+    receive_time.record(received - start)
+    # Decode the jpg to greyscale and reduce the interesting portion as spec
+    # says. A fresh array per frame since it is handed to the main thread.
+    # The format is agreed with the first frame.
+    if receiver.format not in decoders:
+      decoders[receiver.format] = spec.decoder(receiver.format)
+    image_crop = decoders[receiver.format](jpg, np.empty(spec.shape, np.uint8))
+    decode_time.record(monotonic() - received)
+    return receiver.frames - 1, image_crop
+
+  # This thresholding algorithm works but not at our implemenentation stage. So,
+  # I am using just simple greyscaling. The below threshold attempts to segment the 
+  # the color blue from any other colors.
+
+  # image = image[120:240, :, :]
+  # R = [(30,60),(30,60),(90,140)]
+  # red_range = np.logical_and(R[0][0] < image[:,:,0], image[:,:,0] < R[0][1])
+  # green_range = np.logical_and(R[1][0] < image[:,:,0], image[:,:,0] < R[1][1])
+  # blue_range = np.logical_and(R[2][0] < image[:,:,0], image[:,:,0] < R[2][1])
+  # valid_range = np.logical_and(red_range, green_range, blue_range)
+  # image.flags.writeable = True
+  # image[valid_range] = 200
+  # image[np.logical_not(valid_range)] = 0
+  # image_crop = image[:,:,2]
+
+  # Frames are received and decoded on their own thread and only the newest
+  # waits here, so neither the keys nor the window ever hold up the socket.
+  frames = LatestQueue(1)
+  source = Source('ingest', read_frame, frames)
+  source.start()
 
   while not QUIT:
       # Starting to collect images for training
       print 'Collecting images...'
-      # Image is 320x120 that is reshaped into one row vector
-      # image_array = np.zeros((1, 38400))
-      # image_label = np.zeros((1,4), 'float')
 
-      # Stream the image frame by frame
       try: 
-        stream_bytes = ' '
-        frame = 1
+        seq, image_crop = None, None
+        unsaved = None
         while send_inst:
-          stream_bytes += connection.read(1024)
-          # JPEG image files begin with FF D8 and end with FF D9
-          first = stream_bytes.find('\xff\xd8')
-          last = stream_bytes.find('\xff\xd9')
-          if first != -1 and last != -1:
-            jpg = stream_bytes[first:last + 2]
-            stream_bytes = stream_bytes[last + 2:]
-            # I use cStringIO to read the bytes wired in and use PIL to import this
-            # imformation into a jpg picture. 
-            image = Image.open(cStringIO.StringIO(jpg))
-            # Convert the jpg image to greyscale
-            image = image.convert(mode='L')
-            # Convert the jpg to numpy operable format 
-            image = np.array(np.asarray(image))
-            image_crop = image[120:240,:]
-            
-            # This thresholding algorithm works but not at our implemenentation stage. So,
-            # I am using just simple greyscaling. The below threshold attempts to segment the 
-            # the color blue from any other colors.
-
-            # image = image[120:240, :, :]
-            # R = [(30,60),(30,60),(90,140)]
-            # red_range = np.logical_and(R[0][0] < image[:,:,0], image[:,:,0] < R[0][1])
-            # green_range = np.logical_and(R[1][0] < image[:,:,0], image[:,:,0] < R[1][1])
-            # blue_range = np.logical_and(R[2][0] < image[:,:,0], image[:,:,0] < R[2][1])
-            # valid_range = np.logical_and(red_range, green_range, blue_range)
-            # image.flags.writeable = True
-            # image[valid_range] = 200
-            # image[np.logical_not(valid_range)] = 0
-            # image_crop = image[:,:,2]
-
-            temp_array = image_crop.reshape(1, 38400).astype(np.float32)
-
-            frame += 1
-            total_frames += 1
-
-            # After
+          # The keys and window are polled at least every POLL seconds, with
+          # or without new frames
+          try:
+            packet = frames.get(timeout=POLL)
+          except Empty:
+            packet = None
+          if packet is STOP:
+            break
+          start = monotonic()
+          if packet is not None:
+            seq, image_crop = packet.value
+
+          if keys is not None:
+            up, down, left, right, change = keys.get_keys()
+            if keys.quit:
+              break
+          else:
             up, down, left, right, change = get_keys()
-
-            if change:
-                # Something changed, so send a new command
-                command = 'idle'
-                
-                if up:
-                    command = 'forward'
-                    saved_frame += 1
-                    # Vertically concatenate this flattened image into the container made 
-                    # earlier. Do the same to the label. 
-                    image_array = np.vstack((image_array, temp_array))
-                    image_label = np.vstack((image_label, labels[2]))
-                    
-                elif down:
-                    command = 'reverse'
-                    saved_frame += 1
-                    image_array = np.vstack((image_array, temp_array))
-                    image_label = np.vstack((image_label, labels[3]))
-
-                append = lambda x: command + '_' + x if command != 'idle' else x
-
-                if left:
-                    command = append('left')
-                    saved_frame += 1
-                    image_array = np.vstack((image_array, temp_array))
-                    image_label = np.vstack((image_label, labels[0]))
-                elif right:
-                    command = append('right')
-                    saved_frame += 1
-                    image_array = np.vstack((image_array, temp_array))
-                    image_label = np.vstack((image_label, labels[1]))
-
-                print(command)
-                try:
-                    sock.sendto(configuration[command], (host, port))
-                except TypeError:
-                    # Windows + Python 3 workaround?
-                    sock.sendto(bytes(configuration[command], 'utf-8'), (host, port))
-
-                # Show the command and JSON
-                background.fill(black)
-                text = big_font.render(command, 1, white)
-                text_position = text.get_rect(centerx=size[0] / 2)
-                background.blit(text, text_position)
-
-                pretty = json.dumps(json.loads(configuration[command]), indent=4)
-                pretty_y_position = big_font.size(command)[1] + 10
-                for line in pretty.split('\n'):
-                    text = little_font.render(line, 1, white)
-                    text_position = text.get_rect(x=0, y=pretty_y_position)
-                    pretty_y_position += little_font.size(line)[1]
-                    background.blit(text, text_position)
-
-                screen.blit(background, (0, 0))
-                pygame.display.flip()
-            
-            # Limit to 20 frames per second
-            clock.tick(60)
-
-        # Since both containers' first entry are zeros, don't use that. 
-        train = image_array[1:,:]
-        training_labels = image_label[1:,:]
-
-        # Saving images and labels to disk
+          step = monotonic()
+          keys_time.record(step - start)
+
+          if change:
+              # Something changed, so send a new command
+              command = 'idle'
+              # Class indexes of the keys held, stored with the next new frame
+              labels = []
+
+              if up:
+                  command = 'forward'
+                  labels.append(2)
+              elif down:
+                  command = 'reverse'
+                  labels.append(3)
+
+              append = lambda x: command + '_' + x if command != 'idle' else x
+
+              if left:
+                  command = append('left')
+                  labels.append(0)
+              elif right:
+                  command = append('right')
+                  labels.append(1)
+              unsaved = labels
+
+              print(command)
+              if recorder is not None and seq is not None:
+                  recorder.record_command(seq, command)
+              step = monotonic()
+              channel.send(command)
+              send_time.record(monotonic() - step)
+
+              if hud is not None:
+                hud.show(command)
+
+          if unsaved and packet is not None:
+              # Only a frame that arrived since the change is stored, never
+              # the last one again, so one change gives one sample per key
+              step = monotonic()
+              for label in unsaved:
+                  saved_frame += 1
+                  # Copy this flattened image and its label into the writer's chunk
+                  writer.append(image_crop, label)
+              unsaved = None
+              store_time.record(monotonic() - step)
+
+          if hud is not None:
+            # Capped to --hud-fps and only when the command changed
+            step = monotonic()
+            if hud.render():
+              display_time.record(monotonic() - step)
+          frame_time.record(monotonic() - start)
+
+        total_frames = receiver.frames
+        # Writing out the last frames and labels
         print 'Saving data...'
-        np.savez('training_data/test.npz', train=train, train_labels = training_labels)
+        writer.close()
 
         print 'Total Frames:', total_frames
         print 'Saved Frames:', saved_frame
         print 'Dropped Frames:', total_frames - saved_frame
+        if duplicates is not None:
+          print 'Near duplicates not stored:', duplicates.stats()
+        print 'Stored Frames:', writer.written, 'in', output, 'as', writer.session
+        if writer.dropped:
+          print 'Frames dropped while the disk fell behind:', writer.dropped
+        if writer.lost:
+          print 'Frames lost to a write error:', writer.lost, writer.error
+        print 'Frames skipped by the control loop:', frames.dropped
+        if source.error is not None:
+          print 'Receive stage stopped: %r' % (source.error,)
+        print 'Receiver stats:', receiver.stats()
+        print 'Command stats:', channel.stats()
+        print metrics.format_line()
+        break
 
       finally: 
+        source.stopped.set()
+        writer.close()
+        channel.idle()
+        channel.close()
         connection.close()
         server_socket.close()
+        if keys is not None:
+          keys.close()
+        if recorder is not None:
+          recorder.close()
+          print 'Session recorded to', recorder.directory
 
-  pygame.quit()
+  if not headless:
+    pygame.quit()
 
 # Name:         make_parser()
 # Description:  Builds and returns an argument parser.
@@ -311,6 +332,50 @@ def make_parser():
         help='The server to send control commands to.',
         default='127.1'
     )
+    parser.add_argument(
+        '-r',
+        '--record',
+        dest='record',
+        help='Record the raw camera stream and commands under sessions/.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--dedupe',
+        dest='dedupe',
+        help='Skip frames within this many hash bits of a recent frame with '
+             'the same label; -1 keeps every frame.',
+        default=DISTANCE,
+        type=int
+    )
+    parser.add_argument(
+        '--headless',
+        dest='headless',
+        help='No pygame window; steer with the arrow keys in this terminal.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-l',
+        '--listen',
+        dest='listen',
+        help='Address to accept the Raspberry Pi camera stream on.',
+        default='192.168.1.186'
+    )
+    parser.add_argument(
+        '--hud-fps',
+        dest='hud_fps',
+        help='Most redraws of the pygame window per second; 0 never redraws it.',
+        default=HUD_FPS,
+        type=float
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        dest='output',
+        help='Dataset directory the captured frames are added to.',
+        default=dataset.DATASET_DIR
+    )
+    preprocess.add_arguments(parser)
+    add_arguments(parser)
     return parser
 
 # Name:         main()
@@ -330,7 +395,9 @@ def main():
         print('Server does not appear to be listening for messages, aborting')
         return
 
-    interactive_control(args.server, args.port, configuration)
+    interactive_control(args.server, args.port, configuration, args.record, args.dedupe,
+                        from_args(args), args.headless, args.listen, args.hud_fps,
+                        preprocess.from_args(args), args.output)
 
 # This is a standard boilerplate function
 if __name__ == '__main__':
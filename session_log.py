@@ -0,0 +1,165 @@
+# Name:         session_log.py
+# Description:  Append-only on-disk log of a raw camera session, and a reader
+#               to replay it.
+# Notes:        A session is a directory holding
+#                 frames.stream  the JPEGs exactly as they came off the wire,
+#                                each behind a '<L' length header, so any
+#                                FrameReceiver can read it back
+#                 index.bin      one '<IQId' record per frame: seq, byte
+#                                offset of the JPEG, size, receive time
+#                 commands.txt   one 'seq time command sent' line per command
+#                                decision, sent is 0 when it was suppressed
+#                 format         the wire format of the frames when it is not
+#                                'jpeg' (see 'wire_format.py')
+#               Everything is only ever appended, so a crash loses at most
+#               what was still in the write buffers.
+
+"""Record and replay of raw camera sessions."""
+import os
+import struct
+import time
+
+from frame_receiver import HEADER, clock
+
+INDEX = struct.Struct('<IQId')
+FRAMES_FILE = 'frames.stream'
+INDEX_FILE = 'index.bin'
+COMMANDS_FILE = 'commands.txt'
+FORMAT_FILE = 'format'
+SESSIONS_DIR = 'sessions'
+
+
+def new_session_dir(root=SESSIONS_DIR):
+    """Returns a fresh, unique session directory name under root."""
+    return os.path.join(root, '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+
+class SessionRecorder(object):
+    """Appends frames and command decisions to a session directory."""
+
+    def __init__(self, directory, flush_interval=1.0):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self._frames = open(os.path.join(directory, FRAMES_FILE), 'ab')
+        self._index = open(os.path.join(directory, INDEX_FILE), 'ab')
+        self._commands = open(os.path.join(directory, COMMANDS_FILE), 'a')
+        self.offset = self._frames.tell()
+        self.frames = os.path.getsize(os.path.join(directory, INDEX_FILE)) // INDEX.size
+        self.flush_interval = flush_interval
+        self._last_flush = clock()
+
+    def record_frame(self, jpg, received=None):
+        """Appends one JPEG, returning its sequence number."""
+        seq = self.frames
+        size = len(jpg)
+        self._frames.write(HEADER.pack(size))
+        self._frames.write(jpg)
+        self._index.write(INDEX.pack(seq, self.offset + HEADER.size, size,
+                                     clock() if received is None else received))
+        self.offset += HEADER.size + size
+        self.frames += 1
+        if clock() - self._last_flush >= self.flush_interval:
+            self.flush()
+        return seq
+
+    def set_format(self, name):
+        """Notes the wire format the frames are recorded in."""
+        with open(os.path.join(self.directory, FORMAT_FILE), 'w') as format_file:
+            format_file.write(name + '\n')
+
+    def record_command(self, seq, command, sent=True, at=None):
+        """Notes the command decided for frame seq."""
+        self._commands.write('%d %.6f %s %d\n' % (
+            seq, clock() if at is None else at, command, 1 if sent else 0))
+
+    def flush(self):
+        for log in (self._frames, self._index, self._commands):
+            log.flush()
+        self._last_flush = clock()
+
+    def close(self):
+        # No end-of-stream header, so the session can be appended to later
+        for log in (self._frames, self._index, self._commands):
+            log.close()
+
+
+class SessionReader(object):
+    """Random and sequential access to a recorded session."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE), 'rb') as index_file:
+            data = index_file.read()
+        # A crash can leave half a record at the end; ignore it
+        count = len(data) // INDEX.size
+        self.index = [INDEX.unpack_from(data, i * INDEX.size) for i in range(count)]
+        self.commands = {}
+        path = os.path.join(directory, COMMANDS_FILE)
+        if os.path.exists(path):
+            with open(path) as commands_file:
+                for line in commands_file:
+                    fields = line.split()
+                    if len(fields) == 4:
+                        self.commands.setdefault(int(fields[0]), []).append(
+                            (float(fields[1]), fields[2], fields[3] == '1'))
+        self.format = 'jpeg'
+        path = os.path.join(directory, FORMAT_FILE)
+        if os.path.exists(path):
+            with open(path) as format_file:
+                self.format = format_file.read().strip()
+        self._frames = open(os.path.join(directory, FRAMES_FILE), 'rb')
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, position):
+        """Returns (seq, receive time, JPEG bytes) of the position'th frame."""
+        seq, offset, size, received = self.index[position]
+        self._frames.seek(offset)
+        return seq, received, self._frames.read(size)
+
+    def __iter__(self):
+        for position in range(len(self.index)):
+            yield self.frame(position)
+
+    def close(self):
+        self._frames.close()
+
+
+class ReplaySource(object):
+    """Camera source that replays a session's JPEGs.
+
+    speed 1 keeps the original frame timing, 4 plays four times as fast and
+    0 as fast as possible.
+    """
+
+    def __init__(self, directory, speed=1.0, loop=False):
+        self.reader = SessionReader(directory)
+        if self.reader.format != 'jpeg':
+            raise ValueError('%s holds %s frames; only JPEG sessions can be streamed' % (
+                directory, self.reader.format))
+        self.speed = speed
+        self.loop = loop
+
+    def __iter__(self):
+        while True:
+            start = None
+            first = None
+            for _, received, jpeg in self.reader:
+                if self.speed:
+                    if start is None:
+                        start, first = clock(), received
+                    delay = start + (received - first) / self.speed - clock()
+                    if delay > 0:
+                        time.sleep(delay)
+                yield jpeg
+            if not self.loop or not len(self.reader):
+                return
+
+    def close(self):
+        self.reader.close()
+
+
+def is_session(path):
+    return os.path.exists(os.path.join(path, INDEX_FILE))
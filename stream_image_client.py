@@ -2,42 +2,218 @@
 # Description:  Allows the Raspberry Pi to act as streaming client, sending
 #               jpegs to an ip destination, where the server will collect JPEGs
 #               off the network.
+# Instructions: python stream_image_client.py
+#               or, to drive on the Pi itself with a model from export_model.py:
+#               python stream_image_client.py --drive models/model.npz --control lambo.json
+# Notes:        In --drive mode each frame is preprocessed and predicted on the
+#               Pi and the command goes straight to pi_pcm, so a decision costs
+#               no network round trip. Thumbnails can still be streamed to
+#               'monitor_viewer.py' with --monitor, on their own port so they
+#               never reach a driving server. --source picks the camera:
+#               'picamera', 'synthetic' or a directory/stream file to replay,
+#               so both modes also run on a plain Linux box. With --adapt the
+#               client asks for the server's feedback (see 'feedback.py') and
+#               lowers the frame rate, JPEG quality and resolution while the
+#               server falls behind. --format gray (or zgray) asks the server
+#               to take only the model's region as raw grayscale instead of
+#               JPEGs; the Pi camera then captures unencoded YUV frames.
 
 # Reference:    PiCamera documentation
 #               https://picamera.readthedocs.org/en/release-1.10/recipes2.html
 
+import argparse
 import io
 import socket
 import struct
 import time
-import picamera
-
-
-# Creating a socket and streams to ip address
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client_socket.connect(('192.168.1.101', 8000))
-connection = client_socket.makefile('wb') 
-
-try:
-    with picamera.PiCamera() as camera:
-        camera.resolution = (320, 240)  # Using QVGA as resolution; smaller size
-        camera.framerate = 10           # Attempt 10 frames per second, can increase
-        #camera.start_preview()
-        time.sleep(3)                   # Give camera three seconds to warm up. 
-        start = time.time()     
-        stream = io.BytesIO()
-        
-        # Sending JPEGs in video stream
-        for foo in camera.capture_continuous(stream, 'jpeg', use_video_port = True):
-            connection.write(struct.pack('<L', stream.tell()))
-            connection.flush()
-            stream.seek(0)
-            connection.write(stream.read())
-            if time.time() - start > 600:  # Turn off connection after 10 minutes
-                break
-            stream.seek(0)
-            stream.truncate()
+
+import numpy as np
+from PIL import Image
+
+from camera import gray_frames, open_source
+from frame_receiver import clock
+from monitor_viewer import MONITOR_PORT
+from wire_format import FORMATS, encoder, negotiate
+
+
+# Name:         stream(connection, frames, duration, controller, encode)
+# Description:  Sends every frame behind a '<L' length header until duration
+#               seconds have passed (0: until the frames end). encode turns a
+#               frame into the agreed wire format (see 'wire_format.py');
+#               controller, if given, is told about every frame sent.
+def stream(connection, frames, duration, controller=None, encode=None):
+    start = time.time()
+    # Sending JPEGs (or raw grayscale) in video stream
+    for frame in frames:
+        payload = encode(frame) if encode is not None else frame
+        connection.write(struct.pack('<L', len(payload)))
+        connection.write(payload)
+        connection.flush()
+        if controller is not None:
+            controller.sent()
+        if duration and time.time() - start > duration:  # Turn off connection after duration
+            break
     connection.write(struct.pack('<L', 0))
-finally:
-    connection.close()
-    client_socket.close()
\ No newline at end of file
+
+
+# Name:         thumbnail(jpeg, size)
+# Description:  Returns a small JPEG of the frame for monitoring.
+def thumbnail(jpeg, size=(80, 60), quality=50):
+    image = Image.open(io.BytesIO(jpeg))
+    image.draft('RGB', size)
+    image.thumbnail(size)
+    output = io.BytesIO()
+    image.save(output, 'jpeg', quality=quality)
+    return output.getvalue()
+
+
+# Name:         drive(source, model, dispatcher, duration, monitor, monitor_every, spec)
+# Description:  Predicts on every frame locally and sends the command to pi_pcm.
+#               Frames are reduced as spec (see 'preprocess.py') says, the
+#               original crop by default. Every monitor_every frames a
+#               thumbnail goes to monitor, if given.
+def drive(source, model, dispatcher, duration, monitor=None, monitor_every=5, spec=None):
+    from preprocess import Preprocess
+    spec = spec or Preprocess()
+    decode = spec.decoder('jpeg')
+    temp_array = np.empty((1, spec.size), np.float32)
+    start = time.time()
+    frames = 0
+    busy = 0.0
+    for jpeg in source:
+        captured = clock()
+        decode(jpeg, temp_array)
+        predict = int(model.predict_classes(temp_array)[0])
+        dispatcher.dispatch(predict, captured)
+        busy += clock() - captured
+        frames += 1
+        if monitor is not None and frames % monitor_every == 0:
+            small = thumbnail(jpeg)
+            monitor.write(struct.pack('<L', len(small)))
+            monitor.write(small)
+            monitor.flush()
+        if duration and time.time() - start > duration:
+            break
+    if monitor is not None:
+        monitor.write(struct.pack('<L', 0))
+    print('Frames: %d, mean frame to command: %.1f ms' % (
+        frames, 1000.0 * busy / frames if frames else 0.0))
+    print('Dispatcher stats: %s' % (dispatcher.stats(),))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description='Streams the Pi camera to a server or drives on the Pi.'
+    )
+    parser.add_argument('-s', '--server', dest='server', default='192.168.1.101',
+                        help='Server to stream frames to.')
+    parser.add_argument('-p', '--port', dest='port', default=8000, type=int,
+                        help='Port the server listens on.')
+    parser.add_argument('--source', dest='source', default='picamera',
+                        help="'picamera', 'synthetic' or a JPEG directory/stream file.")
+    parser.add_argument('--framerate', dest='framerate', default=10, type=int,
+                        help='Frames per second, can increase.')
+    parser.add_argument('--duration', dest='duration', default=600, type=float,
+                        help='Seconds to run for, 0 for no limit.')
+    parser.add_argument('--format', dest='format', default='jpeg',
+                        choices=FORMATS,
+                        help="Wire format to ask the server for: the full JPEG, or only the "
+                             "model's region as raw (or zlib compressed) grayscale.")
+    parser.add_argument('--adapt', dest='adapt', action='store_true',
+                        help="Follow the server's feedback: lower the frame rate, then the "
+                             "quality, then the resolution when it falls behind.")
+    parser.add_argument('--min-framerate', dest='min_framerate', default=2, type=int,
+                        help='Lowest frame rate --adapt may pick.')
+    parser.add_argument('--max-framerate', dest='max_framerate', default=30, type=int,
+                        help='Highest frame rate --adapt may pick.')
+    parser.add_argument('--quality', dest='quality', default=85, type=int,
+                        help='JPEG quality, and the highest --adapt may pick.')
+    parser.add_argument('--min-quality', dest='min_quality', default=40, type=int,
+                        help='Lowest JPEG quality --adapt may pick.')
+    parser.add_argument('--min-width', dest='min_width', default=160, type=int,
+                        help='Narrowest resolution --adapt may pick (4:3).')
+    parser.add_argument('--target-latency', dest='target_latency', default=0.2, type=float,
+                        help='Capture to action seconds --adapt tries to stay under.')
+    parser.add_argument('--drive', dest='drive', default=None,
+                        help='Exported .npz model; predict on the Pi instead of streaming.')
+    parser.add_argument('--control', dest='control_file', default='lambo.json',
+                        help='JSON control file for the RC car (--drive).')
+    parser.add_argument('--pcm-host', dest='pcm_host', default='127.0.0.1',
+                        help='pi_pcm host (--drive).')
+    parser.add_argument('--pcm-port', dest='pcm_port', default=12345, type=int,
+                        help='pi_pcm port (--drive).')
+    parser.add_argument('--monitor', dest='monitor', action='store_true',
+                        help="Also stream thumbnails to 'monitor_viewer.py' (--drive).")
+    parser.add_argument('--monitor-host', dest='monitor_host', default=None,
+                        help='Host running monitor_viewer.py, --server by default.')
+    parser.add_argument('--monitor-port', dest='monitor_port', default=MONITOR_PORT, type=int,
+                        help='Port monitor_viewer.py listens on.')
+    return parser
+
+
+def main():
+    parser = make_parser()
+    args = parser.parse_args()
+    monitor_address = (args.monitor_host or args.server, args.monitor_port)
+    if args.monitor and monitor_address == (args.server, args.port):
+        # A driving server would take the thumbnails for frames to drive on
+        parser.error('--monitor must not go to the driving server at %s:%d' % monitor_address)
+    # Using QVGA as resolution; smaller size
+    source = open_source(args.source, (320, 240), args.framerate)
+    client_socket = None
+    connection = None
+    try:
+        if args.drive is None or args.monitor:
+            # Creating a socket and streams to ip address
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client_socket.connect((args.server, args.port) if args.drive is None
+                                  else monitor_address)
+            connection = client_socket.makefile('wb')
+        if args.drive is None:
+            adapt = args.adapt and hasattr(source, 'configure')
+            if args.adapt and not adapt:
+                print('--adapt: this source cannot change its settings, ignoring')
+            # Settled before anything else reads from the socket; the server
+            # only sends feedback when asked for it here
+            wire_format = negotiate(client_socket, [args.format] + (
+                ['jpeg'] if args.format != 'jpeg' else []), feedback=adapt)
+            print('Streaming %s frames' % wire_format)
+            controller = None
+            if adapt:
+                from feedback import RESOLUTIONS, FeedbackReader, RateController
+                controller = RateController(
+                    source, args.framerate, args.min_framerate, args.max_framerate,
+                    args.quality, args.min_quality, args.quality,
+                    [size for size in RESOLUTIONS if size[0] >= args.min_width],
+                    args.target_latency)
+                FeedbackReader(client_socket, controller).start()
+            frames = source if wire_format == 'jpeg' else gray_frames(source)
+            stream(connection, frames, args.duration, controller, encoder(wire_format))
+        else:
+            from common import load_configuration
+            from dispatcher import CommandDispatcher
+            from drive_loop import load_predictor
+            from preprocess import for_model
+            # The model's inputs are whatever its training frames were reduced to
+            spec = for_model(args.drive)
+            model = load_predictor(args.drive, spec.size)
+            print('Model inputs: %r' % (spec,))
+            with open(args.control_file) as configuration_file:
+                configuration = load_configuration(configuration_file)
+            dispatcher = CommandDispatcher(args.pcm_host, args.pcm_port, configuration,
+                                           failsafe=1.0)
+            try:
+                drive(source, model, dispatcher, args.duration, connection, spec=spec)
+            finally:
+                dispatcher.idle()
+                dispatcher.close()
+    finally:
+        source.close()
+        if connection is not None:
+            connection.close()
+        if client_socket is not None:
+            client_socket.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+# Name:         sweep.py
+# Description:  Trains many 'train.py' style models in parallel and ranks them
+#               by validation accuracy and per-frame inference latency.
+# Instructions: python sweep.py --units 32 64 128 256 512 --batch-size 256 512
+#                   --epochs 20 50 [--trials 10] [--workers 2] [--json sweep.json]
+#               Needs a dataset written by convert_npz.py.
+# Notes:        Without --trials every combination of the given values is
+#               run, with it that many distinct combinations picked at random.
+#               Each trial runs in its own worker process, streaming batches
+#               from the memory mapped dataset (one copy in the page cache for
+#               all of them) against the same held out validation frames.
+#               A trial is stopped early when its best validation accuracy
+#               after --grace epochs is below the median the other trials
+#               had reached at that epoch. Latency is measured with the
+#               trial's model exported for 'mlp.py', which is what drives,
+#               one trial after another once all of them have finished
+#               training, so no trial is timed while others load the CPUs.
+
+"""Parallel hyperparameter sweep runner."""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import batches
+import checkpoints
+import dataset
+from bench_inference import latency_ms
+from frame_receiver import clock
+from preprocess import PIXEL_SCALE
+
+# Results table headers; a * under pareto means no other trial is both
+# more accurate and faster
+HEADERS = ('rank', 'units', 'layers', 'batch', 'epochs', 'lr', 'run', 'val_acc',
+           'latency_ms', 'train_s', 'pareto')
+
+# State of a worker process, set up by _start_worker
+_worker = {}
+
+
+def space(args):
+    """Returns every combination of the searched values, as dicts."""
+    names = ('units', 'layers', 'batch_size', 'epochs', 'learning_rate')
+    values = [args.units, args.layers, args.batch_size, args.epochs, args.learning_rate]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def pick(configurations, trials, seed=None):
+    """Returns trials distinct configurations at random, all of them if trials is None."""
+    if trials is None or trials >= len(configurations):
+        return list(configurations)
+    chosen = np.random.RandomState(seed).choice(len(configurations), trials, replace=False)
+    return [configurations[index] for index in sorted(chosen)]
+
+
+def build_model(input_dim, num_classes, units, layers, learning_rate):
+    """Returns the compiled train.py architecture with layers hidden Dense/PReLU pairs."""
+    from keras.models import Sequential
+    from keras.layers import Dense, Activation, advanced_activations
+    from keras.optimizers import SGD
+
+    model = Sequential()
+    for layer in range(layers):
+        if layer == 0:
+            model.add(Dense(units, input_dim=input_dim, init='lecun_uniform'))
+        else:
+            model.add(Dense(units, init='lecun_uniform'))
+        model.add(advanced_activations.PReLU(init='zero', weights=None))
+    model.add(Dense(num_classes, init='lecun_uniform'))
+    model.add(Activation('softmax'))
+    model.compile(optimizer=SGD(lr=learning_rate), loss='categorical_crossentropy',
+                  metrics=['accuracy'])
+    return model
+
+
+def median_stopper(progress, lock, grace):
+    """Returns a Keras callback stopping the trial once it is losing.
+
+    progress maps each epoch to the best validation accuracies trials had
+    reached by then; it is shared by all workers through a manager.
+    """
+    from keras.callbacks import Callback
+
+    class MedianStopper(Callback):
+        def __init__(self):
+            Callback.__init__(self)
+            self.best = 0.0
+            self.history = []
+            self.stopped_at = None
+
+        def on_epoch_end(self, epoch, logs=None):
+            accuracy = (logs or {}).get('val_acc', 0.0)
+            self.best = max(self.best, accuracy)
+            self.history.append(float(accuracy))
+            with lock:
+                others = progress.get(epoch, [])
+                progress[epoch] = others + [self.best]
+            if epoch + 1 >= grace and len(others) >= 2 and self.best < np.median(others):
+                self.stopped_at = epoch + 1
+                self.model.stop_training = True
+
+    return MedianStopper()
+
+
+def _start_worker(directory, validation_split, seed):
+    data = dataset.Dataset(directory)
+    train_indices, validation_indices = batches.split(len(data), validation_split, seed)
+    _worker['data'] = data
+    _worker['train'] = train_indices
+    _worker['validation'] = (data.load(validation_indices),
+                             dataset.one_hot(data.labels[validation_indices],
+                                             data.num_classes))
+
+
+def run_trial(job):
+    """Trains one configuration, returns its result row."""
+    trial, configuration, progress, lock, grace, models, scratch, seed = job
+    from export_model import export
+
+    data = _worker['data']
+    validation = _worker['validation']
+    result = dict(configuration, trial=trial)
+    start = clock()
+    model = build_model(data.frame_size, data.num_classes, configuration['units'],
+                        configuration['layers'], configuration['learning_rate'])
+    stopper = median_stopper(progress, lock, grace)
+    training = batches.BatchGenerator(data, _worker['train'],
+                                      batch_size=configuration['batch_size'], seed=seed)
+    try:
+        model.fit_generator(
+            training,
+            samples_per_epoch=training.samples,
+            nb_epoch=configuration['epochs'],
+            validation_data=validation,
+            callbacks=[stopper],
+            max_q_size=2,
+            verbose=0,
+        )
+    finally:
+        training.close()
+    result['train_seconds'] = clock() - start
+    result['epochs_run'] = len(stopper.history)
+    result['stopped_early'] = stopper.stopped_at is not None
+    result['val_acc'] = stopper.best
+    result['val_acc_history'] = stopper.history
+
+    # Timed by the parent once every trial is done, see measure_latency()
+    result['exported'] = os.path.join(scratch, 'trial-%03d.npz' % trial)
+    export(model, result['exported'])
+    if models:
+        name = os.path.join(models, 'trial-%03d' % trial)
+        model.save(name + '.h5')
+        shutil.copy(result['exported'], name + '.npz')
+        # Both share name.json, which tells the servers the model's inputs
+        checkpoints.write_seen(name + '.h5', data.directory, data.names,
+                               len(_worker['train']), result['epochs_run'],
+                               preprocess=data.preprocess)
+    return result
+
+
+def measure_latency(results, frame, repeats=500):
+    """Times every trial's exported model on frame, one after another."""
+    from mlp import NumpyModel
+    for row in results:
+        numpy_model = NumpyModel(row.pop('exported'))
+        row['latency_ms'] = latency_ms(numpy_model.predict, frame, repeats)
+    return results
+
+
+def rank(results):
+    """Sorts results by accuracy, then latency, and marks the Pareto front:
+    trials no other trial beats on both."""
+    results = sorted(results, key=lambda row: (-row['val_acc'], row['latency_ms']))
+    fastest = None
+    for position, row in enumerate(results):
+        row['rank'] = position + 1
+        # Everything ranked above is at least as accurate
+        row['pareto'] = fastest is None or row['latency_ms'] < fastest
+        fastest = row['latency_ms'] if fastest is None else min(fastest, row['latency_ms'])
+    return results
+
+
+def format_table(results):
+    lines = ['%4s %5s %6s %5s %6s %8s %4s %7s %10s %8s %6s' % HEADERS]
+    for row in results:
+        lines.append('%4d %5d %6d %5d %6d %8g %4d %6.2f%% %10.3f %8.0f %6s' % (
+            row['rank'], row['units'], row['layers'], row['batch_size'], row['epochs'],
+            row['learning_rate'], row['epochs_run'], 100 * row['val_acc'],
+            row['latency_ms'], row['train_seconds'], '*' if row['pareto'] else ''))
+    return '\n'.join(lines)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter sweep over train.py models.')
+    parser.add_argument('--dataset', dest='dataset', default=dataset.DATASET_DIR,
+                        help='Dataset directory written by convert_npz.py.')
+    parser.add_argument('--units', dest='units', default=[32, 64, 128, 256, 512], type=int,
+                        nargs='+', help='Neurons per hidden layer to try.')
+    parser.add_argument('--layers', dest='layers', default=[2], type=int, nargs='+',
+                        help='Hidden layer counts to try.')
+    parser.add_argument('--batch-size', dest='batch_size', default=[256, 512], type=int,
+                        nargs='+', help='Batch sizes to try.')
+    parser.add_argument('--epochs', dest='epochs', default=[20, 50], type=int, nargs='+',
+                        help='Most epochs per trial to try.')
+    parser.add_argument('--learning-rate', dest='learning_rate', default=[0.01], type=float,
+                        nargs='+', help='SGD learning rates to try.')
+    parser.add_argument('--trials', dest='trials', default=None, type=int,
+                        help='Random search: run this many combinations instead of all.')
+    parser.add_argument('--workers', dest='workers', default=max(1, multiprocessing.cpu_count() // 2),
+                        type=int, help='Trials trained at the same time.')
+    parser.add_argument('--grace', dest='grace', default=5, type=int,
+                        help='Epochs every trial runs before it can be stopped early.')
+    parser.add_argument('--validation-split', dest='validation_split', default=0.025,
+                        type=float, help='Fraction of frames held out, as in train.py.')
+    parser.add_argument('--seed', dest='seed', default=0, type=int,
+                        help='Seed for the validation split and random search.')
+    parser.add_argument('--models', dest='models', default=None,
+                        help='Also save every trial model (.h5 and .npz) to this directory.')
+    parser.add_argument('--json', dest='json_file', default=None,
+                        help='Also write the ranked results to this JSON file.')
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    if not os.path.exists(os.path.join(args.dataset, dataset.MANIFEST)):
+        print('The sweep needs a dataset, run convert_npz.py first')
+        return
+    if args.models and not os.path.isdir(args.models):
+        os.makedirs(args.models)
+    configurations = pick(space(args), args.trials, args.seed)
+    print('%d trials in %d workers' % (len(configurations), args.workers))
+
+    manager = multiprocessing.Manager()
+    progress = manager.dict()
+    lock = manager.Lock()
+    # The exported models wait here for measure_latency()
+    scratch = tempfile.mkdtemp()
+    jobs = [(trial, configuration, progress, lock, args.grace, args.models, scratch,
+             args.seed + trial)
+            for trial, configuration in enumerate(configurations)]
+    # A fresh process per trial gives every model all of its memory back
+    pool = multiprocessing.Pool(args.workers, _start_worker,
+                                (args.dataset, args.validation_split, args.seed),
+                                maxtasksperchild=1)
+    start = time.time()
+    results = []
+    try:
+        try:
+            for result in pool.imap_unordered(run_trial, jobs):
+                results.append(result)
+                print('Trial %d: %s, %.2f%% after %d epochs%s' % (
+                    result['trial'], ' '.join('%s=%s' % item for item in sorted(
+                        (key, result[key]) for key in configurations[0])),
+                    100 * result['val_acc'], result['epochs_run'],
+                    ' (stopped early)' if result['stopped_early'] else ''))
+        finally:
+            pool.close()
+            pool.join()
+        # Any frame will do: the cost does not depend on the pixels
+        frame = dataset.Dataset(args.dataset).frame(0).reshape(1, -1) * PIXEL_SCALE
+        measure_latency(results, frame.astype(np.float32))
+    finally:
+        shutil.rmtree(scratch)
+    results = rank(results)
+    print(format_table(results))
+    print('%d trials in %.0f s, %d stopped early' % (
+        len(results), time.time() - start, sum(row['stopped_early'] for row in results)))
+    if args.json_file:
+        with open(args.json_file, 'w') as output:
+            json.dump({'benchmark': 'sweep', 'time': time.time(), 'dataset': args.dataset,
+                       'results': results}, output, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
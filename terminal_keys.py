@@ -0,0 +1,83 @@
+# Name:         terminal_keys.py
+# Description:  Steering keys read from the terminal, for driving and
+#               capturing without a pygame window.
+# Notes:        A terminal only reports key presses, not releases, and repeats
+#               only the last key held, so keys latch instead: Up and Down set
+#               the throttle (the opposite key stops it), Left and Right the
+#               steering (the opposite key straightens it), space stops both
+#               and q quits. w, a, s and d work like the arrows. POSIX only;
+#               the terminal is put in cbreak mode, so Ctrl+C still works, and
+#               restored by close().
+
+"""Latched arrow keys from a terminal in cbreak mode."""
+import os
+import select
+import sys
+import termios
+import tty
+
+# Last byte of the escape sequence each arrow key sends
+ARROWS = {b'A': 'up', b'B': 'down', b'C': 'right', b'D': 'left'}
+LETTERS = {b'w': 'up', b's': 'down', b'd': 'right', b'a': 'left', b' ': 'stop', b'q': 'quit'}
+
+
+class TerminalKeys(object):
+    """get_keys() returns (up, down, left, right, changed) like the pygame one."""
+
+    def __init__(self, stream=None):
+        self.fd = (stream or sys.stdin).fileno()
+        self.saved = termios.tcgetattr(self.fd)
+        tty.setcbreak(self.fd)
+        # -1, 0 or 1: reverse/stopped/forward and left/straight/right
+        self.throttle = 0
+        self.steering = 0
+        self.quit = False
+        self._pending = b''
+
+    def presses(self):
+        """Returns the names of the keys pressed since the last call."""
+        data = self._pending
+        while select.select([self.fd], [], [], 0)[0]:
+            chunk = os.read(self.fd, 64)
+            if not chunk:
+                break
+            data += chunk
+        names = []
+        index = 0
+        while index < len(data):
+            if data[index:index + 1] == b'\x1b':
+                if data[index + 1:index + 2] not in (b'', b'['):
+                    # A lone Escape, not an arrow
+                    index += 1
+                    continue
+                if len(data) - index < 3:
+                    # The rest of the sequence has not arrived yet
+                    break
+                names.append(ARROWS.get(data[index + 2:index + 3]))
+                index += 3
+            else:
+                names.append(LETTERS.get(data[index:index + 1].lower()))
+                index += 1
+        self._pending = data[index:]
+        return [name for name in names if name]
+
+    def get_keys(self):
+        before = (self.throttle, self.steering)
+        for name in self.presses():
+            if name == 'up':
+                self.throttle = 0 if self.throttle < 0 else 1
+            elif name == 'down':
+                self.throttle = 0 if self.throttle > 0 else -1
+            elif name == 'left':
+                self.steering = 0 if self.steering > 0 else -1
+            elif name == 'right':
+                self.steering = 0 if self.steering < 0 else 1
+            elif name == 'stop':
+                self.throttle = self.steering = 0
+            elif name == 'quit':
+                self.quit = True
+        return (self.throttle > 0, self.throttle < 0, self.steering < 0, self.steering > 0,
+                (self.throttle, self.steering) != before)
+
+    def close(self):
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
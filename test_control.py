@@ -7,7 +7,10 @@
 # References:   Most of the PyGame control and server information is taken
 #               directly from https://github.com/bskari/pi-rc/blob/master/interactive_control.py
 # Notes:        I have made modifications to the code obtained from above in order
-#               to streamline the training process.
+#               to streamline the training process. --roi, --scale and
+#               --equalize pick the preprocessing spec (see preprocess.py).
+#               Frames are written to the --output dataset in the background
+#               as they are captured (see capture_writer.py).
 
 import pygame
 import pygame.font
@@ -15,206 +18,189 @@ import numpy as np
 import socket
 import argparse
 import json
-import cStringIO
 import io
 import time
 
 from pygame.locals import *
+from common import CommandChannel
 from common import dead_frequency
+from common import load_configuration
 from common import server_up
-from PIL import Image
+from frame_receiver import FrameReceiver
+from frame_receiver import clock as monotonic
+from capture_writer import CaptureWriter
+import dataset
+from dedupe import DISTANCE, DuplicateFilter
+from metrics import Metrics, add_arguments, from_args
+from wire_format import FORMATS
+import preprocess
 
 
 UP = LEFT = DOWN = RIGHT = False
 QUIT = False
 
-# Name:      load_configuration(configuration_file)
-# Description: Generates a dict of JSON command messages for each movement.
-def load_configuration(configuration_file):
-    configuration = json.loads(configuration_file.read())
-    dead = dead_frequency(configuration['frequency'])
-    sync_command = {
-        'frequency': configuration['frequency'],
-        'dead_frequency': dead,
-        'burst_us': configuration['synchronization_burst_us'],
-        'spacing_us': configuration['synchronization_spacing_us'],
-        'repeats': configuration['total_synchronizations'],
-    }
-    base_command = {
-        'frequency': configuration['frequency'],
-        'dead_frequency': dead,
-        'burst_us': configuration['signal_burst_us'],
-        'spacing_us': configuration['signal_spacing_us'],
-    }
-
-    movement_to_command = {}
-    for key in (
-        'forward',
-        'forward_left',
-        'forward_right',
-        'left',
-        'reverse',
-        'reverse_left',
-        'reverse_right',
-        'right',
-    ):
-        command_dict = base_command.copy()
-        command_dict['repeats'] = configuration[key]
-        movement_to_command[key] = command_dict
-
-    direct_commands = {
-        key: json.dumps([sync_command, movement_to_command[key]])
-        for key in movement_to_command
-    }
-
-    # We also need to add an idle command; just broadcast at the dead frequency
-    command_dict = [base_command.copy()]
-    command_dict[0]['frequency'] = dead
-    command_dict[0]['repeats'] = 20  # Doesn't matter
-    direct_commands['idle'] = json.dumps(command_dict)
-
-    return direct_commands
-
-# Name:      interactive_control(host, port, configuration)
+# Name:      interactive_control(host, port, configuration, dedupe, metrics, spec, output)
 # Description: Runs the interactive control.
-def interactive_control(host, port, configuration):
+def interactive_control(host, port, configuration, dedupe=DISTANCE, metrics=None, spec=None,
+                        output=dataset.DATASET_DIR):
+  # Image is 320x120 (or whatever spec makes of it) that is stored as one
+  # uint8 row vector, written to the dataset in the background
+  # Near-identical frames (the car stopped or crawling) are not stored
+  spec = spec or preprocess.Preprocess()
+  duplicates = DuplicateFilter(dedupe, frame_shape=spec.shape) if dedupe >= 0 else None
+  writer = CaptureWriter(output, spec, duplicates)
+
   # Setting up server
   server_socket = socket.socket()
   server_socket.bind(('192.168.1.186', 8000))
   server_socket.listen(0)
 
   # accept Raspberry Pi connection
-  connection = server_socket.accept()[0].makefile('rb')
+  connection = server_socket.accept()[0]
+  receiver = FrameReceiver(connection, formats=FORMATS)
 
-  # Creating labels using one hot encoding method. There are 4 commands: 
-  # up, down, left, right and therefore labels are 4 dimensional
-  # vectors. 
-  labels = np.zeros((4,4), 'float')
-  for i in range(4):
-    labels[i,i] = 1
-  # The actual assignment of keypress to label
-  temp_label = np.zeros((1,4), 'float')
+  # There are 4 commands: left, right, up, down which are stored as class
+  # indexes 0-3 and one hot encoded when the data is saved.
 
   # Starting PyGame window to control RC Car
   pygame.init()
 
-  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  # One socket and pre-encoded payloads; the command is asked for on every
+  # frame and the channel only sends it when it changes or is due again. It
+  # falls back to idle if frames stop arriving.
+  channel = CommandChannel(host, port, configuration, failsafe=1.0)
+  channel.start()
   # Assign send_inst to True initially; stream condition
   global send_inst
   send_inst = True
   global command 
   command = 'idle'
-  # Image is 320x120 that is reshaped into one row vector
-  image_array = np.zeros((1, 38400))
-  image_label = np.zeros((1,4), 'float')
+  crop_buffer = np.empty(spec.shape, np.uint8)
+  decode_frame = None
   saved_frame = 0
   total_frames = 0
+
+  # Time spent in each step of the loop, see metrics.py
+  metrics = metrics or Metrics()
+  metrics.add_source('receiver', receiver.stats)
+  metrics.add_source('channel', channel.stats)
+  metrics.add_source('writer', writer.stats)
+  receive_time = metrics.histogram('receive')
+  decode_time = metrics.histogram('decode')
+  keys_time = metrics.histogram('keys')
+  send_time = metrics.histogram('send')
+  frame_time = metrics.histogram('frame')
   
   print 'Collecting images...'
     
   try: 
-    stream_bytes = ' '
     frame = 1
     while send_inst:
-      stream_bytes += connection.read(1024)
-      # JPEG image files begin with FF D8 and end with FF D9
-      first = stream_bytes.find('\xff\xd8')
-      last = stream_bytes.find('\xff\xd9')
-
-      if first != -1 and last != -1:
-        jpg = stream_bytes[first:last + 2]
-        stream_bytes = stream_bytes[last + 2:]
-        image = Image.open(cStringIO.StringIO(jpg))
-        image = image.convert(mode='L')
-        image = np.asarray(image)
-        # Cropping the interesting portions
-        image_crop = image[120:240, :]
-        temp_array = image_crop.reshape(1, 38400).astype(np.float32)
-
-        frame += 1
-        total_frames += 1
+      # Each JPEG arrives behind a '<L' length header from the client
+      start = monotonic()
+      jpg = receiver.receive()
+      if jpg is None:
+        break
+      received = monotonic()
+      receive_time.record(received - start)
+
+      # Decoding to greyscale and reducing the interesting portion as spec
+      # says, in whichever format the client picked with its first frame
+      if decode_frame is None:
+        decode_frame = spec.decoder(receiver.format)
+      image_crop = decode_frame(jpg, crop_buffer)
+      decoded = monotonic()
+      decode_time.record(decoded - received)
+
+      frame += 1
+      total_frames += 1
        
-        for event in pygame.event.get():
-          if event.type == KEYDOWN:
-            key_input = pygame.key.get_pressed()
-
-            if key_input[pygame.K_w]:
-              print 'Forward'
-              command = 'forward'
-              saved_frame += 1
-              image_array = np.vstack((image_array, temp_array))
-              image_label = np.vstack((image_label, labels[2]))
-
-            elif key_input[pygame.K_w] and key_input[pygame.K_d]:
-              print 'Forward and Right'
-              command = 'forward_right'
-              saved_frame += 1
-              image_array = np.vstack((image_array, temp_array))
-              image_label = np.vstack((image_label, labels[1]))
-
-            elif key_input[pygame.K_w] and key_input[pygame.K_a]:
-              print 'Forward and Left'
-              command = 'forward_left'
-              saved_frame += 1
-              image_array = np.vstack((image_array, temp_array))
-              image_label = np.vstack((image_label, labels[0]))
-
-            elif key_input[pygame.K_s] and key_input[pygame.K_a]:
-              print 'Reverse and Left'
-              command = 'reverse_left'
-
-            elif key_input[pygame.K_w] and key_input[pygame.K_d]:
-              print 'Reverse and Right'
-              command = 'reverse_right'
-
-            elif key_input[pygame.K_s]:
-              print 'Reverse'
-              command = 'reverse'
-              saved_frame += 1
-              image_array = np.vstack((image_array, temp_array))
-              image_label = np.vstack((image_label, labels[3]))
-
-            elif key_input[pygame.K_a]:
-              print 'Left'
-              command = 'left'
-              saved_frame += 1
-              image_array = np.vstack((image_array, temp_array))
-              image_label = np.vstack((image_label, labels[0]))
-
-            elif key_input[pygame.K_d]:
-              print 'Right'
-              command = 'right'
-              saved_frame += 1
-              image_array = np.vstack((image_array, temp_array))
-              image_label = np.vstack((image_label, labels[1]))
-
-            elif key_input[pygame.K_q]:
-              print 'Quitting'
-              send_inst = False
-              break
-
-          elif event.type == pygame.KEYUP:
-            print 'Idle'
-            command = 'idle'
-
-      
-          try:
-              sock.sendto(configuration[command], (host, port))
-          except TypeError:
-              # Windows + Python 3 workaround?
-              sock.sendto(bytes(configuration[command], 'utf-8'), (host, port))
-
-
-    train = image_array[1:,:]
-    training_labels = image_label[1:,:]
-    # Saving images and labels to disk
+      for event in pygame.event.get():
+        if event.type == KEYDOWN:
+          key_input = pygame.key.get_pressed()
+
+          if key_input[pygame.K_w]:
+            print 'Forward'
+            command = 'forward'
+            saved_frame += 1
+            writer.append(image_crop, 2)
+
+          elif key_input[pygame.K_w] and key_input[pygame.K_d]:
+            print 'Forward and Right'
+            command = 'forward_right'
+            saved_frame += 1
+            writer.append(image_crop, 1)
+
+          elif key_input[pygame.K_w] and key_input[pygame.K_a]:
+            print 'Forward and Left'
+            command = 'forward_left'
+            saved_frame += 1
+            writer.append(image_crop, 0)
+
+          elif key_input[pygame.K_s] and key_input[pygame.K_a]:
+            print 'Reverse and Left'
+            command = 'reverse_left'
+
+          elif key_input[pygame.K_w] and key_input[pygame.K_d]:
+            print 'Reverse and Right'
+            command = 'reverse_right'
+
+          elif key_input[pygame.K_s]:
+            print 'Reverse'
+            command = 'reverse'
+            saved_frame += 1
+            writer.append(image_crop, 3)
+
+          elif key_input[pygame.K_a]:
+            print 'Left'
+            command = 'left'
+            saved_frame += 1
+            writer.append(image_crop, 0)
+
+          elif key_input[pygame.K_d]:
+            print 'Right'
+            command = 'right'
+            saved_frame += 1
+            writer.append(image_crop, 1)
+
+          elif key_input[pygame.K_q]:
+            print 'Quitting'
+            send_inst = False
+            break
+
+        elif event.type == pygame.KEYUP:
+          print 'Idle'
+          command = 'idle'
+      step = monotonic()
+      keys_time.record(step - decoded)
+
+      channel.send(command)
+      now = monotonic()
+      send_time.record(now - step)
+      frame_time.record(now - start)
+
+
+    # Writing out the last images and labels
     print 'Saving data...'
-    np.savez('test.npz', train=train, train_labels = training_labels)
+    writer.close()
 
     print 'Total Frames:', total_frames
     print 'Saved Frames:', saved_frame
     print 'Dropped Frames:', total_frames - saved_frame
+    if duplicates is not None:
+      print 'Near duplicates not stored:', duplicates.stats()
+    print 'Stored Frames:', writer.written, 'in', output, 'as', writer.session
+    if writer.dropped:
+      print 'Frames dropped while the disk fell behind:', writer.dropped
+    if writer.lost:
+      print 'Frames lost to a write error:', writer.lost, writer.error
+    print 'Receiver stats:', receiver.stats()
+    print 'Command stats:', channel.stats()
+    print metrics.format_line()
   finally: 
+    writer.close()
+    channel.idle()
+    channel.close()
     connection.close()
     server_socket.close()
     pygame.quit()
@@ -244,6 +230,23 @@ def make_parser():
         help='The server to send control commands to.',
         default='127.1'
     )
+    parser.add_argument(
+        '--dedupe',
+        dest='dedupe',
+        help='Skip frames within this many hash bits of a recent frame with '
+             'the same label; -1 keeps every frame.',
+        default=DISTANCE,
+        type=int
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        dest='output',
+        help='Dataset directory the captured frames are added to.',
+        default=dataset.DATASET_DIR
+    )
+    preprocess.add_arguments(parser)
+    add_arguments(parser)
     return parser
 
 # Name:     main()
@@ -263,7 +266,8 @@ def main():
         print('Server does not appear to be listening for messages, aborting')
         return
 
-    interactive_control(args.server, args.port, configuration)
+    interactive_control(args.server, args.port, configuration, args.dedupe, from_args(args),
+                        preprocess.from_args(args), args.output)
 
 # This is a standard boilerplate function
 if __name__ == '__main__':
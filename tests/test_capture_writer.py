@@ -0,0 +1,117 @@
+"""Tests for the queueing, dropping and closing of capture_writer.CaptureWriter."""
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+import dataset
+from capture_writer import CaptureWriter
+from preprocess import Preprocess
+
+SPEC = Preprocess(scale=4)
+
+
+class CaptureWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def writer(self, **kwargs):
+        writer = CaptureWriter(self.directory, SPEC, session='test', **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def frame(self, value):
+        return np.full(SPEC.shape, value, np.uint8)
+
+    def test_everything_appended_is_written_on_close(self):
+        writer = self.writer(chunk_frames=4)
+        for value in range(10):
+            self.assertTrue(writer.append(self.frame(value), value % 4))
+        writer.close()
+        stats = writer.stats()
+        self.assertEqual((stats['frames'], stats['written'], stats['dropped']), (10, 10, 0))
+        data = dataset.Dataset(self.directory)
+        self.assertEqual(len(data), 10)
+        self.assertEqual([int(data.frame(index)[0]) for index in range(10)], list(range(10)))
+        self.assertEqual(list(data.labels), [value % 4 for value in range(10)])
+        self.assertEqual(data.preprocess, SPEC)
+
+    def test_close_twice(self):
+        writer = self.writer()
+        writer.append(self.frame(1), 0)
+        writer.close()
+        writer.close()
+        self.assertEqual(writer.written, 1)
+
+    def test_full_queue_drops_whole_chunks_and_counts_them(self):
+        # Room for one chunk waiting behind the one being written
+        writer = self.writer(chunk_frames=2, max_queued=2 * SPEC.size)
+        writing = threading.Event()
+        release = threading.Event()
+        write = writer._write
+
+        def slow_write(*chunk):
+            writing.set()
+            release.wait()
+            write(*chunk)
+
+        writer._write = slow_write
+        for value in range(2):
+            writer.append(self.frame(value), 0)
+        self.assertTrue(writing.wait(5.0))
+        # Queued behind the write, then dropped, then left in the open chunk
+        for value in range(2, 7):
+            writer.append(self.frame(value), 1)
+        self.assertEqual(writer.dropped, 2)
+        release.set()
+        writer.close()
+        stats = writer.stats()
+        self.assertEqual((stats['frames'], stats['written'], stats['dropped']), (7, 5, 2))
+        data = dataset.Dataset(self.directory)
+        self.assertEqual([int(data.frame(index)[0]) for index in range(len(data))],
+                         [0, 1, 2, 3, 6])
+        manifest = dataset.read_manifest(self.directory)
+        self.assertEqual(sum(entry['dropped'] for entry in manifest['shards']), 2)
+
+    def test_drops_are_counted_against_the_next_shard_listed(self):
+        # One frame per chunk and per shard, one chunk waiting
+        writer = self.writer(chunk_frames=1, max_queued=SPEC.size, max_bytes=SPEC.size)
+        writing = threading.Semaphore(0)
+        release = threading.Semaphore(0)
+        write = writer._write
+
+        def slow_write(*chunk):
+            writing.release()
+            release.acquire()
+            write(*chunk)
+
+        writer._write = slow_write
+        writer.append(self.frame(0), 0)
+        writing.acquire()
+        writer.append(self.frame(1), 0)     # waits
+        writer.append(self.frame(2), 0)     # dropped, listed with shard 0
+        release.release()
+        writing.acquire()                   # frame 1 is being written now
+        writer.append(self.frame(3), 0)     # waits
+        writer.append(self.frame(4), 0)     # dropped, listed with shard 1
+        release.release()
+        release.release()
+        writer.close()
+        manifest = dataset.read_manifest(self.directory)
+        self.assertEqual([entry['frames'] for entry in manifest['shards']], [1, 1, 1])
+        self.assertEqual([entry['dropped'] for entry in manifest['shards']], [1, 1, 0])
+        self.assertEqual(writer.dropped, 2)
+
+    def test_refuses_another_spec(self):
+        writer = self.writer()
+        writer.append(self.frame(1), 0)
+        writer.close()
+        self.assertRaises(ValueError, CaptureWriter, self.directory, Preprocess(scale=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
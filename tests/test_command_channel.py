@@ -0,0 +1,119 @@
+"""Tests for the coalescing and held back commands of common.CommandChannel."""
+import socket
+import time
+import unittest
+
+from common import CommandChannel
+from dispatcher import CommandDispatcher
+
+CONFIGURATION = {'idle': 'i', 'forward': 'f', 'forward_left': 'fl', 'forward_right': 'fr',
+                 'reverse': 'r'}
+
+
+class ChannelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Stands in for pi_pcm
+        self.pcm = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.pcm.bind(('127.0.0.1', 0))
+        self.pcm.settimeout(1.0)
+        self.port = self.pcm.getsockname()[1]
+
+    def tearDown(self):
+        self.pcm.close()
+
+    def received(self, count):
+        return [self.pcm.recv(64).decode('utf-8') for _ in range(count)]
+
+    def nothing_received(self):
+        self.pcm.settimeout(0.05)
+        try:
+            self.assertRaises(socket.timeout, self.pcm.recv, 64)
+        finally:
+            self.pcm.settimeout(1.0)
+
+
+class CommandChannelTest(ChannelTestCase):
+
+    def channel(self, **kwargs):
+        channel = CommandChannel('127.0.0.1', self.port, CONFIGURATION, **kwargs)
+        self.addCleanup(channel.close)
+        return channel
+
+    def test_unchanged_command_is_coalesced(self):
+        channel = self.channel(resend_interval=10.0, min_interval=0)
+        self.assertTrue(channel.send('forward'))
+        self.assertFalse(channel.send('forward'))
+        self.assertFalse(channel.send('forward'))
+        self.assertEqual((channel.sent, channel.suppressed), (1, 2))
+        self.assertEqual(self.received(1), ['f'])
+        self.nothing_received()
+
+    def test_unchanged_command_is_resent_after_resend_interval(self):
+        channel = self.channel(resend_interval=0.02, min_interval=0)
+        self.assertTrue(channel.send('forward'))
+        time.sleep(0.03)
+        self.assertTrue(channel.send('forward'))
+        self.assertEqual(self.received(2), ['f', 'f'])
+
+    def test_change_within_min_interval_is_held_for_tick(self):
+        channel = self.channel(min_interval=0.05)
+        self.assertTrue(channel.send('forward'))
+        self.assertFalse(channel.send('reverse'))
+        self.assertEqual(channel.pending, 'reverse')
+        self.assertEqual(channel.rate_limited, 1)
+        # Too early, still held
+        channel.tick()
+        self.assertEqual(channel.sent, 1)
+        time.sleep(0.06)
+        channel.tick()
+        self.assertIsNone(channel.pending)
+        self.assertEqual(self.received(2), ['f', 'r'])
+
+    def test_newest_change_wins(self):
+        channel = self.channel(min_interval=0.05)
+        channel.send('forward')
+        channel.send('reverse')
+        channel.send('forward_left')
+        time.sleep(0.06)
+        channel.tick()
+        self.assertEqual(self.received(2), ['f', 'fl'])
+
+    def test_asking_for_the_last_sent_command_drops_the_held_one(self):
+        channel = self.channel(min_interval=0.05)
+        channel.send('forward')
+        channel.send('reverse')
+        self.assertFalse(channel.send('forward'))
+        self.assertIsNone(channel.pending)
+        time.sleep(0.06)
+        channel.tick()
+        self.assertEqual(channel.sent, 1)
+
+    def test_idle_is_never_held(self):
+        channel = self.channel(min_interval=10.0)
+        channel.send('forward')
+        self.assertTrue(channel.idle())
+        self.assertEqual(self.received(2), ['f', 'i'])
+
+    def test_failsafe_sends_idle(self):
+        channel = self.channel(min_interval=0, failsafe=0.02)
+        channel.send('forward')
+        time.sleep(0.03)
+        channel.tick()
+        self.assertEqual(channel.failsafes, 1)
+        self.assertEqual(self.received(2), ['f', 'i'])
+
+
+class CommandDispatcherTest(ChannelTestCase):
+
+    def test_held_change_is_flushed_without_keepalive_or_failsafe(self):
+        dispatcher = CommandDispatcher('127.0.0.1', self.port, CONFIGURATION,
+                                       min_interval=0.02)
+        self.addCleanup(dispatcher.close)
+        self.assertTrue(dispatcher.dispatch(2))
+        self.assertFalse(dispatcher.dispatch(0))
+        self.assertEqual(self.received(2), ['f', 'fl'])
+
+
+if __name__ == '__main__':
+    unittest.main()
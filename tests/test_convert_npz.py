@@ -0,0 +1,87 @@
+"""Tests for the shard naming and re-run rules of convert_npz."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import convert_npz
+
+
+class ShardBasesTest(unittest.TestCase):
+
+    def test_names_come_from_the_file_names(self):
+        self.assertEqual(convert_npz.shard_bases(['a/run1.npz', 'b/run2.npz']),
+                         ['run1', 'run2'])
+
+    def test_a_name_already_in_the_dataset_is_renamed(self):
+        names = ['run1-00000', 'run1-00001']
+        self.assertEqual(convert_npz.shard_bases(['new/run1.npz'], names), ['run1-2'])
+
+    def test_sources_with_the_same_file_name_get_different_names(self):
+        sources = ['a/run1.npz', 'b/run1.npz', 'c/run1.npz']
+        self.assertEqual(convert_npz.shard_bases(sources), ['run1', 'run1-2', 'run1-3'])
+
+    def test_renamed_names_are_taken_too(self):
+        names = ['run1-00000', 'run1-2-00000']
+        self.assertEqual(convert_npz.shard_bases(['run1.npz'], names), ['run1-3'])
+
+    def test_capture_writer_names_do_not_clash_with_their_stem(self):
+        names = ['session-part0001-00000']
+        self.assertEqual(convert_npz.shard_bases(['session.npz'], names), ['session'])
+
+
+class IsConvertedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.source = os.path.join(self.directory, 'run1.npz')
+        with open(self.source, 'wb') as capture:
+            capture.write(b'capture')
+
+    def entry(self, **changes):
+        entry = {'name': 'run1-00000', 'source': self.source}
+        entry.update(convert_npz.source_stamp(self.source))
+        entry.update(changes)
+        return entry
+
+    def test_same_path_size_and_time(self):
+        self.assertTrue(convert_npz.is_converted(self.source, [self.entry()]))
+
+    def test_other_path(self):
+        entry = self.entry(source=os.path.join(self.directory, 'run2.npz'))
+        self.assertFalse(convert_npz.is_converted(self.source, [entry]))
+
+    def test_changed_size(self):
+        entry = self.entry(source_size=self.entry()['source_size'] + 1)
+        self.assertFalse(convert_npz.is_converted(self.source, [entry]))
+
+    def test_changed_time(self):
+        entry = self.entry(source_mtime=self.entry()['source_mtime'] - 60)
+        self.assertFalse(convert_npz.is_converted(self.source, [entry]))
+
+    def test_entries_without_a_stamp_match_on_the_path(self):
+        entry = {'name': 'run1-00000', 'source': self.source}
+        self.assertTrue(convert_npz.is_converted(self.source, [entry]))
+
+
+class ConvertTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_shards_are_named_from_the_base_and_stamped(self):
+        source = os.path.join(self.directory, 'run1.npz')
+        labels = np.eye(4)[[0, 1, 2, 3, 0]]
+        np.savez(source, train=np.full((5, 38400), 127.6), train_labels=labels)
+        output = os.path.join(self.directory, 'dataset')
+        os.makedirs(output)
+        entries, _ = convert_npz.convert((source, 'run1-2', output, 2))
+        self.assertEqual([entry['name'] for entry in entries],
+                         ['run1-2-00000', 'run1-2-00001', 'run1-2-00002'])
+        self.assertEqual([convert_npz.base_name(entry['name']) for entry in entries],
+                         ['run1-2'] * 3)
+        self.assertTrue(convert_npz.is_converted(source, entries))
@@ -0,0 +1,87 @@
+"""Tests for the histogram percentiles and text output of metrics.py."""
+import unittest
+
+from metrics import BOUNDS, PREFIX, Histogram, Metrics
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(Histogram().percentile(0.5), 0.0)
+
+    def test_percentile_is_bucket_upper_bound(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.record(0.003)
+        histogram.record(0.3)
+        self.assertEqual(histogram.percentile(0.5), 0.005)
+        self.assertEqual(histogram.percentile(0.99), 0.005)
+        # Never above the slowest duration recorded
+        self.assertEqual(histogram.percentile(1.0), 0.3)
+
+    def test_duration_on_a_bound_stays_in_that_bucket(self):
+        histogram = Histogram()
+        histogram.record(0.002)
+        histogram.record(0.001)
+        self.assertEqual(histogram.counts[BOUNDS.index(0.002)], 1)
+        self.assertEqual(histogram.percentile(1.0), 0.002)
+
+    def test_slower_than_every_bound(self):
+        histogram = Histogram()
+        histogram.record(25.0)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.percentile(0.5), 25.0)
+
+    def test_stats(self):
+        histogram = Histogram()
+        for seconds in (0.001, 0.002, 0.003):
+            histogram.record(seconds)
+        stats = histogram.stats()
+        self.assertEqual(stats['count'], 3)
+        self.assertAlmostEqual(stats['mean_ms'], 2.0)
+        self.assertAlmostEqual(stats['max_ms'], 3.0)
+        self.assertEqual(sum(stats['buckets']), 3)
+
+
+class FormatTextTest(unittest.TestCase):
+
+    def samples(self, text):
+        values = {}
+        for line in text.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                values[name] = float(value)
+        return values
+
+    def test_buckets_are_cumulative(self):
+        metrics = Metrics()
+        for seconds in (0.00001, 0.003, 0.003, 0.4, 30.0):
+            metrics.record('decode', seconds)
+        values = self.samples(metrics.format_text())
+        bucket = '%s_stage_seconds_bucket{stage="decode",le="%s"}'
+        self.assertEqual(values[bucket % (PREFIX, repr(1e-05))], 1)
+        self.assertEqual(values[bucket % (PREFIX, repr(0.002))], 1)
+        self.assertEqual(values[bucket % (PREFIX, repr(0.005))], 3)
+        self.assertEqual(values[bucket % (PREFIX, repr(0.5))], 4)
+        self.assertEqual(values[bucket % (PREFIX, repr(10.0))], 4)
+        self.assertEqual(values[bucket % (PREFIX, '+Inf')], 5)
+        self.assertEqual(values['%s_stage_seconds_count{stage="decode"}' % PREFIX], 5)
+        self.assertAlmostEqual(values['%s_stage_seconds_sum{stage="decode"}' % PREFIX],
+                               30.40601)
+        # One line per bound plus +Inf, and the memory gauges
+        lines = [name for name in values if name.startswith(PREFIX + '_stage_seconds_bucket')]
+        self.assertEqual(len(lines), len(BOUNDS) + 1)
+        self.assertIn('%s_rss_bytes' % PREFIX, values)
+
+    def test_one_series_per_stage(self):
+        metrics = Metrics()
+        metrics.record('receive', 0.001)
+        metrics.record('infer', 0.002)
+        text = metrics.format_text()
+        self.assertIn('stage="receive"', text)
+        self.assertIn('stage="infer"', text)
+        self.assertEqual(text.count('# TYPE %s_stage_seconds histogram' % PREFIX), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
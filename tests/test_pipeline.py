@@ -0,0 +1,44 @@
+"""Tests for the drop-oldest queue of pipeline.py."""
+import threading
+import time
+import unittest
+
+from pipeline import Empty, LatestQueue
+
+
+class LatestQueueTest(unittest.TestCase):
+
+    def test_keeps_the_newest(self):
+        frames = LatestQueue(2)
+        for item in range(5):
+            frames.put(item)
+        self.assertEqual(frames.dropped, 3)
+        self.assertEqual(frames.max_depth, 2)
+        self.assertEqual([frames.get(), frames.get()], [3, 4])
+        self.assertEqual(frames.qsize(), 0)
+
+    def test_no_drops_while_the_consumer_keeps_up(self):
+        frames = LatestQueue(1)
+        for item in range(3):
+            frames.put(item)
+            self.assertEqual(frames.get(), item)
+        self.assertEqual(frames.dropped, 0)
+
+    def test_get_times_out(self):
+        frames = LatestQueue(1)
+        start = time.time()
+        self.assertRaises(Empty, frames.get, 0.05)
+        self.assertGreaterEqual(time.time() - start, 0.04)
+
+    def test_get_wakes_on_put(self):
+        frames = LatestQueue(1)
+        timer = threading.Timer(0.05, frames.put, ('frame',))
+        timer.start()
+        try:
+            self.assertEqual(frames.get(timeout=5.0), 'frame')
+        finally:
+            timer.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,17 @@
 # Description:  Trains an artificial neural network (ANN) or multi-layer perceptron (MLP)
 #               model using images obtained from self_control_train.py
 # Instructions: Make sure training numpy arrays (.npz) files are in current directory. 
+#               If 'training_data/dataset' exists (see convert_npz.py) it is used instead.
+#               Run with --stream to train from it batch by batch, and with
+#               --augment to also randomly flip, shift and re-light each
+#               training batch (see augment.py) in --workers processes.
+#               A checkpoint is saved after every epoch; --resume continues
+#               from it. --fine-tune models/model.h5 trains an existing model
+#               further on the dataset shards it has not seen yet, mixed with
+#               a sample of the ones it has (see checkpoints.py).
+#               The model's input size comes from the preprocessing spec the
+#               frames were made with (see preprocess.py), which is saved
+#               next to the model for the servers to use.
 # Notes:        For more information, please check out the main github repo
 #               https://github.com/kechiao/SmallSelfSteeringSuperCar
 
@@ -9,64 +20,260 @@
 #GET MORE DATA (Such is the life of a data engineer/machine learner...:-))
 
 import numpy as np 
+import argparse
 import glob 
+import multiprocessing
+import os
 import random
+import sys
 
-from keras.models import Sequential
+import batches
+import checkpoints
+import dataset
+import preprocess
+from augment import Augmenter
+
+from keras.models import Sequential, load_model
 from keras.layers import Dense, Activation, Dropout, advanced_activations
 from matplotlib import pyplot as plt 
 from sklearn import utils
 
-# Containers used to concatenate image and label vectors
-trainingImages = np.zeros((1,38400))
-trainingLabels = np.zeros((1,4))
+parser = argparse.ArgumentParser(description='Trains the auto-driving model.')
+parser.add_argument(
+    '--stream',
+    dest='stream',
+    action='store_true',
+    help='Feed batches from the dataset instead of loading it all into RAM.'
+)
+parser.add_argument(
+    '--dataset',
+    dest='dataset',
+    default=dataset.DATASET_DIR,
+    help='Dataset directory, e.g. one written by dedupe.py.'
+)
+parser.add_argument(
+    '--augment',
+    dest='augment',
+    action='store_true',
+    help='Augment training batches on the fly, implies --stream.'
+)
+parser.add_argument(
+    '--workers',
+    dest='workers',
+    default=multiprocessing.cpu_count(),
+    type=int,
+    help='Processes building augmented batches, 0 builds them in a thread.'
+)
+parser.add_argument(
+    '--epochs',
+    dest='epochs',
+    default=50,
+    type=int,
+    help='Epochs to train for.'
+)
+parser.add_argument(
+    '--output',
+    dest='output',
+    default='models/model.h5',
+    help='Where to save the trained model.'
+)
+parser.add_argument(
+    '--checkpoints',
+    dest='checkpoints',
+    default=checkpoints.CHECKPOINT_DIR,
+    help='Directory the model is checkpointed to after every epoch.'
+)
+parser.add_argument(
+    '--resume',
+    dest='resume',
+    action='store_true',
+    help='Continue the run whose checkpoint is in --checkpoints.'
+)
+parser.add_argument(
+    '--fine-tune',
+    dest='fine_tune',
+    default=None,
+    help='Model to train further on the dataset shards it has not seen.'
+)
+parser.add_argument(
+    '--replay',
+    dest='replay',
+    default=1.0,
+    type=float,
+    help='When fine-tuning, seen frames mixed in per new frame.'
+)
+args = parser.parse_args()
+args.stream = args.stream or args.augment
+
+if args.resume:
+  state = checkpoints.read_state(args.checkpoints)
+  if state is None:
+    print 'No checkpoint to resume from in', args.checkpoints
+    sys.exit(1)
+  # Pick the same data, in the same order, as the interrupted run
+  for option in ('dataset', 'stream', 'augment', 'epochs', 'output', 'fine_tune', 'replay'):
+    setattr(args, option, state['args'][option])
+  print 'Resuming after epoch %d of %d' % (state['epoch'], args.epochs)
+else:
+  state = {'epoch': 0, 'seed': random.randint(0, 2 ** 31 - 1), 'args': vars(args)}
+np.random.seed(state['seed'])
+
+have_dataset = os.path.exists(os.path.join(args.dataset, dataset.MANIFEST))
+if (args.stream or args.fine_tune) and not have_dataset:
+  print 'Streaming, augmenting and fine-tuning need a dataset, run convert_npz.py first'
+  sys.exit(1)
+
+if have_dataset:
+  data = dataset.Dataset(args.dataset)
+  spec = data.preprocess
+  selection = np.arange(len(data))
+  seen_shards = []
+  new_shards = data.names
+  if args.fine_tune:
+    parent = checkpoints.read_seen(args.fine_tune)
+    if parent is None:
+      print 'No %s, cannot tell which data %s has seen' % (
+          checkpoints.manifest_file(args.fine_tune), args.fine_tune)
+      sys.exit(1)
+    if preprocess.from_dict(parent.get('preprocess')) != spec:
+      print '%s was trained on %r frames but %s holds %r frames' % (
+          args.fine_tune, preprocess.from_dict(parent.get('preprocess')), args.dataset, spec)
+      sys.exit(1)
+    seen_shards = parent['shards']
+    selection, new_shards = checkpoints.fine_tune_indices(data, seen_shards, args.replay)
+    if not new_shards:
+      print args.fine_tune, 'has seen every shard of', args.dataset
+      sys.exit(0)
+    print 'Fine-tuning on %d new shards, %d frames with the seen ones mixed in' % (
+        len(new_shards), len(selection))
+
+if args.stream:
+  # Nothing is loaded up front; batches are gathered from the mapped shards
+  # and scaled to float32 as they are needed.
+  train_indices, validation_indices = batches.split(
+      len(selection), validation_split=0.025, seed=state['seed'])
+  train_indices, validation_indices = selection[train_indices], selection[validation_indices]
+elif have_dataset:
+  # Sharded uint8 dataset written by convert_npz.py. Opening it only maps the
+  # files; frames are gathered in shuffled order straight into one float32
+  # array scaled to [0,1], so there are no extra full size copies.
+  order = selection[np.random.permutation(len(selection))]
+  trainingImages = data.load(order)
+  trainingLabels = dataset.one_hot(data.labels[order])
+else:
+  # Returns a list of all .npz extension files to import training data
+  training_data = glob.glob('training_data/*.npz')
 
-# Returns a list of all .npz extension files to import training data
-training_data = glob.glob('training_data/*.npz')
+  # Every file must have been captured with the same preprocessing
+  specs = [preprocess.from_npz(np.load(training_set)) for training_set in training_data]
+  spec = specs[0] if specs else preprocess.Preprocess()
+  if any(other != spec for other in specs):
+    print 'Training files were captured with different preprocessing:'
+    for training_set, other in zip(training_data, specs):
+      print '  %s: %r' % (training_set, other)
+    sys.exit(1)
 
-# Loading data, interating through all .npz files and extracting contents
-for training_set in training_data:
-  data = np.load(training_set)
-  trainingImages = np.vstack((data['train'],trainingImages))
-  trainingLabels = np.vstack((data['train_labels'],trainingLabels))
+  # Containers used to concatenate image and label vectors
+  trainingImages = np.zeros((1,spec.size))
+  trainingLabels = np.zeros((1,4))
 
-# We want to shuffle the data so the network will not accidentally learn a whole class
-# when we input batches of data. That would be bad. 
-# Also, we are scaling the inputs from original pixel intensity values [0,255] to [0,1]
-trainingImages, trainingLabels = utils.shuffle(trainingImages[1:,:],trainingLabels[1:,:])
-trainingImages = trainingImages / 255.0
+  # Loading data, interating through all .npz files and extracting contents
+  for training_set in training_data:
+    data = np.load(training_set)
+    trainingImages = np.vstack((data['train'],trainingImages))
+    trainingLabels = np.vstack((data['train_labels'],trainingLabels))
 
+  # We want to shuffle the data so the network will not accidentally learn a whole class
+  # when we input batches of data. That would be bad. 
+  # Also, we are scaling the inputs from original pixel intensity values [0,255] to [0,1]
+  trainingImages, trainingLabels = utils.shuffle(trainingImages[1:,:],trainingLabels[1:,:])
+  trainingImages = trainingImages * preprocess.PIXEL_SCALE
 
-print 'Starting Training...'
+
+print 'Starting Training on', spec
 
 # Using Parametric ReLU to prevent saturation of gradients
 # We also use logistic regression activation because we want a probability
 # that output belongs in one of 4 classes. Therefore, we also use cross-entropy
 # loss instead of euclidian distances because distances in probabilities don't make sense. 
 
-model = Sequential()
-prelu = advanced_activations.PReLU(init='zero', weights=None)
-model.add(Dense(64, input_dim = 38400, init='lecun_uniform'))
-model.add(prelu)
-model.add(Dense(64, init='lecun_uniform'))
-model.add(prelu)
-model.add(Dense(4, init='lecun_uniform'))
-model.add(Activation('softmax'))
+if state['epoch']:
+  # The checkpoint holds the optimizer state too
+  model = load_model(checkpoints.checkpoint_file(args.checkpoints))
+elif args.fine_tune:
+  model = load_model(args.fine_tune)
+else:
+  model = Sequential()
+  prelu = advanced_activations.PReLU(init='zero', weights=None)
+  model.add(Dense(64, input_dim = spec.size, init='lecun_uniform'))
+  model.add(prelu)
+  model.add(Dense(64, init='lecun_uniform'))
+  model.add(prelu)
+  model.add(Dense(4, init='lecun_uniform'))
+  model.add(Activation('softmax'))
+
+  model.compile(optimizer='sgd', loss='categorical_crossentropy', metrics=['accuracy'])
 
-model.compile(optimizer='sgd', loss='categorical_crossentropy', metrics=['accuracy'])
+checkpointer = checkpoints.checkpointer(args.checkpoints, state)
+
+# Save the model, and what it has been trained on for later fine-tuning
+def save_model():
+  model.save(args.output)
+  if have_dataset:
+    seen = set(seen_shards) | set(new_shards)
+    checkpoints.write_seen(args.output, args.dataset, seen, len(data.shard_indices(seen)),
+                           args.epochs, parent=args.fine_tune, preprocess=spec)
+  else:
+    checkpoints.write_seen(args.output, None, [], len(trainingImages), args.epochs,
+                           files=training_data, preprocess=spec)
 
 # Batch size here is a hyperparameter that requires tuning for best performance. 
-model.fit(trainingImages, trainingLabels, nb_epoch=50, batch_size=256, validation_split=0.025)
+if args.stream:
+  # The generators prefetch in the background, so Keras' own queue is kept short
+  if args.augment:
+    # Shifts are in the stored frames' pixels, so smaller for downsampled ones
+    augmenter = Augmenter(shift=max(1, 4 // spec.scale), frame_shape=spec.shape)
+    training = batches.BatchGenerator(data, train_indices, batch_size=256,
+                                      transform=augmenter, workers=args.workers)
+  else:
+    training = batches.BatchGenerator(data, train_indices, batch_size=256)
+  validation = None
+  if len(validation_indices):
+    validation = batches.BatchGenerator(data, validation_indices, batch_size=256, shuffle=False)
+  try:
+    model.fit_generator(
+        training,
+        samples_per_epoch=training.samples,
+        nb_epoch=args.epochs,
+        validation_data=validation,
+        nb_val_samples=validation.samples if validation else None,
+        max_q_size=2,
+        callbacks=[checkpointer],
+        initial_epoch=state['epoch'],
+    )
+    # Saved before the generators are torn down, so a slow shutdown loses nothing
+    save_model()
+  finally:
+    training.close()
+    if validation:
+      validation.close()
+  if args.augment:
+    stats = training.stats()
+    print 'Augmented %d samples, %.0f samples/s per process in %d workers' % (
+        stats['samples'], stats['transform_samples_per_second'], stats['workers'])
+  exampleImage = data.frame(train_indices[4]) * preprocess.PIXEL_SCALE
+else:
+  model.fit(trainingImages, trainingLabels, nb_epoch=args.epochs, batch_size=256,
+            validation_split=0.025, callbacks=[checkpointer], initial_epoch=state['epoch'])
+  save_model()
+  exampleImage = trainingImages[4,:]
 
 # Print out an example of an image and predicted output
-print model.predict_classes(trainingImages[4,:].reshape(1,38400))
-testImage = trainingImages[4,:].reshape(120,320)
+print model.predict_classes(exampleImage.reshape(1,spec.size))
+testImage = exampleImage.reshape(spec.shape)
 plt.imshow(testImage, cmap='Greys_r')
 plt.show()
 
-# Save the model
-model.save('models/model.h5')
-
 # Some performance statistics:
 # Note: These will likely differ depending on shuffling and batch gradients.
 
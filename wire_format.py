@@ -0,0 +1,124 @@
+# Name:         wire_format.py
+# Description:  Frame formats the Pi client and the servers can agree on when
+#               the connection is set up, with the client side encoders and
+#               server side decoders.
+# Notes:        'jpeg' is the camera's full colour frame, as always sent.
+#               'gray' is only the region the model looks at (decode.CROP_BOX)
+#               as raw uint8 grayscale, 'zgray' the same through zlib at its
+#               fastest level. Neither needs a JPEG decode on the server.
+#               A client that wants anything but JPEG starts with HELLO in
+#               place of the first length header, followed by a count byte
+#               and one code byte per format it offers, best first. The
+#               server answers HELLO and the code it picked (the first offer
+#               it supports); frames then follow with the usual '<L' headers.
+#               A client that sends no HELLO gets JPEG, as before. A client
+#               that wants progress reports back (see 'feedback.py') adds
+#               the FEEDBACK code to its offer, which servers that do not
+#               know it pass over like any other unknown code.
+
+"""Negotiated wire formats for the camera stream."""
+import zlib
+
+import numpy as np
+
+from decode import CROP_BOX, crop_shape, decode_frame
+from frame_receiver import HELLO
+
+FORMATS = ('jpeg', 'gray', 'zgray')
+# Offered along with the formats to ask for feedback records
+FEEDBACK = 0x80
+
+
+class NegotiationError(ValueError):
+    """Raised when the two ends cannot agree on a format."""
+
+
+def hello(offers, feedback=False):
+    """Returns the client's HELLO message offering the formats in offers,
+    and asking for feedback records if feedback is set."""
+    codes = [FORMATS.index(name) for name in offers] + ([FEEDBACK] if feedback else [])
+    return bytes(HELLO + bytearray([len(codes)] + codes))
+
+
+def answer(name):
+    """Returns the server's reply choosing format name."""
+    return bytes(HELLO + bytearray([FORMATS.index(name)]))
+
+
+def choose(codes, supported):
+    """Returns the first format in the client's codes that is supported."""
+    for code in bytearray(codes):
+        if code < len(FORMATS) and FORMATS[code] in supported:
+            return FORMATS[code]
+    raise NegotiationError('No common format in %r' % (
+        [FORMATS[code] if code < len(FORMATS) else code for code in bytearray(codes)
+         if code != FEEDBACK],))
+
+
+def negotiate(client_socket, offers, feedback=False):
+    """Client side: offers formats on a fresh connection, returns the one
+    picked. With feedback the server is asked to send feedback records."""
+    if list(offers) == ['jpeg'] and not feedback:
+        return 'jpeg'
+    client_socket.sendall(hello(offers, feedback))
+    reply = bytearray()
+    while len(reply) < len(HELLO) + 1:
+        chunk = client_socket.recv(len(HELLO) + 1 - len(reply))
+        if not chunk:
+            raise NegotiationError('Server closed the connection during negotiation')
+        reply += chunk
+    if bytes(reply[:len(HELLO)]) != HELLO or reply[-1] >= len(FORMATS):
+        raise NegotiationError('Unexpected negotiation reply %r' % (bytes(reply),))
+    return FORMATS[reply[-1]]
+
+
+def encoder(name):
+    """Returns the client's function from a frame to the payload for format name.
+
+    'jpeg' takes the JPEG bytes, the others the cropped uint8 grayscale
+    region (see camera.Source.gray_frames()).
+    """
+    if name == 'jpeg':
+        return lambda jpeg: jpeg
+    if name == 'gray':
+        return lambda gray: np.ascontiguousarray(gray, np.uint8).tobytes()
+    if name == 'zgray':
+        return lambda gray: zlib.compress(np.ascontiguousarray(gray, np.uint8).tobytes(), 1)
+    raise NegotiationError('Unknown format %r' % (name,))
+
+
+def decoder(name, box=CROP_BOX, scale=1):
+    """Returns the server's function from a payload to the model's pixels.
+
+    The function has decode_frame's signature: it fills out (any array with
+    crop_shape(box, scale) elements) or returns a new uint8 array. Raw
+    payloads always hold the full resolution CROP_BOX region.
+    """
+    if name == 'jpeg':
+        return lambda payload, out=None: decode_frame(payload, out, box, scale)
+    if name not in FORMATS:
+        raise NegotiationError('Unknown format %r' % (name,))
+    if box != CROP_BOX:
+        raise NegotiationError("Format %r only carries the region %r" % (name, CROP_BOX))
+    full_height, full_width = crop_shape(CROP_BOX)
+    height, width = crop_shape(box, scale)
+
+    def decode(payload, out=None):
+        if name == 'zgray':
+            # FrameReceiver hands out memoryviews, which Python 2's zlib refuses
+            if isinstance(payload, memoryview):
+                payload = payload.tobytes()
+            payload = zlib.decompress(payload)
+        if len(payload) != full_height * full_width:
+            raise ValueError('Raw frame has %d bytes, expected %d' % (
+                len(payload), full_height * full_width))
+        pixels = np.frombuffer(payload, np.uint8).reshape(full_height, full_width)
+        if scale > 1:
+            # Block average, like libjpeg's DCT scaling
+            pixels = pixels.reshape(height, scale, width, scale).mean(axis=(1, 3))
+        if out is None:
+            return pixels.astype(np.uint8)
+        np.copyto(out.reshape(height, width), pixels, casting='unsafe')
+        return out
+
+    return decode